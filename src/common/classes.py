@@ -208,6 +208,7 @@ class Measure:
 class Beat(BaseModel):
     id: int
     gongan_id: int
+    seq: int = -1  # Dense sequence number of the beat in the complete score (numbered from 0), see Score.index_beats.
     # duration: float
     measures: dict[Position, Measure] = Field(default_factory=dict)
     prev: Optional["Beat"] = Field(default=None, repr=False)  # previous beat in the score
@@ -264,6 +265,7 @@ class Gongan(BaseModel):
     comments: list[str] = Field(default_factory=list)
     haslabel: bool = False  # Will be set if the gongan has a Label metadata
     _pass_: PassSequence = 0  # Counts the number of times the gongan is passed during generation of MIDI file.
+    _position_tags_: tuple | None = None  # Cached result of score2notationutils.utils.aggregate_positions.
 
     # @field_validator("metadata", mode="after")
     # @classmethod
@@ -295,6 +297,22 @@ class Score(BaseModel, validate_assignment=True):
     flowinfo: FlowInfo = Field(default_factory=FlowInfo)
     midifile_duration: int = None
     part_info: Part = None
+    beat_count: int = 0
+
+    def index_beats(self) -> None:
+        """Numbers all beats of the score consecutively, starting from 0. The sequence number can be used as an index
+        in lists that contain information about individual beats. Call this method after the last beat has been
+        added to the score."""
+        beats = [beat for gongan in self.gongans for beat in gongan.beats]  # pylint: disable=not-an-iterable
+        for seq, beat in enumerate(beats):
+            beat.seq = seq
+        self.beat_count = len(beats)
+
+    def is_indexed(self) -> bool:
+        """Determines whether the sequence numbers assigned by index_beats are still valid, i.e. no beats have been
+        added or removed since."""
+        beats = [beat for gongan in self.gongans for beat in gongan.beats]  # pylint: disable=not-an-iterable
+        return len(beats) == self.beat_count and all(beat.seq == seq for seq, beat in enumerate(beats))
 
 
 @dataclass
@@ -0,0 +1,95 @@
+"""Destinations of the files that are generated by the notation2midi pipeline.
+By default, the output is written to the file locations that are determined by the run settings. An application
+that embeds the converter can select another sink through `RunSettings.output_sink` to retrieve the content of the
+generated files without touching the file system, e.g. a BytesIOSink or a CallbackSink.
+"""
+
+import io
+import os
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from enum import StrEnum
+from typing import BinaryIO, Callable, Iterator
+
+
+class OutputKind(StrEnum):
+    """Types of output generated by the pipeline."""
+
+    MIDI = "midi"
+    PDF = "pdf"
+    HELPINGHAND = "helpinghand"
+    NOTATION = "notation"  # Corrected notation
+
+
+class OutputSink(ABC):
+    """Base class for output destinations. Subclasses should implement the `open` method."""
+
+    @abstractmethod
+    @contextmanager
+    def open(self, kind: OutputKind, filepath: str) -> Iterator[BinaryIO]:
+        """Returns a binary stream to which the output should be written.
+        Args:
+            kind (OutputKind): type of output.
+            filepath (str): location of the output file as determined by the run settings.
+        """
+
+    def write(self, kind: OutputKind, filepath: str, data: bytes) -> None:
+        """Writes the entire content of an output file."""
+        with self.open(kind, filepath) as outfile:
+            outfile.write(data)
+
+
+class FileSink(OutputSink):
+    """Writes the output to the file system. This is the default sink.
+    The output is written to a temporary file which replaces the output file when it has been written successfully.
+    This avoids leaving a truncated file if the output can't be generated."""
+
+    @contextmanager
+    def open(self, kind: OutputKind, filepath: str) -> Iterator[BinaryIO]:
+        tempfilepath = os.path.join(os.path.dirname(filepath), "_" + os.path.basename(filepath))
+        try:
+            with open(tempfilepath, "wb") as outfile:
+                yield outfile
+        except BaseException:
+            if os.path.exists(tempfilepath):
+                os.remove(tempfilepath)
+            raise
+        os.replace(tempfilepath, filepath)
+
+
+class BytesIOSink(OutputSink):
+    """Keeps the output in memory. The content of each output type is available in the `outputs` dict once it has
+    been written completely."""
+
+    outputs: dict[OutputKind, bytes]
+    filepaths: dict[OutputKind, str]
+
+    def __init__(self):
+        self.outputs = {}
+        self.filepaths = {}
+
+    @contextmanager
+    def open(self, kind: OutputKind, filepath: str) -> Iterator[BinaryIO]:
+        buffer = io.BytesIO()
+        yield buffer
+        self.outputs[kind] = buffer.getvalue()
+        self.filepaths[kind] = filepath
+
+
+class CallbackSink(OutputSink):
+    """Passes the content of each output file to a callback function once it has been written completely."""
+
+    callback: Callable[[OutputKind, str, bytes], None]
+
+    def __init__(self, callback: Callable[[OutputKind, str, bytes], None]):
+        """Args:
+        callback (Callable[[OutputKind, str, bytes], None]): function that is called with the output type, the
+                                                            file location and the content of each output file.
+        """
+        self.callback = callback
+
+    @contextmanager
+    def open(self, kind: OutputKind, filepath: str) -> Iterator[BinaryIO]:
+        buffer = io.BytesIO()
+        yield buffer
+        self.callback(kind, filepath, buffer.getvalue())
@@ -69,6 +69,7 @@ class Agent:
         PATTERNSCORE = "pattern_score"
         COMPLETESCORE = "complete_score"
         EXECUTION = "execution"
+        FLOWANALYSIS = "flow_analysis"
         PART = "part"
         PDFFILE = "pdf_file"
 
@@ -1,12 +1,19 @@
+from array import array
 from collections import defaultdict
 from dataclasses import dataclass, field
-from enum import StrEnum
 from typing import ClassVar
 
 from pydantic import BaseModel, Field
 
 from src.common.classes import Beat, Score
-from src.common.constants import DEFAULT, PassSequence, Position
+from src.common.constants import (
+    BPM,
+    DEFAULT,
+    IterationSequence,
+    PassSequence,
+    Position,
+    VelocityInt,
+)
 from src.common.notes import Note
 from src.notation2midi.metadata_classes import DynamicsMeta, TempoMeta
 
@@ -61,22 +68,11 @@ class Loop(Flow):
         return self.to_beat if beat is self.from_beat and self.counter < self.cycle else None
 
 
-@dataclass
-class GradualChangeStatus:
-    """Keeps track of the current beat's start and end values of a gradual change (see below)"""
-
-    beat_seq: int = 0  # current beat sequence (1..tot_beats)
-    tot_beats: int = 0  # total number of beats involved in the gradual change.
-    initial_value: int = 0  # value at the start of the gradual change.
-    start_value: int = 0  # value at the start of the beat.
-    end_value: int = 0  # (incremented) value at the end of the beat
-    completed: bool = False  # Indicates whether the last change step has been executed.
-
-
 class GradualChange(BaseModel):
     """Generic class that describes the gradual change of a musical expression value (tempo, dynamics) over multiple beats.
     Each instance of this class corresponds with a TEMPO or DYNAMICS metadata item.
-    With a value of zero for tot_beats this class acts as an immediate (non-gradual) tempo or dynamics change."""
+    With a value of zero for tot_beats this class acts as an immediate (non-gradual) tempo or dynamics change.
+    Instances are immutable during the execution: the progress of a change is kept in a GradualChangeStatus."""
 
     positions: list[Position] = Field(default_factory=list)  # positions for which the instruction applies.
     passes: list[int] = Field(default_factory=list)
@@ -86,7 +82,6 @@ class GradualChange(BaseModel):
     from_value: int | None = None  # The initial value. If None, the 'current' value in the execution flow
     #                                is used as initial value.
     to_value: int = 0  # The final value of the gradual change.
-    status: GradualChangeStatus | None = None  # Current status of the change
 
     def matches(self, position: Position, pass_nr: int, iteration_nr: int):
         """Returns True if the combination of arguments matches this GradualChange's fields.
@@ -97,93 +92,158 @@ class GradualChange(BaseModel):
             and (iteration_nr in self.iterations or (iteration_nr is None and not self.iterations))
         )
 
-    def clear_status(self):
-        self.status = None
 
-    def initialize_status(self, initial_value):
-        """Initializes the gradual change. Initial value is the current value in the score's flow. If the GradualChange
+@dataclass
+class GradualChangeStatus:
+    """Keeps track of the current beat's start and end values of a gradual change.
+    A new status is created each time the gradual change becomes active in the execution flow."""
+
+    change: GradualChange
+    beat_seq: int = 0  # current beat sequence (1..tot_beats)
+    initial_value: int = 0  # value at the start of the gradual change.
+    start_value: int | None = None  # value at the start of the beat.
+    end_value: int | None = None  # (incremented) value at the end of the beat
+    completed: bool = False  # Indicates whether the last change step has been executed.
+
+    @classmethod
+    def start(cls, change: GradualChange, initial_value: int) -> "GradualChangeStatus":
+        """Activates the gradual change. Initial value is the current value in the score's flow. If the GradualChange
         has a from_value!=None, it will overrule the current value. If tot_beats is 0, both start_value and end_value
         will be set to the GradualChange's to_value. In the latter case, from_value should be None or equal to to_value.
         """
-        self.status = GradualChangeStatus(
-            tot_beats=self.tot_beats,
+        return cls(
+            change=change,
             initial_value=(
-                self.from_value if self.from_value else self.to_value if self.tot_beats == 0 else initial_value
+                change.from_value if change.from_value else change.to_value if change.tot_beats == 0 else initial_value
             ),
-            start_value=None,
-            end_value=None,
         )
 
     def next_step(self) -> None:
         """Sets the status to the next step in the gradual change."""
-        if self.status.completed:
+        if self.completed:
             return
-        self.status.beat_seq += 1
-        if self.status.beat_seq > self.tot_beats:
+        to_value = self.change.to_value
+        tot_beats = self.change.tot_beats
+        self.beat_seq += 1
+        if self.beat_seq > tot_beats:
             # Passed the end of the sequence: set both start and end values to the GradualChange's final value.
             # The value is now fixed for future beats.
-            self.status.start_value = self.status.end_value = self.to_value
-            self.status.completed = True
-        elif self.status.beat_seq == self.tot_beats:
+            self.start_value = self.end_value = to_value
+            self.completed = True
+        elif self.beat_seq == tot_beats:
             # Last beat of the sequence: set the start value to the previous beat's end value, set end value to
             # the GradualChange's final value.
-            self.status.start_value = self.status.initial_value if self.status.beat_seq == 1 else self.status.end_value
-            self.status.end_value = self.to_value
+            self.start_value = self.initial_value if self.beat_seq == 1 else self.end_value
+            self.end_value = to_value
         else:
             # Set the start value to the previous beat's end value and add one step increment for the end value.
-            self.status.start_value = self.status.initial_value if self.status.beat_seq == 1 else self.status.end_value
-            self.status.end_value = self.status.start_value + int(
-                (self.to_value - self.status.start_value) / (self.tot_beats - self.status.beat_seq + 1)
-            )
+            self.start_value = self.initial_value if self.beat_seq == 1 else self.end_value
+            self.end_value = self.start_value + int((to_value - self.start_value) / (tot_beats - self.beat_seq + 1))
 
 
-BeatID = str
 GonganID = int
 
 
+@dataclass
+class ExecutionStep:
+    """A single beat in the unrolled execution flow of the score, together with the values of the flow counters."""
+
+    beat: Beat
+    pass_nr: PassSequence  # value of the beat's GoTo counter.
+    iteration: IterationSequence  # value of the gongan's Loop counter, DEFAULT if the gongan has no loop.
+
+
+@dataclass
+class ExpressionTimeline:
+    """Values of a musical expression (tempo, dynamics) at the start and at the end of each step of an ExecutionPlan.
+    The values are stored in compact integer arrays that are indexed by the step's sequence number in the plan."""
+
+    start: array = field(default_factory=lambda: array("i"))
+    end: array = field(default_factory=lambda: array("i"))
+
+    def append(self, start_value: int, end_value: int) -> None:
+        """Adds the values for the next step."""
+        self.start.append(start_value)
+        self.end.append(end_value)
+
+    def values(self, step_seq: int) -> tuple[int, int]:
+        """Returns the start and end value for the given step."""
+        return self.start[step_seq], self.end[step_seq]
+
+
+@dataclass
+class ExecutionPlan:
+    """The execution flow of a score, unrolled once so that it can be shared by all MIDI tracks.
+    `tempo` and `dynamics` contain the musical expression values for each step. Positions that are explicitly
+    mentioned in a DYNAMICS instruction have their own dynamics timeline in `dynamics_overrides`. Positions that
+    are addressed by exactly the same DYNAMICS instructions share the same timeline.
+    If the flow does not terminate, `cycle_beat` contains the beat from which the flow repeats itself and `steps`
+    contains the flow up to that point."""
+
+    steps: list[ExecutionStep] = field(default_factory=list)
+    complete: bool = True  # False if the flow was not unrolled until its end.
+    cycle_beat: Beat | None = None
+    tempo: ExpressionTimeline = field(default_factory=ExpressionTimeline)
+    dynamics: ExpressionTimeline = field(default_factory=ExpressionTimeline)
+    dynamics_overrides: dict[Position, ExpressionTimeline] = field(default_factory=dict)
+
+    def dynamics_for(self, position: Position) -> ExpressionTimeline:
+        """Returns the dynamics timeline of the position."""
+        return self.dynamics_overrides.get(position, self.dynamics)
+
+
+@dataclass
+class FlowAnalysis:
+    """Summary of the execution flow of a score, available before the MIDI file is generated."""
+
+    executed_beat_count: int = 0  # Number of beats that will be performed, including repeats.
+    duration_seconds: float = 0  # Estimated duration of the MIDI file, including silences at start and end.
+    terminates: bool = True  # False if the flow contains a never ending cycle.
+    cycle_beat_id: str | None = None  # full_id of the beat from which a never ending flow repeats itself.
+
+
 @dataclass
 class ExecutionManager:
     """Takes care of the execution or 'performance' of a score. This consists of applying musical expression
     (dynamics, tempo) and flow (GOTO, LOOP and SEQUENCE).
-    dynamics_dict and tempo_dict link GradualChange instances with the first beat
-    of the change sequence.
-    `active_tempo` and `active_dynamics` keep track of the currently active tempo and dynamics GradualChange instances.
-    After the end of an active gradual change has been reached while processing the score's flow, it will remain active
-    with its 'to_value' as the current value until a new GradualChange instruction is encountered.
-
-
-    Returns:
-        _type_: _description_
+    goto_list, dynamics_list and tempo_list are indexed by the sequence number of the beats (see Score.index_beats).
+    dynamics_list and tempo_list link GradualChange instances with the first beat of the change sequence.
+    The execution flow, tempo and dynamics are evaluated once by `create_execution_plan`. After the end of
+    a gradual change has been reached while processing the score's flow, its 'to_value' remains the current value
+    until a new GradualChange instruction is encountered.
     """
 
-    class MusicalExpressionType(StrEnum):
-        TEMPO = "TEMPO"
-        DYNAMICS = "DYNAMICS"
-
     score: Score
     curr_beat: Beat = None
-    curr_position: Position = None
-    goto_dict: dict[BeatID, GoTo] = field(default_factory=dict)
     loop_dict: dict[GonganID, Loop] = field(default_factory=dict)
-    dynamics_dict: dict[BeatID, list[GradualChange]] = field(default_factory=lambda: defaultdict(list))
-    tempo_dict: dict[BeatID, list[GradualChange]] = field(default_factory=lambda: defaultdict(list))
-    active_dynamics: GradualChange | None = None
-    active_tempo: GradualChange | None = None
     pattern_dict: dict[str, list[Note]] = field(default_factory=dict)
+    goto_list: list[GoTo | None] = field(init=False)
+    dynamics_list: list[list[GradualChange]] = field(init=False)
+    tempo_list: list[list[GradualChange]] = field(init=False)
+    plan: ExecutionPlan | None = field(default=None, init=False)  # Most recently created execution plan.
+
+    def __post_init__(self):
+        if self.score and not self.score.is_indexed():
+            # A beat without a valid sequence number would read and overwrite the flow information of another beat.
+            raise ValueError("The beats of the score are not numbered. Call Score.index_beats after the last change.")
+        beat_count = self.score.beat_count if self.score else 0
+        self.goto_list = [None] * beat_count
+        self.dynamics_list = [[] for _ in range(beat_count)]
+        self.tempo_list = [[] for _ in range(beat_count)]
 
     def create_default_goto(self, beat: Beat) -> GoTo:
-        self.goto_dict[beat.full_id] = GoTo(from_beat=beat, to_beat_dict={DEFAULT: beat.next})
-        return self.goto_dict[beat.full_id]
+        self.goto_list[beat.seq] = GoTo(from_beat=beat, to_beat_dict={DEFAULT: beat.next})
+        return self.goto_list[beat.seq]
 
     def goto(self, beat: Beat, create_if_none: bool = True) -> GoTo:
         """Returns the GoTo object for the beat or a newly created default GoTo value"""
-        goto = self.goto_dict.get(beat.full_id, None)
+        goto = self.goto_list[beat.seq]
         if not goto and create_if_none:
             goto = self.create_default_goto(beat)
         return goto
 
     def set_goto(self, beat: Beat, goto: GoTo) -> None:
-        self.goto_dict[beat.full_id] = goto
+        self.goto_list[beat.seq] = goto
 
     def extend_goto(self, beat: Beat, goto: GoTo, skip_default=True) -> None:
         """extend the beat's goto with the goto data.
@@ -213,7 +273,7 @@ class ExecutionManager:
             from_value=meta.from_value,
             to_value=meta.to_value,
         )
-        self.tempo_dict[beat.full_id].append(tempo)
+        self.tempo_list[beat.seq].append(tempo)
 
     def assign_dynamics(self, beat: Beat, meta: DynamicsMeta) -> None:
         """Assigns a Dynamics item for the given beat, for each position in positions."""
@@ -225,47 +285,60 @@ class ExecutionManager:
             from_value=meta.from_value,
             to_value=meta.to_value,
         )
-        self.dynamics_dict[beat.full_id].append(dynamics)
+        self.dynamics_list[beat.seq].append(dynamics)
 
-    def initialize_gradual_change(self, initial_value: int) -> GradualChange:
+    def initialize_gradual_change(self, initial_value: int) -> GradualChangeStatus:
         """Creates an initial active musical expression for the score's execution, with the given initial value."""
-        gradual_change = GradualChange(tot_beats=0, from_value=initial_value, to_value=initial_value)
-        gradual_change.status = GradualChangeStatus(end_value=initial_value)
-        return gradual_change
-
-    def update_gradual_change_status(self, change_type: MusicalExpressionType) -> None:
-        """Updates the status values for the given musical expression type"""
-        # Check if a new GradualChange is effective for the current beat, pass and loop.
-        matching_value = None
-        gradual_change_list = self.tempo_dict if change_type is self.MusicalExpressionType.TEMPO else self.dynamics_dict
+        return GradualChangeStatus(
+            change=GradualChange(tot_beats=0, from_value=initial_value, to_value=initial_value),
+            end_value=initial_value,
+        )
+
+    @staticmethod
+    def matching_gradual_change(
+        gradual_changes: list[GradualChange],
+        position: Position | None,
+        pass_nr: PassSequence,
+        iteration_nr: IterationSequence,
+    ) -> GradualChange | None:
+        """Returns the GradualChange that applies to the given position, pass and iteration. A GradualChange that
+        explicitly mentions a position, pass or iteration takes precedence over a more generic one."""
         for pos_, pass_, iter_ in (
-            (po, pa, it)
-            for po in (self.curr_position, None)
-            for pa in (self.get_curr_pass(self.curr_beat), None)
-            for it in (self.get_curr_iteration(self.curr_beat), None)
+            (po, pa, it) for po in (position, None) for pa in (pass_nr, None) for it in (iteration_nr, None)
         ):
-            matching_value = next(
-                (d for d in gradual_change_list[self.curr_beat.full_id] if d.matches(pos_, pass_, iter_)),
-                None,
-            )
-            if matching_value:
-                break
-
-        # Determine the current active GradualChange
-        active_change = self.active_tempo if change_type is self.MusicalExpressionType.TEMPO else self.active_dynamics
-        if matching_value and matching_value != active_change:
-            # New tempo or dynamics applies.
-            # Copy the current tempo or dynamics value to initialize the new GradualChange.
-            current_value = active_change.status.end_value
-            active_change.clear_status()
-            # Set the new GradualChange as the active one.
-            active_change = matching_value
-            active_change.initialize_status(initial_value=current_value)
-        active_change.next_step()
-        if change_type is self.MusicalExpressionType.TEMPO:
-            self.active_tempo = active_change
-        else:
-            self.active_dynamics = active_change
+            if matching_value := next((d for d in gradual_changes if d.matches(pos_, pass_, iter_)), None):
+                return matching_value
+        return None
+
+    def expression_timeline(
+        self,
+        steps: list[ExecutionStep],
+        gradual_change_list: list[list[GradualChange]],
+        initial_value: int,
+        position: Position | None = None,
+    ) -> ExpressionTimeline:
+        """Evaluates the gradual changes of one musical expression type along the unrolled execution flow.
+        Args:
+            steps (list[ExecutionStep]): the unrolled execution flow.
+            gradual_change_list (list[list[GradualChange]]): tempo_list or dynamics_list.
+            initial_value (int): value at the start of the execution.
+            position (Position | None, optional): position for which to evaluate the changes. None is equivalent
+                                                  to any position that is not mentioned in a GradualChange.
+        Returns:
+            ExpressionTimeline: start and end value for each step.
+        """
+        timeline = ExpressionTimeline()
+        active = self.initialize_gradual_change(initial_value)
+        for step in steps:
+            # Check if a new GradualChange is effective for the current beat, pass and loop.
+            if gradual_changes := gradual_change_list[step.beat.seq]:
+                matching_value = self.matching_gradual_change(gradual_changes, position, step.pass_nr, step.iteration)
+                if matching_value and matching_value is not active.change:
+                    # New tempo or dynamics applies. The current value initializes the new GradualChange.
+                    active = GradualChangeStatus.start(matching_value, initial_value=active.end_value)
+            active.next_step()
+            timeline.append(active.start_value, active.end_value)
+        return timeline
 
     def get_curr_pass(self, beat: Beat) -> int:
         return self.goto(beat).counter
@@ -275,16 +348,21 @@ class ExecutionManager:
             return self.loop(beat).counter
         return DEFAULT
 
-    def reset_all(self, position: Position):
+    def reset_all(self):
         """Resets all GoTo and Loop counters"""
-        for goto in self.goto_dict.values():
-            goto.reset_counter()
+        for goto in self.goto_list:
+            if goto:
+                goto.reset_counter()
         for loop in self.loop_dict.values():
             loop.reset_counter()
-        self.curr_position = position
-        self.active_tempo = self.initialize_gradual_change(self.score.settings.midi.default_tempo)
-        self.active_dynamics = self.initialize_gradual_change(
-            self.score.settings.midi.dynamics[self.score.settings.midi.default_dynamics]
+
+    def flow_state(self) -> tuple[int, tuple[int, ...], tuple[int, ...]]:
+        """Returns the current beat together with the values of all flow counters. The flow is deterministic:
+        if the same state occurs twice, the flow will never terminate."""
+        return (
+            self.curr_beat.seq,
+            tuple(goto.counter if goto else 0 for goto in self.goto_list),
+            tuple(loop.counter for loop in self.loop_dict.values()),
         )
 
     def next_beat_in_flow(self) -> Beat:
@@ -334,15 +412,66 @@ class ExecutionManager:
         else:
             self.curr_beat = None
 
-        if self.curr_beat:
-            self.update_gradual_change_status(self.MusicalExpressionType.TEMPO)
-            self.update_gradual_change_status(self.MusicalExpressionType.DYNAMICS)
         return self.curr_beat
 
-    def get_tempo_values(self) -> tuple[int, int]:
-        """Returns the tempo for the given beat."""
-        return (self.active_tempo.status.start_value, self.active_tempo.status.end_value)
-
-    def get_dynamics_values(self) -> tuple[int, int]:
-        """Returns the dynamics for the given beat and position."""
-        return (self.active_dynamics.status.start_value, self.active_dynamics.status.end_value)
+    def _dynamics_signatures(self) -> dict[Position, tuple[int, ...]]:
+        """Identifies, for each position that is mentioned in a DYNAMICS instruction, the set of instructions
+        that mention it. Positions with the same signature share the same dynamics throughout the execution.
+        Returns:
+            dict[Position, tuple[int, ...]]: signature of each explicitly mentioned position.
+        """
+        signatures: dict[Position, list[int]] = defaultdict(list)
+        for gradual_changes in self.dynamics_list:
+            for gradual_change in gradual_changes:
+                for position in gradual_change.positions:
+                    signatures[position].append(id(gradual_change))
+        return {position: tuple(signature) for position, signature in signatures.items()}
+
+    def create_execution_plan(self, max_steps: int | None = None) -> ExecutionPlan:
+        """Unrolls the execution flow of the score into an ExecutionPlan. The flow (GOTO, LOOP and SEQUENCE) and
+        the tempo are evaluated only once. Dynamics are evaluated once for the positions that are not mentioned in
+        any DYNAMICS instruction and once for each group of positions that share the same DYNAMICS instructions.
+        The unrolling stops if the flow does not terminate or if it exceeds max_steps.
+        Args:
+            max_steps (int | None, optional): maximum number of steps. Defaults to None (no maximum).
+        Returns:
+            ExecutionPlan: the unrolled flow.
+        """
+        plan = ExecutionPlan()
+        # Between two backward jumps, the flow moves strictly forward. So a non-terminating flow must pass through
+        # the same state at a backward jump twice. It therefore suffices to check the state at backward jumps.
+        jump_states: set[tuple] = set()
+        prev_seq = -1
+        self.curr_beat = None
+        self.reset_all()
+        while beat := self.next_beat_in_flow():
+            if beat.seq <= prev_seq:
+                state = self.flow_state()
+                if state in jump_states:
+                    plan.complete = False
+                    plan.cycle_beat = beat
+                    break
+                jump_states.add(state)
+            if max_steps is not None and len(plan.steps) >= max_steps:
+                plan.complete = False
+                break
+            prev_seq = beat.seq
+            plan.steps.append(
+                ExecutionStep(beat=beat, pass_nr=self.get_curr_pass(beat), iteration=self.get_curr_iteration(beat))
+            )
+        self.curr_beat = None
+
+        midi = self.score.settings.midi
+        plan.tempo = self.expression_timeline(plan.steps, self.tempo_list, midi.default_tempo)
+        default_velocity = midi.dynamics[midi.default_dynamics]
+        plan.dynamics = self.expression_timeline(plan.steps, self.dynamics_list, default_velocity)
+        timelines: dict[tuple[int, ...], ExpressionTimeline] = {}
+        for position, signature in self._dynamics_signatures().items():
+            if signature not in timelines:
+                timelines[signature] = self.expression_timeline(
+                    plan.steps, self.dynamics_list, default_velocity, position
+                )
+            plan.dynamics_overrides[position] = timelines[signature]
+
+        self.plan = plan
+        return plan
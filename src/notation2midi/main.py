@@ -3,10 +3,14 @@
 from tkinter.messagebox import askyesno
 
 from src.common.logger import Logging
+from src.common.output_sinks import BytesIOSink, OutputKind
+from src.notation2midi.pipeline.analyze_flow import FlowAnalysisAgent
 from src.notation2midi.pipeline.apply_rules import RulesAgent
 from src.notation2midi.pipeline.create_execution import ExecutionCreatorAgent
 from src.notation2midi.pipeline.create_note_patterns import NotePatternGeneratorAgent
 from src.notation2midi.pipeline.export_to_midiplayer import (
+    MidiPlayerPublishAgent,
+    MidiPlayerUpdateAgentModel,
     MidiPlayerUpdatePartAgent,
     MidiPlayerUpdatePdfAgent,
 )
@@ -33,11 +37,13 @@ PIPE = [
     ScorePostprocessAgent,  # Fills empty and shorthand beats + applies metadata. -> CompleteScore
     ScoreValidationAgent,  # Validates the score and performs corrections if required.
     ExecutionCreatorAgent,  # Creates a score Execution: the flow (gongan sequence), tempi and dynamics.
+    FlowAnalysisAgent,  # Detects never ending flows, counts the executed beats and estimates the duration.
     MidiGeneratorAgent,  # Generates MIDI output.
     PDFGeneratorAgent,  # Generates a human-readable PDF score.
     ScoreToNotationAgent,  # Generates a corrected and standardized input file.
     MidiPlayerUpdatePartAgent,  # Updates the JSON settings file of the Front End application.
     MidiPlayerUpdatePdfAgent,
+    MidiPlayerPublishAgent,  # Publishes content-hashed, precompressed MIDI and PDF files for the Front End.
 ]
 
 
@@ -52,6 +58,26 @@ def run_pipeline(run_settings: RunSettings):
     pipeline.execute()
 
 
+def run_pipeline_in_memory(run_settings: RunSettings, notation: str) -> dict[OutputKind, bytes]:
+    """Creates a single notation from the given notation content without reading or writing notation, MIDI or PDF
+    files. This enables to embed the conversion in another application or service.
+    Args:
+        run_settings (RunSettings): Settings and configuration. `notation_id` and `part_id` determine which
+                                    configuration is applied to the notation.
+        notation (str): content of a notation file.
+    Returns:
+        dict[OutputKind, bytes]: the content of each generated output.
+    """
+    sink = BytesIOSink()
+    notation_, output_sink = run_settings.notation, run_settings.output_sink
+    run_settings.notation, run_settings.output_sink = notation, sink
+    try:
+        run_pipeline(run_settings)
+    finally:
+        run_settings.notation, run_settings.output_sink = notation_, output_sink
+    return sink.outputs
+
+
 def run_multiple_pipelines(run_settings: RunSettings):
     """Creates multiple notations
 
@@ -69,11 +95,12 @@ def run_multiple_pipelines(run_settings: RunSettings):
         if runtype in notation_info.include_in_run_types
         and (not is_production_run or notation_info.include_in_production_run)
     ]
-    # Run the pipeline for each part of each song.
-    for notation_key, notation_info in notation_list:
-        for part_key, _ in notation_info.parts.items():
-            run_settings = Settings.get(notation_id=notation_key, part_id=part_key)
-            run_pipeline(run_settings)
+    # Run the pipeline for each part of each song. The midiplayer content is updated once, at the end of the run.
+    with MidiPlayerUpdateAgentModel.batch():
+        for notation_key, notation_info in notation_list:
+            for part_key, _ in notation_info.parts.items():
+                run_settings = Settings.get(notation_id=notation_key, part_id=part_key)
+                run_pipeline(run_settings)
 
 
 def main():
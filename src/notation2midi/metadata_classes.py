@@ -83,11 +83,8 @@ class MetaDataBaseModel(BaseModel, RunSettingsListener):
     def model_dump_notation(self):
         jsonval = self.model_dump(exclude_defaults=True)
         del jsonval["line"]
-        if self.DEFAULTPARAM:
-            defval = jsonval[self.DEFAULTPARAM]
-            del jsonval[self.DEFAULTPARAM]
-        else:
-            defval = ""
+        # The default parameter is missing if it has its default value.
+        defval = jsonval.pop(self.DEFAULTPARAM, "") if self.DEFAULTPARAM else ""
         return f"{{{self.metatype} {defval} {' '.join([f'{key}={val}' for key, val in jsonval.items()])}}}".strip()
 
 
@@ -0,0 +1,189 @@
+"""Compact storage and binary encoding of MIDI events.
+MidiTrackX writes its events directly in encoded form into a MidiEventBuffer. This avoids the creation and
+validation of a mido Message object for each event. `write_midifile` serializes the buffers to a standard
+Type 1 Standard MIDI File. `MidiEventBuffer.to_mido` provides a mido view of the events, which can be saved
+with mido with a byte-identical result.
+"""
+
+import struct
+from array import array
+from bisect import bisect_right
+from typing import BinaryIO
+
+from mido import Message, MetaMessage, MidiTrack
+
+# Status bytes of channel events (without channel number)
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+CONTROL_CHANGE = 0xB0
+PROGRAM_CHANGE = 0xC0
+# Meta event status byte and meta event types
+META = 0xFF
+TEXT = 0x01
+TRACK_NAME = 0x03
+MARKER = 0x06
+MIDI_PORT = 0x21
+END_OF_TRACK = 0x2F
+SET_TEMPO = 0x51
+
+TEXT_ENCODING = "latin1"  # Same as the default charset of mido.
+DEFAULT_TEMPO = 500000  # Tempo in microseconds per quarter note (120 BPM) until the first set_tempo event.
+
+
+def encode_variable_int(value: int) -> bytes:
+    """Encodes a non-negative integer as a MIDI variable-length quantity."""
+    if value < 0x80:
+        return bytes((value,))
+    encoded = [value & 0x7F]
+    value >>= 7
+    while value:
+        encoded.append((value & 0x7F) | 0x80)
+        value >>= 7
+    return bytes(reversed(encoded))
+
+
+def channel_event(status: int, channel: int, *data: int) -> bytes:
+    """Encodes a channel event (note_on, note_off, control_change, program_change).
+    Args:
+        status (int): status byte without channel number, e.g. NOTE_ON.
+        channel (int): MIDI channel (0-15).
+        data (int): data bytes (0-127).
+    Raises:
+        ValueError: if the channel or a data byte is out of range.
+    """
+    if not 0 <= channel <= 15 or not all(0 <= value <= 127 for value in data):
+        raise ValueError(f"Invalid value in MIDI event: status={status:#x} channel={channel} data={data}")
+    return bytes((status | channel, *data))
+
+
+def meta_event(meta_type: int, data: bytes) -> bytes:
+    """Encodes a meta event."""
+    return bytes((META, meta_type)) + encode_variable_int(len(data)) + data
+
+
+def text_event(meta_type: int, text: str) -> bytes:
+    """Encodes a meta event that contains text (text, track_name, marker)."""
+    return meta_event(meta_type, text.encode(TEXT_ENCODING))
+
+
+def tempo_event(tempo: int) -> bytes:
+    """Encodes a set_tempo meta event. The tempo is expressed in microseconds per quarter note."""
+    return meta_event(SET_TEMPO, tempo.to_bytes(3, "big"))
+
+
+END_OF_TRACK_EVENT = b"\x00" + meta_event(END_OF_TRACK, b"")  # including delta time 0
+
+
+class MidiEventBuffer:
+    """Events of a single MIDI track. The delta times are stored in an integer array and the events
+    in encoded form, without delta time and without running status."""
+
+    deltas: array
+    events: list[bytes]
+
+    def __init__(self):
+        self.deltas = array("L")
+        self.events = []
+
+    def __len__(self) -> int:
+        return len(self.events)
+
+    def append(self, delta: int, event: bytes) -> int:
+        """Appends an event and returns its index."""
+        self.deltas.append(delta)
+        self.events.append(event)
+        return len(self.events) - 1
+
+    def extend(self, deltas: array, events: list[bytes]) -> None:
+        """Appends a series of events."""
+        self.deltas.extend(deltas)
+        self.events.extend(events)
+
+    def replace(self, index: int, event: bytes) -> None:
+        """Replaces the event with the given index, keeping its delta time."""
+        self.events[index] = event
+
+    def encode(self) -> bytes:
+        """Returns the content of the track chunk, using running status and closed by an end_of_track event.
+        The result is identical to the encoding by mido."""
+        data = bytearray()
+        running_status = None
+        for delta, event in zip(self.deltas, self.events):
+            data += encode_variable_int(delta)
+            status = event[0]
+            data += event[1:] if status == running_status else event
+            running_status = status if status < 0xF0 else None
+        data += END_OF_TRACK_EVENT
+        return bytes(data)
+
+    def tempo_changes(self) -> list[tuple[int, int]]:
+        """Returns the absolute tick time and the tempo of each set_tempo event."""
+        changes = []
+        ticktime = 0
+        for delta, event in zip(self.deltas, self.events):
+            ticktime += delta
+            if event[0] == META and event[1] == SET_TEMPO:
+                changes.append((ticktime, int.from_bytes(event[3:6], "big")))
+        return changes
+
+    def to_mido(self) -> MidiTrack:
+        """Returns the events as a mido MidiTrack."""
+        track = MidiTrack()
+        for delta, event in zip(self.deltas, self.events):
+            if event[0] == META:
+                message = MetaMessage.from_bytes(bytearray(event))
+                message.time = delta
+            else:
+                message = Message.from_bytes(event, time=delta)
+            track.append(message)
+        return track
+
+
+class TempoMap:
+    """Converts tick times into seconds, using the tempo changes of a MIDI file.
+    The result corresponds with the time that mido and MIDI players assign to a tick time."""
+
+    ticks_per_beat: int
+    ticktimes: list[int]  # Tick time of each tempo change
+    tempi: list[int]  # Tempo from each tempo change on
+    seconds_at: list[float]  # Time in seconds of each tempo change
+
+    def __init__(self, tempo_changes: list[tuple[int, int]], ticks_per_beat: int):
+        """Args:
+        tempo_changes (list[tuple[int, int]]): absolute tick time and tempo of each set_tempo event, in
+                                               chronological order. See MidiEventBuffer.tempo_changes.
+        ticks_per_beat (int): number of ticks per quarter note (PPQ)
+        """
+        self.ticks_per_beat = ticks_per_beat
+        self.ticktimes = [0]
+        self.tempi = [DEFAULT_TEMPO]
+        self.seconds_at = [0.0]
+        for ticktime, tempo in tempo_changes:
+            self.seconds_at.append(self.seconds(ticktime))
+            self.ticktimes.append(ticktime)
+            self.tempi.append(tempo)
+
+    def seconds(self, ticktime: int) -> float:
+        """Returns the time in seconds of the given tick time."""
+        index = bisect_right(self.ticktimes, ticktime) - 1
+        return (
+            self.seconds_at[index] + (ticktime - self.ticktimes[index]) * self.tempi[index] * 1e-6 / self.ticks_per_beat
+        )
+
+
+def _write_chunk(file: BinaryIO, name: bytes, data: bytes) -> None:
+    file.write(name)
+    file.write(struct.pack(">L", len(data)))
+    file.write(data)
+
+
+def write_midifile(file: BinaryIO, buffers: list[MidiEventBuffer], ticks_per_beat: int) -> None:
+    """Writes a Type 1 Standard MIDI File with one track for each event buffer.
+    Args:
+        file (BinaryIO): binary file object
+        buffers (list[MidiEventBuffer]): content of the tracks
+        ticks_per_beat (int): number of ticks per quarter note (PPQ)
+    """
+    _write_chunk(file, b"MThd", struct.pack(">hhh", 1, len(buffers), ticks_per_beat))
+    for buffer in buffers:
+        _write_chunk(file, b"MTrk", buffer.encode())
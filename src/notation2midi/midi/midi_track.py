@@ -2,21 +2,39 @@
 It is used by the MidiGenerator (score_to_midi module).
 """
 
-import json
 import math
+from array import array
+from bisect import insort
 from collections import defaultdict
+from dataclasses import dataclass, field, replace
 from enum import Enum
-from typing import ClassVar, override
+from fractions import Fraction
+from typing import ClassVar, Collection
 
-from mido import Message, MetaMessage, MidiTrack, bpm2tempo
-from mido.messages import BaseMessage
+from mido import MidiTrack, bpm2tempo
 from pydantic import BaseModel
 
 from src.common.classes import Preset
 from src.common.constants import InstrumentType, Pitch, Position, Stroke, SustainType
 from src.common.logger import Logging
 from src.common.notes import Note
-from src.settings.classes import RunSettings
+from src.notation2midi.execution.execution import ExpressionTimeline
+from src.notation2midi.midi.midi_events import (
+    CONTROL_CHANGE,
+    MARKER,
+    MIDI_PORT,
+    NOTE_OFF,
+    NOTE_ON,
+    PROGRAM_CHANGE,
+    TEXT,
+    TRACK_NAME,
+    MidiEventBuffer,
+    channel_event,
+    meta_event,
+    tempo_event,
+    text_event,
+)
+from src.settings.classes import HelpingHandOutput, RunSettings, TempoCurve
 
 logger = Logging.get_logger(__name__)
 
@@ -37,7 +55,7 @@ class BeatInfo(BaseModel):
     duration: float
     start_ticktime: int = 0
     end_ticktime: int = 0
-    update_times: list[int] = []
+    update_count: int = 1  # Number of update moments, which are UPDATEFREQ ticks apart, starting at start_ticktime.
 
     def next_update_time(self, curr_time: int, include_curr: bool = False) -> int | None:
         """Returns the next time when gradual tempi and dynamics should be updated.
@@ -54,12 +72,29 @@ class BeatInfo(BaseModel):
             updatetime += self.UPDATEFREQ
         return updatetime if updatetime <= self.start_ticktime else None
 
+    def update_times(self, from_ticktime: int, to_ticktime: int) -> range:
+        """Returns the update moments within the given (closed) interval.
+        Args:
+            from_ticktime: start of the interval
+            to_ticktime: end of the interval
+        Returns:
+            range: update times in ticktime
+        """
+        first = max(0, -((self.start_ticktime - from_ticktime) // self.UPDATEFREQ))  # ceiling division
+        last = min(self.update_count - 1, (to_ticktime - self.start_ticktime) // self.UPDATEFREQ)
+        return range(
+            self.start_ticktime + first * self.UPDATEFREQ,
+            self.start_ticktime + (last + 1) * self.UPDATEFREQ,
+            self.UPDATEFREQ,
+        )
+
     def get_change_fraction(self, ticktime: int):
-        past_update_times = [t for t in self.update_times if t <= ticktime]
-        if past_update_times:
-            last_update_time = past_update_times[-1]
-            return self.update_times.index(last_update_time) / len(self.update_times)
-        return 0
+        """Returns the fraction of the gradual change that applies from the last update moment
+        up to the given time."""
+        if ticktime < self.start_ticktime:
+            return 0
+        last_update = min((ticktime - self.start_ticktime) // self.UPDATEFREQ, self.update_count - 1)
+        return last_update / self.update_count
 
     def tempo(self, ticktime: int):
         frac = self.get_change_fraction(ticktime)
@@ -70,13 +105,82 @@ class BeatInfo(BaseModel):
         return self.start_velocity + int(frac * (self.end_velocity - self.start_velocity))
 
 
-class MidiTrackX(MidiTrack):
-    """Extends the mido.MidiTrack class. The track processes and stores the messages
-    for one single channel (which in most cases corresponds with one instrument position).
-    Generates MIDI messages and keeps track of the midi time (tick time).
+@dataclass
+class HelpingHandEvent:
+    """Event that moves the 'helping hand' (animated arrow) of the MIDI player to the next note.
+    The event is created when a note is processed. The information about the next note is added
+    when that note is processed."""
+
+    id: int
+    millitime: Fraction  # Exact time of the event in milliseconds
+    index: int | None = None  # Index of the marker message in the track's event buffer, if any.
+    pitch: Pitch = None  # Pitch and octave of the next note
+    octave: int = None
+    time_until: int = None  # Time in milliseconds until the next note
+    is_last: bool = False
+
+    def marker_text(self, position: Position, channel: int) -> str:
+        """Text of the marker message that contains the event."""
+        return (
+            "{"
+            f'"id": {self.id}, "type": "helpinghand", "position": "{position}", "channel": {channel}, '
+            f'"pitch": "{self.pitch}", "octave": {self.octave}, "timeuntil": {self.time_until}, '
+            f'"islast": {str(self.is_last).lower()}'  # format for javascript
+            "}"
+        )
+
+    def timeline_entry(self) -> list:
+        """Compact representation of the event in the helping hand timeline (see HELPINGHAND_TIMELINE_FIELDS)."""
+        return [self.id, int(self.millitime), str(self.pitch), self.octave, self.time_until]
+
+
+HELPINGHAND_TIMELINE_FIELDS = ["id", "time", "pitch", "octave", "timeuntil"]
+
+
+@dataclass
+class TrackSegment:
+    """Content that a track generated for a series of beats, in a form that can be spliced into another track
+    with the same state (see MidiTrackX.segment_state). Used by the MIDI segment cache (see segment_cache module).
+    Indices, ids and tick times are relative to the start of the segment."""
+
+    deltas: array
+    events: list[bytes]
+    ticks: int  # Increase of the track's current tick time
+    millis: Fraction  # Increase of the track's current millisecond time
+    helpinghand_events: list[HelpingHandEvent]
+    # Pitch, octave and time_until of the helping hand event that was pending at the start of the segment.
+    helpinghand_update: tuple[Pitch, int, int] | None
+    tempo_message_count: int
+    grid_tempo_change_count: int
+    end_beat: "BeatInfo"
+    end_state: tuple  # Value of MidiTrackX.segment_state at the end of the segment.
+    # Part markers (name, tick time) encountered by the MIDI generator, see MidiGeneratorAgent.
+    part_markers: list[tuple[str, int]] = field(default_factory=list)
+
+
+@dataclass
+class SegmentMark:
+    """Position in a track at the start of a segment."""
+
+    event_count: int
+    helpinghand_count: int
+    helpinghand_pending: bool
+    ticktime: int
+    millitime: Fraction
+    msg_id: int
+    tempo_message_count: int
+    grid_tempo_change_count: int
+
+
+class MidiTrackX:
+    """The track processes and stores the messages for one single channel (which in most cases
+    corresponds with one instrument position). Generates MIDI messages and keeps track of the midi
+    time (tick time). The messages are stored in encoded form in a MidiEventBuffer. Use `to_mido`
+    to obtain a mido MidiTrack.
     """
 
     run_settings: RunSettings
+    name: str
     position: Position
     instrumenttype: InstrumentType
     channel: int
@@ -84,21 +188,38 @@ class MidiTrackX(MidiTrack):
     bank: int
     preset: int
     animate_helpinghand: bool
-    first_helpinghand_msg: MetaMessage = None
+    helpinghand_markers: bool  # Store helping hand events as marker messages
+    events: MidiEventBuffer
+    helpinghand_events: list[HelpingHandEvent]
     # The next attribute keeps track of the end message of the last note.
     # The time of this message will be delayed if an extension note is encountered.
     last_note: Note = None
-    last_helpinghand_msg: MetaMessage = None
     # midi notes that are currently on (i.e. `note_off` message is not yet saved to the track)
-    open_notes: dict[SustainType, set[int]] = defaultdict(set)
+    open_notes: dict[SustainType, list[int]]  # The midi notes of each sustain type are kept in ascending order.
+    # Absolute tick time of the last message and number of messages in the track.
+    # These values are kept up to date by all methods that add or modify messages.
     ticktime_last_message: int = 0
+    message_count: int = 0
     current_ticktime: int = 0
-    # current and prev millitimes are used for the panggul animation
-    current_millitime: int = 0  # cumulative time in milliseconds of the last message in the queue
-    last_hh_millitime: int = 0  # idem for the most recent helpinghand message in the queue
+    # current and prev millitimes are used for the panggul animation. They are exact fractions, which makes
+    # the differences between them independent of the position in the track (see segment_state).
+    current_millitime: Fraction = Fraction(0)  # cumulative time in milliseconds of the last message in the queue
+    last_hh_millitime: Fraction = Fraction(0)  # idem for the most recent helpinghand message in the queue
     current_bpm: int = 0
+    # Tempo of the fixed (non-adaptive) tempo curve. Differs from current_bpm if tempo_curve is BPM or MILLISECONDS.
+    grid_bpm: int = 0
+    # Accumulated timing error in milliseconds w.r.t. the fixed tempo curve, and time of the last update moment.
+    tempo_drift: float = 0
+    last_update_ticktime: int = 0
+    # Number of tempo messages in the tempo track and number of tempo changes of the fixed tempo curve.
+    tempo_message_count: int = 0
+    grid_tempo_change_count: int = 0
     current_velocity: int
     current_beat: BeatInfo
+    # Precomputed tempo and dynamics of each step of the execution plan (see ExecutionPlan).
+    tempo_timeline: ExpressionTimeline = None
+    dynamics_timeline: ExpressionTimeline = None
+    NOTE_OFF_VELOCITY = 64  # Default velocity of mido note_off messages.
     TEMPO_TRACK_NAME = Position.KEMPLI.value  # Track that will hold the tempo MetaMessages.
     # Tempo changes need only to be set in one track because this is a type 1 MIDI file which synchronizes all tracks.
 
@@ -106,13 +227,13 @@ class MidiTrackX(MidiTrack):
         """Sets the preset. Call this method before any note on or note off message. This enables to assign multiple"
         tracks to the same channel."""
         # Note: MSB (control 0) seems to accept values larger than 127.
-        self.append(Message(type="control_change", skip_checks=False, control=0, value=self.bank, channel=self.channel))
-        self.append(Message(type="program_change", skip_checks=False, program=self.preset, channel=self.channel))
-        self.append(MetaMessage(type="midi_port", port=self.port))
+        self.append_event(channel_event(CONTROL_CHANGE, self.channel, 0, self.bank))
+        self.append_event(channel_event(PROGRAM_CHANGE, self.channel, self.preset))
+        self.append_event(meta_event(MIDI_PORT, bytes((self.port,))))
 
     def set_channel(self):
-        """The track_name message is auto-generated by the MidiTrack constructor."""
-        self.append(MetaMessage(type="midi_port", port=self.port))
+        """The track_name message is generated by the MidiTrackX constructor."""
+        self.append_event(meta_event(MIDI_PORT, bytes((self.port,))))
         # Do not set channel volume. It will be set in the online MIDI app.
 
     def switch_note_on(self, midivalue: int, note: Note):
@@ -124,23 +245,21 @@ class MidiTrackX(MidiTrack):
             update_current_time: add the current message's duration to self.current_time
         """
         # self.set_bank_and_preset()
-        self.append(
-            Message(
-                type="note_on",
-                note=midivalue,
-                velocity=int(self.current_velocity * note.relative_velocity),
-                time=self.current_ticktime - self.ticktime_last_message,
-                channel=self.channel,
-                skip_checks=False,
-            )
+        self.append_event(
+            channel_event(NOTE_ON, self.channel, midivalue, int(self.current_velocity * note.relative_velocity)),
+            time=self.current_ticktime - self.ticktime_last_message,
         )
 
     def __init__(self, position: Position, preset: Preset, midi_dict: dict, run_settings: RunSettings):
-        super().__init__()
+        self.events = MidiEventBuffer()
         self.name = position.value
+        self.append_event(text_event(TRACK_NAME, self.name))
         self.run_settings = run_settings
         self.position = position
         self.animate_helpinghand = position in run_settings.midiplayer.helpinghand
+        self.helpinghand_markers = run_settings.midiplayer.helpinghand_output is HelpingHandOutput.MARKERS
+        self.helpinghand_events = []
+        self.open_notes = defaultdict(list)
         self.channel = preset.channel
         self.port = preset.port
         self.bank = preset.bank
@@ -153,54 +272,205 @@ class MidiTrackX(MidiTrack):
         self.current_bpm = 0
         # Dummy beat info needed for initial silence
         self.current_beat = BeatInfo(
-            fullid="0-0", start_bpm=60, end_bpm=60, start_velocity=0, end_velocity=0, duration=0, update_times=[0]
+            fullid="0-0", start_bpm=60, end_bpm=60, start_velocity=0, end_velocity=0, duration=0, update_count=1
         )
-        self.last_helpinghand_msg = self._append_helpinghand_message()
-        self.first_helpinghand_msg = self.last_helpinghand_msg
+        self._append_helpinghand_event()
+        self.midi_dict = midi_dict
+
+    # Attributes that refer to objects that are shared by all tracks.
+    SHARED_ATTRIBUTES: ClassVar[tuple[str]] = ("run_settings", "midi_dict", "tempo_timeline", "dynamics_timeline")
+
+    def __getstate__(self):
+        """Omits the shared objects when pickling the track. This avoids copying them when a track is returned
+        by a worker process (see MidiGeneratorAgent). Call `restore_shared_attributes` after unpickling."""
+        return {key: value for key, value in self.__dict__.items() if key not in self.SHARED_ATTRIBUTES}
+
+    def restore_shared_attributes(self, run_settings: RunSettings, midi_dict: dict) -> None:
+        """Restores the shared objects that are required to post-process an unpickled track."""
+        self.run_settings = run_settings
         self.midi_dict = midi_dict
 
-    @override
-    def append(self, message: BaseMessage, **kwargs):
-        """Appends a message and increments the tick time.
-        Overrides the MidiTrack append method.
+    def append_event(self, event: bytes, time: int = 0) -> int:
+        """Appends an encoded message and increments the tick time.
         Args:
-            message (BaseMessage): message to append.
+            event (bytes): encoded message, see the midi_events module.
+            time (int): delta time in ticks.
+        Returns:
+            int: index of the message in the track's event buffer.
         """
-        super().append(message, **kwargs)
-        self.ticktime_last_message += message.time
+        index = self.events.append(time, event)
+        self.ticktime_last_message += time
+        self.message_count += 1
+        return index
+
+    def to_mido(self) -> MidiTrack:
+        """Returns the content of the track as a mido MidiTrack."""
+        return self.events.to_mido()
+
+    def segment_state(self) -> tuple:
+        """Returns the state of the track that, together with the notation, determines the content of
+        the next segment. Tick and millisecond times are relative to the current time, so that a segment
+        can be reused at any position in the track. The timing error is only tracked with tempo_curve
+        MILLISECONDS (see `_tempo_change_required`)."""
+        drift = None
+        if self.run_settings.midi.tempo_curve is TempoCurve.MILLISECONDS:
+            drift = (self.tempo_drift, self.last_update_ticktime - self.current_ticktime)
+        return (
+            self.current_ticktime - self.ticktime_last_message,
+            self.current_millitime - self.last_hh_millitime,
+            self.current_bpm,
+            self.grid_bpm,
+            drift,
+            self.current_velocity,
+            tuple((sustaintype.value, tuple(notes)) for sustaintype, notes in self.open_notes.items()),
+            self._pending_helpinghand_event() is not None,
+        )
+
+    def _pending_helpinghand_event(self) -> HelpingHandEvent | None:
+        """Returns the last helping hand event if it still waits for the next note."""
+        if self.helpinghand_events and self.helpinghand_events[-1].time_until is None:
+            return self.helpinghand_events[-1]
+        return None
+
+    def mark_segment(self) -> SegmentMark:
+        """Marks the start of a segment. See `collect_segment`."""
+        return SegmentMark(
+            event_count=len(self.events),
+            helpinghand_count=len(self.helpinghand_events),
+            helpinghand_pending=self._pending_helpinghand_event() is not None,
+            ticktime=self.current_ticktime,
+            millitime=self.current_millitime,
+            msg_id=self.msg_id,
+            tempo_message_count=self.tempo_message_count,
+            grid_tempo_change_count=self.grid_tempo_change_count,
+        )
 
-    def switch_notes_off(self, force: set[int] = None) -> None:
+    def collect_segment(self, mark: SegmentMark) -> TrackSegment:
+        """Returns the content that was generated since the given mark."""
+        pending = self.helpinghand_events[mark.helpinghand_count - 1] if mark.helpinghand_pending else None
+        return TrackSegment(
+            deltas=self.events.deltas[mark.event_count :],
+            events=self.events.events[mark.event_count :],
+            ticks=self.current_ticktime - mark.ticktime,
+            millis=self.current_millitime - mark.millitime,
+            helpinghand_events=[
+                replace(
+                    event,
+                    id=event.id - mark.msg_id,
+                    index=None if event.index is None else event.index - mark.event_count,
+                    millitime=event.millitime - mark.millitime,
+                )
+                for event in self.helpinghand_events[mark.helpinghand_count :]
+            ],
+            helpinghand_update=(
+                (pending.pitch, pending.octave, pending.time_until)
+                if pending and len(self.helpinghand_events) > mark.helpinghand_count
+                else None
+            ),
+            tempo_message_count=self.tempo_message_count - mark.tempo_message_count,
+            grid_tempo_change_count=self.grid_tempo_change_count - mark.grid_tempo_change_count,
+            end_beat=self.current_beat.model_copy(
+                update={
+                    "start_ticktime": self.current_beat.start_ticktime - mark.ticktime,
+                    "end_ticktime": self.current_beat.end_ticktime - mark.ticktime,
+                }
+            ),
+            end_state=self.segment_state(),
+        )
+
+    def splice_segment(self, segment: TrackSegment) -> None:
+        """Appends a segment that was generated by a track with the same state. The result is the same
+        as generating the segment's content."""
+        event_count = len(self.events)
+        ticktime = self.current_ticktime
+        millitime = self.current_millitime
+        self.events.extend(segment.deltas, segment.events)
+        self.message_count += len(segment.events)
+        self.ticktime_last_message += sum(segment.deltas)
+        if segment.helpinghand_update:
+            pending = self._pending_helpinghand_event()
+            pending.pitch, pending.octave, pending.time_until = segment.helpinghand_update
+        for event in segment.helpinghand_events:
+            self.helpinghand_events.append(
+                replace(
+                    event,
+                    id=event.id + self.msg_id,
+                    index=None if event.index is None else event.index + event_count,
+                    millitime=event.millitime + millitime,
+                )
+            )
+        self.msg_id += len(segment.helpinghand_events)
+        self.tempo_message_count += segment.tempo_message_count
+        self.grid_tempo_change_count += segment.grid_tempo_change_count
+        self.current_ticktime += segment.ticks
+        self.current_millitime += segment.millis
+        self.current_beat = segment.end_beat.model_copy(
+            update={
+                "start_ticktime": segment.end_beat.start_ticktime + ticktime,
+                "end_ticktime": segment.end_beat.end_ticktime + ticktime,
+            }
+        )
+        (
+            _,
+            hh_millitime,
+            self.current_bpm,
+            self.grid_bpm,
+            drift,
+            self.current_velocity,
+            open_notes,
+            _,
+        ) = segment.end_state
+        self.last_hh_millitime = self.current_millitime - hh_millitime
+        if drift:
+            self.tempo_drift, last_update_ticktime = drift
+            self.last_update_ticktime = self.current_ticktime + last_update_ticktime
+        self.open_notes = defaultdict(
+            list, {SustainType(sustaintype): list(notes) for sustaintype, notes in open_notes}
+        )
+
+    def switch_notes_off(self, force: Collection[int] = None) -> None:
         """Appends note_off messages for currently playing notes and removes them from self.open_notes.
         Args:
-           force: if True, all notes will be closed, including notes whose attribute sustain_on_next_note is True.
+           force: notes that should be closed, including notes whose sustain type is SUSTAIN.
         """
         if force is None:
-            force = set()
+            force = ()
         # Keep track of already closed notes to avoid storing a note_off message twice for the same note
         # in the unlikely situation that the same note occurs both in the SUSTAIN and the DONT_SUSTAIN set.
         closed_notes = set()
         for sustaintype, midinotes in self.open_notes.items():
-            for midivalue in sorted(list(midinotes)):  # sort set contents for predictable order: makes result testable.
+            for midivalue in midinotes:  # ascending order: predictable order makes result testable.
                 if (
                     sustaintype is SustainType.OFF_ON_NEXT_NOTE or midivalue in force
                 ) and midivalue not in closed_notes:
-                    self.append(
-                        Message(
-                            type="note_off",
-                            note=midivalue,
-                            time=self.current_ticktime - self.ticktime_last_message,
-                            channel=self.channel,
-                            skip_checks=False,
-                        )
+                    self.append_event(
+                        channel_event(NOTE_OFF, self.channel, midivalue, self.NOTE_OFF_VELOCITY),
+                        time=self.current_ticktime - self.ticktime_last_message,
                     )
                     closed_notes.add(midivalue)
-            self.open_notes[sustaintype] -= closed_notes
+            if closed_notes:
+                self.open_notes[sustaintype] = [midivalue for midivalue in midinotes if midivalue not in closed_notes]
         # Remove notes that occurred in both sets from the SUSTAIN set.
-        self.open_notes[SustainType.SUSTAIN] -= closed_notes
+        sustained_notes = self.open_notes[SustainType.SUSTAIN]
+        if closed_notes:
+            self.open_notes[SustainType.SUSTAIN] = [
+                midivalue for midivalue in sustained_notes if midivalue not in closed_notes
+            ]
 
-    def total_tick_time(self):
+    def total_tick_time(self) -> int:
         """Returns the total tick time in the track's message list."""
-        return sum(msg.time for msg in self)
+        if self.run_settings.options.debug_logging:
+            self.check_tick_clock()
+        return self.ticktime_last_message
+
+    def check_tick_clock(self) -> None:
+        """Verifies that the running tick time and message count correspond with the track's messages."""
+        if self.message_count != len(self.events) or self.ticktime_last_message != sum(self.events.deltas):
+            raise ValueError(
+                f"Inconsistent tick clock for track {self.name}: {self.message_count} messages and "
+                f"{self.ticktime_last_message} ticks registered, {len(self.events)} messages and "
+                f"{sum(self.events.deltas)} ticks found."
+            )
 
     def set_beat_info(self, beat_info: BeatInfo):
         """Updates the information about the current beat."""
@@ -208,38 +478,83 @@ class MidiTrackX(MidiTrack):
         tick_duration = self.units_to_ticks(beat_info.duration, TimeUnit.NOTE)
         beat_info.end_ticktime = beat_info.start_ticktime + tick_duration
         # TODO revert this: temporary fix for integration test.
-        # beat_info.update_times = [beat_info.start_ticktime]
-        beat_info.update_times = [
-            beat_info.start_ticktime + t * BeatInfo.UPDATEFREQ
-            for t in range(int(tick_duration / BeatInfo.UPDATEFREQ) + 1)
-        ]
+        # beat_info.update_count = 1
+        beat_info.update_count = int(tick_duration / BeatInfo.UPDATEFREQ) + 1
         self.current_beat = beat_info
         self.update_gradual_change_values(self.current_ticktime)
 
+    def set_expression_timelines(self, tempo: ExpressionTimeline, dynamics: ExpressionTimeline) -> None:
+        """Sets the tempo and dynamics timelines from which the values of each beat are read."""
+        self.tempo_timeline = tempo
+        self.dynamics_timeline = dynamics
+
+    def set_beat(self, fullid: str, duration: float, step_seq: int) -> None:
+        """Updates the information about the current beat. The tempo and dynamics values are read
+        from the expression timelines at the given step of the execution plan."""
+        self.set_beat_info(
+            BeatInfo(
+                fullid=fullid,
+                start_bpm=self.tempo_timeline.start[step_seq],
+                end_bpm=self.tempo_timeline.end[step_seq],
+                start_velocity=self.dynamics_timeline.start[step_seq],
+                end_velocity=self.dynamics_timeline.end[step_seq],
+                duration=duration,
+            )
+        )
+
     def update_gradual_change_values(self, new_ticktime: int):
         """Updates the tempo and dynamics values. Appends all necessary tempo messages for the period
         until the new tick time"""
         # Determine the update moments
         if not self.current_beat:
             return
-        update_times = [t for t in self.current_beat.update_times if self.current_ticktime <= t <= new_ticktime]
-        for tick_time in update_times:
+        for tick_time in self.current_beat.update_times(self.current_ticktime, new_ticktime):
             new_bpm = self.current_beat.tempo(ticktime=tick_time)
             new_velocity = self.current_beat.velocity(ticktime=tick_time)
+            tempo_change_required = self._tempo_change_required(new_bpm, tick_time)
+            if new_bpm != self.grid_bpm:
+                self.grid_bpm = new_bpm
+                self.grid_tempo_change_count += 1
             # If the tempo has changed, append a new tempo message.
-            if new_bpm != self.current_bpm:
+            if new_bpm != self.current_bpm and tempo_change_required:
                 # Store all tempo messages in one channel. The 'safest' track is the KEMPLI track.
                 # In other tracks tempo messages can cause an incorrect duration of grace notes at the beginning of a beat.
                 if self.name == MidiTrackX.TEMPO_TRACK_NAME:
-                    self.append(
-                        MetaMessage(
-                            "set_tempo", tempo=bpm2tempo(new_bpm), time=(tick_time - self.ticktime_last_message)
-                        )
-                    )
+                    self.append_event(tempo_event(bpm2tempo(new_bpm)), time=tick_time - self.ticktime_last_message)
+                    self.tempo_message_count += 1
                 self.current_bpm = new_bpm
             if new_velocity != self.current_velocity:
                 self.current_velocity = new_velocity
 
+    def _tempo_change_required(self, new_bpm: int, tick_time: int) -> bool:
+        """Determines whether the tempo should be set to the value of the fixed tempo curve at the given
+        update moment. With tempo_curve FIXED this is always the case. Otherwise the current tempo is kept
+        as long as the error stays within the tolerance. The error is the tempo difference in BPM or the
+        accumulated timing difference in milliseconds (predicted until the next update moment).
+        The tempo is always set if the beat has a constant tempo, so that the curve ends on its exact value.
+        All tracks make the same decisions, which keeps their millisecond times consistent with the tempo track.
+        """
+        tempo_curve = self.run_settings.midi.tempo_curve
+        if tempo_curve is TempoCurve.FIXED or self.current_bpm == 0:
+            return True
+        tolerance = self.run_settings.midi.tempo_tolerance
+        if tempo_curve is TempoCurve.BPM:
+            within_tolerance = abs(new_bpm - self.current_bpm) <= tolerance
+        else:
+            millis_per_tick = 60000 / self.run_settings.midi.PPQ
+            if tick_time > self.last_update_ticktime:
+                self.tempo_drift += (
+                    (tick_time - self.last_update_ticktime)
+                    * millis_per_tick
+                    * (1 / self.current_bpm - 1 / self.grid_bpm)
+                )
+                self.last_update_ticktime = tick_time
+            predicted_drift = self.tempo_drift + BeatInfo.UPDATEFREQ * millis_per_tick * (
+                1 / self.current_bpm - 1 / new_bpm
+            )
+            within_tolerance = abs(predicted_drift) <= tolerance
+        return not within_tolerance or self.current_beat.start_bpm == self.current_beat.end_bpm
+
     def units_to_ticks(self, value: int, unit: TimeUnit) -> int:
         "Converts a value from the given unit to ticks"
         match unit:
@@ -257,9 +572,12 @@ class MidiTrackX(MidiTrack):
         """Modifies the duration of the last note or note group by adding the given value
         to their note_off message(s)."""
         # TODO Shouldn't we check that all note_off messages are simultaneous?
-        for i in range(len(self) - 1, -1, -1):
-            if self[i].type == "note_off":
-                self[i].time += self.units_to_ticks(value, unit)
+        events = self.events
+        for i in range(len(events) - 1, -1, -1):
+            if events.events[i][0] & 0xF0 == NOTE_OFF:
+                ticks = self.units_to_ticks(value, unit)
+                events.deltas[i] += ticks
+                self.ticktime_last_message += ticks
             else:
                 break
 
@@ -269,15 +587,15 @@ class MidiTrackX(MidiTrack):
         tick_time = self.units_to_ticks(value, unit)
         self.update_gradual_change_values(self.current_ticktime + tick_time)
         self.current_ticktime += tick_time
-        self.current_millitime += tick_time * 60000 / (self.current_bpm * self.run_settings.midi.PPQ)
+        self.current_millitime += Fraction(tick_time * 60000, self.current_bpm * self.run_settings.midi.PPQ)
 
     def comment(self, message: str) -> None:
         """Creates and appends a comment message"""
-        self.append(MetaMessage("text", text=message))
+        self.append_event(text_event(TEXT, message))
 
     def marker(self, message: str) -> None:
         """Creates and appends a marker message"""
-        self.append(MetaMessage("marker", text=message))
+        self.append_event(text_event(MARKER, message))
 
     def _grace_note_duration(self) -> int:
         """A grace note uses half of the duration of the previous note or rest,
@@ -289,59 +607,56 @@ class MidiTrackX(MidiTrack):
         tick_duration = min(int((self.current_ticktime - self.ticktime_last_message) / 2), max_duration)
         return tick_duration
 
-    def _append_helpinghand_message(self):
+    def _append_helpinghand_event(self) -> None:
         if not self.animate_helpinghand:
-            return None
-        # Add a message to animate the 'helping hand' (moving arrow).
-        # The pitch, octave and time_until values will be updated when the next note is processed.
-        text = (
-            "{"
-            f'"id": {self.msg_id}, "type": "helpinghand", "position": "{self.position}", "channel": {self.channel}, '
-            '"pitch": "{pitch}", "octave": {octave}, "timeuntil": {time_until}, "islast": {is_last}'
-            "}"
-        )
+            return
+        # Add an event to animate the 'helping hand' (moving arrow). The information about the next note
+        # will be added when the next note is processed. A marker message is reserved in the event buffer.
+        # Its text is set by `finalize`.
+        event = HelpingHandEvent(id=self.msg_id, millitime=self.current_millitime)
+        if self.helpinghand_markers:
+            event.index = self.append_event(text_event(MARKER, ""))
+        self.helpinghand_events.append(event)
         self.msg_id += 1
-        new_msg = MetaMessage("marker", text=text)
-        self.append(new_msg)
-        return new_msg
 
-    def _update_prev_helpinghand_message(self, note: Note, is_last: bool = False):
-        if not self.animate_helpinghand or not self.last_helpinghand_msg:
+    def _update_prev_helpinghand_event(self, note: Note, is_last: bool = False) -> None:
+        """Adds the information about the given note to the preceding helping hand event. For the last event,
+        the information of the first note is used, which enables the animation to loop."""
+        if not self.animate_helpinghand or len(self.helpinghand_events) < (1 if is_last else 2):
             return
-        # Edit the previous helping hand message with the current note information.
+        event = self.helpinghand_events[-1 if is_last else -2]
         if is_last:
-            # if self.run_settings.notation.part.loop:
-            first_msg_json = json.loads(self.first_helpinghand_msg.text)
-            time_until = int(self.current_millitime - self.last_hh_millitime)
-            pitch = first_msg_json["pitch"]
-            octave = first_msg_json["octave"]
-            time_until = first_msg_json["timeuntil"] + int(self.current_millitime - self.last_hh_millitime)
-            # else:
-            #     pitch = "NONE"
-            #     octave = 0
-            #     time_until = 0
+            first_event = self.helpinghand_events[0]
+            event.pitch = first_event.pitch
+            event.octave = first_event.octave
+            event.time_until = (first_event.time_until or 0) + int(self.current_millitime - self.last_hh_millitime)
+            event.is_last = True
         else:
-            pitch = note.pitch
-            octave = note.octave
-            time_until = int(self.current_millitime - self.last_hh_millitime)
+            event.pitch = note.pitch
+            event.octave = note.octave
+            event.time_until = int(self.current_millitime - self.last_hh_millitime)
             self.last_hh_millitime = self.current_millitime
-        text: str = self.last_helpinghand_msg.text
-        text = (
-            text.replace("{pitch}", f"{pitch}")
-            .replace("{octave}", f"{octave}")
-            .replace("{time_until}", f"{time_until}")
-            .replace("{is_last}", str(is_last).lower())  # format for javascript
-        )
-        self.last_helpinghand_msg.text = text
+
+    def helpinghand_timeline(self) -> dict:
+        """Returns the helping hand events of the track in compact form (see HELPINGHAND_TIMELINE_FIELDS)."""
+        return {
+            "channel": self.channel,
+            "events": [event.timeline_entry() for event in self.helpinghand_events],
+        }
 
     def finalize(self):
-        """Removes the last helping hand message if it has not been updated."""
-        if self.last_helpinghand_msg and "{time_until}" in self.last_helpinghand_msg.text:
-            self._update_prev_helpinghand_message(note=None, is_last=True)
+        """Completes the last helping hand event and writes the text of the helping hand marker messages."""
+        if self.helpinghand_events and self.helpinghand_events[-1].time_until is None:
+            self._update_prev_helpinghand_event(note=None, is_last=True)
+        for event in self.helpinghand_events:
+            if event.index is not None:
+                self.events.replace(event.index, text_event(MARKER, event.marker_text(self.position, self.channel)))
         self.switch_notes_off(force=self.open_notes[SustainType.SUSTAIN])
+        if self.run_settings.options.debug_logging:
+            self.check_tick_clock()
 
-    def get_midinotes(self, note: Note) -> set[int]:
-        """Return a list of midi values that correspond with the given Note object."""
+    def get_midinotes(self, note: Note) -> tuple[int, ...]:
+        """Return the midi values that correspond with the given Note object, in ascending order."""
         return self.midi_dict.get((note.position, note.pitch, note.octave, note.effect))
 
     def add_note(self, note: Note):
@@ -355,8 +670,7 @@ class MidiTrackX(MidiTrack):
             ValueError: _description_
         """
         if note.pitch not in (Pitch.EXTENSION, Pitch.SILENCE):
-            # sort set contents for predictable order: makes result testable.
-            midinotes = sorted(list(self.get_midinotes(note)))
+            midinotes = self.get_midinotes(note)
             # Stop all non-sustained notes and force stop any open midinote that occurs in the new note.
             grace_note_duration = 0
             if note.effect is Stroke.GRACE_NOTE:
@@ -381,12 +695,13 @@ class MidiTrackX(MidiTrack):
 
                 if count == 1:
                     # Add helping hand message
-                    new_helpinghand_msg = self._append_helpinghand_message()
-                    self._update_prev_helpinghand_message(note)
-                    self.last_helpinghand_msg = new_helpinghand_msg
+                    self._append_helpinghand_event()
+                    self._update_prev_helpinghand_event(note)
 
                 # Keep track of open notes in order to generate their note_off messages later.
-                self.open_notes[note.sustaintype].add(midivalue)
+                open_notes = self.open_notes[note.sustaintype]
+                if midivalue not in open_notes:
+                    insort(open_notes, midivalue)
 
             self.increase_current_time(grace_note_duration, TimeUnit.TICK)
             self.increase_current_time(note.duration, unit=TimeUnit.NOTE)
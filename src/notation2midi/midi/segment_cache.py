@@ -0,0 +1,71 @@
+"""Persistent cache of generated MIDI track segments, which enables incremental regeneration of a MIDI file.
+A segment is the content that a track generates during one passage through a gongan. Its key combines the
+track's properties, the state of the track at the start of the segment (see MidiTrackX.segment_state) and
+a digest of the notation that is processed (notes, pass, tempo and dynamics of each beat). If a key is found
+in the cache, the cached content is spliced into the track instead of being generated again.
+The cache is only valid for the settings that were used to create it (see `fingerprint`). The fingerprint is
+saved in front of the segments, so that the segments of a cache with other settings are never unpickled.
+"""
+
+import hashlib
+import os
+import pickle
+
+from src.common.logger import Logging
+from src.notation2midi.midi.midi_track import TrackSegment
+
+logger = Logging.get_logger(__name__)
+
+# Increase this value when the content of TrackSegment or the MIDI generation changes.
+CACHE_FORMAT_VERSION = 4
+PICKLE_PROTOCOL = 5  # Fixed protocol, to obtain the same digests with all Python versions.
+
+
+def digest(*values) -> bytes:
+    """Returns a digest of the given values. The values should have a deterministic pickled representation,
+    e.g. (nested) tuples of numbers, strings and enum members."""
+    return hashlib.blake2b(pickle.dumps(values, protocol=PICKLE_PROTOCOL), digest_size=16).digest()
+
+
+class SegmentCache:
+    """Track segments of a single notation part, saved in a pickle file."""
+
+    filepath: str
+    fingerprint: bytes
+    segments: dict[bytes, TrackSegment]
+
+    def __init__(self, filepath: str, *settings):
+        """Loads the cache file. The content is discarded if it was created with other settings.
+        Args:
+            filepath (str): location of the cache file.
+            settings: values that determine the MIDI generation, apart from the notation itself.
+        """
+        self.filepath = filepath
+        self.fingerprint = digest(CACHE_FORMAT_VERSION, *settings)
+        self.segments = {}
+        if not os.path.exists(filepath):
+            return
+        try:
+            with open(filepath, "rb") as cachefile:
+                if pickle.load(cachefile) != self.fingerprint:
+                    return
+                segments = pickle.load(cachefile)
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            # The cache is an optimization: any content that can't be read is discarded.
+            logger.warning("Could not read MIDI segment cache %s: %s", filepath, err)
+            return
+        self.segments = segments
+
+    def get(self, key: bytes) -> TrackSegment | None:
+        return self.segments.get(key, None)
+
+    def save(self, segments: dict[bytes, TrackSegment]) -> None:
+        """Replaces the content of the cache with the given segments and saves it.
+        Args:
+            segments (dict[bytes, TrackSegment]): the segments that were used by the last run.
+        """
+        self.segments = segments
+        os.makedirs(os.path.dirname(self.filepath) or ".", exist_ok=True)
+        with open(self.filepath, "wb") as cachefile:
+            pickle.dump(self.fingerprint, cachefile, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(segments, cachefile, protocol=pickle.HIGHEST_PROTOCOL)
@@ -0,0 +1,95 @@
+"""Analyzes the execution flow of a score before the MIDI file is generated."""
+
+from typing import override
+
+from src.common.classes import Beat
+from src.notation2midi.classes import Agent
+from src.notation2midi.execution.execution import (
+    ExecutionManager,
+    ExecutionPlan,
+    FlowAnalysis,
+)
+from src.settings.classes import RunSettings
+
+
+class FlowAnalysisAgent(Agent):
+    """Unrolls the flow (GOTO, LOOP and SEQUENCE) of the score without generating any MIDI content.
+    Detects flows that never end, determines the number of executed beats and estimates the duration
+    of the performance. The run is aborted if the flow does not terminate or if it exceeds the limits
+    in the run settings. The resulting execution plan is reused by the MIDI generator.
+    """
+
+    LOGGING_MESSAGE = "ANALYZING EXECUTION FLOW"
+    EXPECTED_INPUT_TYPES = (Agent.InputOutputType.EXECUTION,)
+    RETURN_TYPE = Agent.InputOutputType.FLOWANALYSIS
+
+    execution: ExecutionManager
+
+    def __init__(self, execution: ExecutionManager):
+        super().__init__(execution.score.settings)
+        self.execution = execution
+
+    @override
+    @classmethod
+    def run_condition_satisfied(cls, run_settings: RunSettings):
+        # The flow only needs to be analyzed if it will be performed, i.e. if a MIDI file is generated.
+        return run_settings.options.notation_to_midi and run_settings.options.notation_to_midi.save_midifile
+
+    def _estimated_duration(self, plan: ExecutionPlan) -> float:
+        """Estimates the duration in seconds of the performance. Gradual tempo changes are approximated
+        by the average tempo of each beat.
+        Args:
+            plan (ExecutionPlan): the unrolled execution flow.
+        Returns:
+            float: duration in seconds.
+        """
+        midi = self.run_settings.midi
+        beat_ticks: dict[int, int] = {}
+
+        def ticks(beat: Beat) -> int:
+            if beat.seq not in beat_ticks:
+                beat_ticks[beat.seq] = round(beat.duration * midi.base_note_time)
+            return beat_ticks[beat.seq]
+
+        seconds = sum(
+            ticks(step.beat) * 120 / ((plan.tempo.start[step_seq] + plan.tempo.end[step_seq]) * midi.PPQ)
+            for step_seq, step in enumerate(plan.steps)
+        )
+        if not self.run_settings.notationfile.part.loop:
+            seconds += midi.silence_seconds_before_start + midi.silence_seconds_after_end
+        return seconds
+
+    @override
+    def _main(self) -> FlowAnalysis:
+        options = self.run_settings.options.notation_to_midi
+        max_beats = options.max_executed_beats
+        # Unroll one step beyond the limit to detect that the limit has been exceeded.
+        plan = self.execution.create_execution_plan(max_steps=max_beats + 1 if max_beats is not None else None)
+        analysis = FlowAnalysis(
+            executed_beat_count=len(plan.steps),
+            duration_seconds=self._estimated_duration(plan),
+            terminates=plan.cycle_beat is None,
+            cycle_beat_id=plan.cycle_beat.full_id if plan.cycle_beat else None,
+        )
+
+        if not analysis.terminates:
+            self.logerror(
+                f"The execution flow never ends: it repeats itself from beat {analysis.cycle_beat_id} "
+                f"after {analysis.executed_beat_count} beats. Check the GOTO, LOOP and SEQUENCE metadata."
+            )
+        elif max_beats is not None and analysis.executed_beat_count > max_beats:
+            self.logerror(f"The execution flow exceeds the maximum of {max_beats} executed beats.")
+        elif options.max_duration_seconds is not None and analysis.duration_seconds > options.max_duration_seconds:
+            self.logerror(
+                f"The estimated duration of {analysis.duration_seconds:.0f} seconds exceeds the maximum "
+                f"of {options.max_duration_seconds} seconds."
+            )
+        else:
+            self.loginfo(
+                f"Executed beats: {analysis.executed_beat_count}, "
+                f"estimated duration: {int(analysis.duration_seconds // 60)}:{int(analysis.duration_seconds % 60):02d}"
+            )
+
+        if self.has_errors:
+            return None
+        return analysis
@@ -1,47 +1,250 @@
+import gzip
+import hashlib
 import os
-from typing import override
+import re
+import socket
+import time
+from contextlib import contextmanager
+from typing import ClassVar, Iterator, override
 
+import brotli
+
+from src.common.logger import Logging
+from src.common.output_sinks import FileSink
 from src.notation2midi.classes import Agent
-from src.settings.classes import Content, PartForm, RunSettings, Song
+from src.settings.classes import (
+    Content,
+    HelpingHandOutput,
+    PartForm,
+    RunSettings,
+    Song,
+)
 from src.settings.constants import PresetsFields
-from src.settings.utils import pretty_compact_json
+from src.settings.content_store import ContentStore
+
+logger = Logging.get_logger(__name__)
+
+HASH_LENGTH = 10  # Number of hexadecimal digits of the content hash in the name of a published file.
+
+
+def _lock_is_stale(lockfilepath: str, stale_after: float) -> bool:
+    """Determines whether a lock file was left behind, e.g. by a process that crashed. This is the case if the
+    process that created the lock file no longer exists or if the lock file is older than `stale_after` seconds.
+    The process can only be checked on POSIX platforms and if it runs on the same host."""
+    try:
+        with open(lockfilepath, "r", encoding="utf-8") as lockfile:
+            owner = lockfile.read().split()
+        age = time.time() - os.path.getmtime(lockfilepath)
+    except FileNotFoundError:
+        return False  # The lock has been released in the meantime.
+    if age > stale_after:
+        return True
+    if os.name == "posix" and len(owner) == 2 and owner[0] == socket.gethostname() and owner[1].isdigit():
+        try:
+            os.kill(int(owner[1]), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass  # The process exists but belongs to another user.
+    return False
+
+
+@contextmanager
+def locked_file(
+    filepath: str, timeout: float = 60.0, interval: float = 0.1, stale_after: float = 600.0
+) -> Iterator[None]:
+    """Gives exclusive access to a file to processes that use this context manager for the same file.
+    The lock consists of a separate lock file which is created exclusively, which works on any platform.
+    The lock file contains the host name and the process id of its owner. A stale lock file (see _lock_is_stale)
+    is removed.
+    Args:
+        filepath (str): the file to lock.
+        timeout (float, optional): maximum waiting time in seconds. Defaults to 60.
+        interval (float, optional): time in seconds between attempts to acquire the lock. Defaults to 0.1.
+        stale_after (float, optional): age in seconds after which a lock file is considered stale. Defaults to 600.
+    Raises:
+        TimeoutError: the lock could not be acquired within the given time.
+    """
+    lockfilepath = filepath + ".lock"
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            lockfile = os.open(lockfilepath, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError as exc:
+            if _lock_is_stale(lockfilepath, stale_after):
+                logger.warning("Removing stale lock file %s.", lockfilepath)
+                try:
+                    os.remove(lockfilepath)
+                except FileNotFoundError:
+                    pass  # Removed by another process.
+                continue
+            if time.monotonic() > deadline:
+                raise TimeoutError(
+                    f"Could not lock {filepath}. Remove {lockfilepath} if no other process is using the file."
+                ) from exc
+            time.sleep(interval)
+        else:
+            with os.fdopen(lockfile, "w", encoding="utf-8") as outfile:
+                outfile.write(f"{socket.gethostname()} {os.getpid()}")
+            break
+    try:
+        yield
+    finally:
+        os.remove(lockfilepath)
+
+
+def content_hashed_name(filename: str, content: bytes) -> str:
+    """Adds a hash of the content to the file name, e.g. Sinom_full.mid -> Sinom_full.1a2b3c4d5e.mid"""
+    stem, ext = os.path.splitext(filename)
+    return f"{stem}.{hashlib.sha256(content).hexdigest()[:HASH_LENGTH]}{ext}"
+
+
+def publish_file(sourcepath: str, folder: str) -> str:
+    """Copies a file to the folder under a content-hashed name, together with a gzip compressed variant
+    <name>.gz and a brotli compressed variant <name>.br. These variants can be served as is by the web server.
+    Because the name changes with the content, the files can be cached indefinitely.
+    Published files that already exist are not rewritten. Previous versions are kept: remove them with
+    `remove_previous_versions` once the published name has been saved in the midiplayer content.
+    Args:
+        sourcepath (str): the file to publish.
+        folder (str): destination folder.
+    Returns:
+        str: the name of the published file.
+    """
+    with open(sourcepath, "rb") as infile:
+        content = infile.read()
+    published = content_hashed_name(os.path.basename(sourcepath), content)
+    variants = {
+        published: lambda: content,
+        published + ".gz": lambda: gzip.compress(content, compresslevel=9, mtime=0),
+        published + ".br": lambda: brotli.compress(content),
+    }
+    for name, compress in variants.items():
+        filepath = os.path.join(folder, name)
+        if os.path.exists(filepath):
+            continue
+        # Write to a temporary file first: an incomplete file would otherwise be considered up to date.
+        with open(filepath + ".tmp", "wb") as outfile:
+            outfile.write(compress())
+        os.replace(filepath + ".tmp", filepath)
+    return published
+
+
+def remove_previous_versions(folder: str, published: str) -> None:
+    """Removes the versions of a published file (see publish_file) that have a different content hash,
+    including their compressed variants.
+    Args:
+        folder (str): folder that contains the published files.
+        published (str): name of the current version.
+    """
+    hashed = list(re.finditer(rf"\.[0-9a-f]{{{HASH_LENGTH}}}", published))[-1]
+    pattern = re.compile(
+        re.escape(published[: hashed.start()])
+        + rf"\.[0-9a-f]{{{HASH_LENGTH}}}"
+        + re.escape(published[hashed.end() :])
+        + r"(\.gz|\.br)?"
+    )
+    for name in os.listdir(folder):
+        if pattern.fullmatch(name) and name not in (published, published + ".gz", published + ".br"):
+            os.remove(os.path.join(folder, name))
 
 
 class MidiPlayerUpdateAgentModel(Agent):
     """Model for agents that update the content.json file in the midiplayer data folder.
-    This class should be subclassed, see subclass definitions below"""
+    This class should be subclassed, see subclass definitions below.
+    Within a `batch` context, the updates are recorded in a journal which is applied to the content file
+    at the end of the batch. Otherwise each update is applied immediately.
+    """
+
+    # Updates recorded during the current batch. None if no batch is active.
+    _journal: ClassVar[list["MidiPlayerUpdateAgentModel"] | None] = None
+
+    def __init__(self, run_settings: RunSettings):
+        super().__init__(run_settings)
+        # The run settings object is reused for the next song of a batch: keep the values of the current song.
+        self.song_title = run_settings.notationfile.title
+        self.instrumentgroup = run_settings.instrumentgroup
+        self.notation_version = run_settings.notation_version
+
+    # pylint: disable=unused-argument,missing-function-docstring
+
+    # Override this function. It should apply the agent's update to the content.
+    def _update_content(self, content: Content) -> None: ...
+
+    # Override this function if the agent should take action once the updated content has been saved.
+    def _content_saved(self) -> None: ...
+
+    # pylint: enable=unused-argument,missing-function-docstring
+
+    @override
+    def _main(self) -> None:
+        """Records the update if a batch is active, otherwise applies it to the content file."""
+        if MidiPlayerUpdateAgentModel._journal is not None:
+            MidiPlayerUpdateAgentModel._journal.append(self)
+            self.loginfo("Update of %s recorded, will be saved at the end of the run", self.song_title)
+        else:
+            self._apply_updates([self])
+
+    @classmethod
+    @contextmanager
+    def batch(cls) -> Iterator[None]:
+        """Collects the content updates of the pipelines that are run within this context and applies them
+        to the content file with a single read and write when the context ends."""
+        MidiPlayerUpdateAgentModel._journal = []
+        try:
+            yield
+        finally:
+            journal, MidiPlayerUpdateAgentModel._journal = MidiPlayerUpdateAgentModel._journal, None
+            if journal:
+                cls._apply_updates(journal)
+
+    @classmethod
+    def _apply_updates(cls, updates: list["MidiPlayerUpdateAgentModel"]) -> None:
+        """Applies the given updates to the content file. The file is locked during the update so that
+        concurrent processes cannot overwrite each other's updates.
+        Args:
+            updates (list[MidiPlayerUpdateAgentModel]): agents whose update should be applied, in order of execution.
+        """
+        agent = updates[-1]
+        store = ContentStore.from_settings(agent.run_settings.midiplayer)
+        try:
+            with locked_file(os.path.join(store.folder, store.contentfile)):
+                content = agent._get_midiplayer_content(store)
+                agent._update_instrument_info(content)
+                for update in updates:
+                    update._update_content(content)
+                if agent._save_midiplayer_content(content, store):
+                    for update in updates:
+                        update._content_saved()
+        except TimeoutError as e:
+            titles = ", ".join(dict.fromkeys(update.song_title for update in updates))
+            agent.logerror("%s The midiplayer content of %s has not been updated.", str(e), titles)
 
-    def _get_midiplayer_content(self, datafolder: str, filename: str) -> Content:
+    def _get_midiplayer_content(self, store: ContentStore) -> Content:
         """Loads the configuration file for the JavaScript midplayer app.
         Next to settings, the file contains information about the MIDI and PDF files
         in the app's production folder.
+        Args:
+            store (ContentStore): store of the midiplayer content.
         Returns:
             Content: Structure for the midiplayer content.
         """
-        with open(os.path.join(datafolder, filename), "r", encoding="utf-8") as filename:
-            playercontent = filename.read()
-        # return temp_update_me(Content.model_validate_json(playercontent))
-        return Content.model_validate_json(playercontent)
+        return store.load()
 
-    def _save_midiplayer_content(self, playercontent: Content, datafolder: str, filename: str):
+    def _save_midiplayer_content(self, playercontent: Content, store: ContentStore) -> bool:
         """Saves the configuration file for the JavaScript midplayer app.
         Args:
             playercontent (Content): content that should be saved to the config file.
-            filename (str, optional): name of the config file. Defaults to None.
+            store (ContentStore): store from which the content was loaded.
+        Returns:
+            bool: True if the content has been saved.
         """
-        playercontent.songs = sorted(playercontent.songs, key=lambda s: s.title)
-        contentfilepath = os.path.join(datafolder, filename)
-        tempfilepath = os.path.join(datafolder, "_" + filename)
         try:
-            with open(tempfilepath, "w", encoding="utf-8") as outfile:
-                jsonised = pretty_compact_json(playercontent.model_dump())
-                outfile.write(jsonised)
-        except IOError as e:
-            os.remove(tempfilepath)
-            self.logerror(e)
-        else:
-            os.remove(contentfilepath)
-            os.rename(tempfilepath, contentfilepath)
+            store.save(playercontent)
+        except (OSError, ValueError) as e:
+            self.logerror(str(e))
+            return False
+        return True
 
     def _update_instrument_info(self, content: Content) -> None:
         """Updates the MIDI information of the InstrumentInfo component from the presets config file."""
@@ -98,28 +301,21 @@ class MidiPlayerUpdatePartAgent(MidiPlayerUpdateAgentModel):
         return (
             run_settings.options.notation_to_midi.is_production_run
             and run_settings.options.notation_to_midi.save_midifile
+            and isinstance(run_settings.output_sink, FileSink)
         )
 
     @override
-    def _main(self) -> None:
-        """Updates the Part information of the song in the content.json file of the midi player."""
-
-        content = self._get_midiplayer_content(
-            self.run_settings.midiplayer.folder, self.run_settings.midiplayer.contentfile
-        )
-        self._update_instrument_info(content)
-
+    def _update_content(self, content: Content) -> None:
+        """Updates the Part information of the song in the content of the midi player."""
         # If info is already present, replace it.
-        song_title = self.run_settings.notationfile.title
-        player_song: Song = next((song_ for song_ in content.songs if song_.title == song_title), None)
+        player_song: Song = next((song_ for song_ in content.songs if song_.title == self.song_title), None)
         if not player_song:
             # TODO create components of Song
             content.songs.append(
                 player_song := Song(
-                    title=self.run_settings.notationfile.title,
-                    instrumentgroup=self.run_settings.instrumentgroup,
+                    title=self.song_title,
+                    instrumentgroup=self.instrumentgroup,
                     display=True,
-                    pfd=None,
                 )
             )
             self.loginfo("New song %s created for MIDI player content", player_song.title)
@@ -143,9 +339,6 @@ class MidiPlayerUpdatePartAgent(MidiPlayerUpdateAgentModel):
                     "Please run again with run-option `save_midifile` set.",
                     self.part_info.part,
                 )
-        self._save_midiplayer_content(
-            content, self.run_settings.midiplayer.folder, self.run_settings.midiplayer.contentfile
-        )
 
 
 class MidiPlayerUpdatePdfAgent(MidiPlayerUpdateAgentModel):
@@ -169,35 +362,113 @@ class MidiPlayerUpdatePdfAgent(MidiPlayerUpdateAgentModel):
             run_settings.options.notation_to_midi.is_production_run
             and run_settings.options.notation_to_midi.save_pdf_notation
             and run_settings.part_id == run_settings.notationfile.generate_pdf_part_id
+            and isinstance(run_settings.output_sink, FileSink)
         )
 
     @override
-    def _main(self) -> None:
-        """Updates the PDF information of the song in the content.json file of the midi player."""
-        content = self._get_midiplayer_content(
-            self.run_settings.midiplayer.folder, self.run_settings.midiplayer.contentfile
-        )
+    def _update_content(self, content: Content) -> None:
+        """Updates the PDF information of the song in the content of the midi player."""
         # Check if song info is already present in the content file
-        song_title = self.run_settings.notationfile.title
-        player_song: Song = next((song_ for song_ in content.songs if song_.title == song_title), None)
+        player_song: Song = next((song_ for song_ in content.songs if song_.title == self.song_title), None)
         if player_song:
             player_song.pdf = self.pdf_file
-            player_song.notation_version = self.run_settings.notation_version
+            player_song.notation_version = self.notation_version
         else:
             # Create a new song entry
             # TODO create components of Song
             content.songs.append(
                 player_song := Song(
-                    title=self.run_settings.notationfile.title,
-                    instrumentgroup=self.run_settings.instrumentgroup,
+                    title=self.song_title,
+                    instrumentgroup=self.instrumentgroup,
                     display=True,
-                    pfd=self.pdf_file,
-                    notation_version=self.run_settings.notation_version,
+                    pdf=self.pdf_file,
+                    notation_version=self.notation_version,
                 )
             )
             self.loginfo("New song %s created for MIDI player content", player_song.title)
 
-        content.songs = sorted(content.songs, key=lambda s: s.title)
-        self._save_midiplayer_content(
-            content, self.run_settings.midiplayer.folder, self.run_settings.midiplayer.contentfile
+
+class MidiPlayerPublishAgent(MidiPlayerUpdateAgentModel):
+    """Publishes the MIDI and PDF files of the song in the midiplayer folder under content-hashed names, together
+    with precompressed variants (see publish_file), and replaces the file names in the midiplayer content
+    with the published names. This enables the browser to cache the files of the midiplayer indefinitely.
+    """
+
+    LOGGING_MESSAGE = "PUBLISHING MIDI PLAYER FILES"
+    EXPECTED_INPUT_TYPES = (Agent.InputOutputType.RUNSETTINGS,)
+    RETURN_TYPE = None
+
+    def __init__(self, run_settings: RunSettings):
+        super().__init__(run_settings)
+        self.part_name = run_settings.notationfile.part.name
+        self.midi_filepath = (
+            run_settings.midi_out_filepath if MidiPlayerUpdatePartAgent.run_condition_satisfied(run_settings) else None
+        )
+        self.helpinghand_filepath = (
+            run_settings.helpinghand_out_filepath
+            if self.midi_filepath and run_settings.midiplayer.helpinghand_output is HelpingHandOutput.SIDECAR
+            else None
+        )
+        self.pdf_filepath = (
+            run_settings.pdf_out_filepath if MidiPlayerUpdatePdfAgent.run_condition_satisfied(run_settings) else None
         )
+        self.published_midi = None
+        self.published_helpinghand = None
+        self.published_pdf = None
+
+    @override
+    @classmethod
+    def run_condition_satisfied(cls, run_settings: RunSettings):
+        return (
+            run_settings.options.notation_to_midi.is_production_run
+            and run_settings.midiplayer.publish_bundle
+            and isinstance(run_settings.output_sink, FileSink)
+        )
+
+    @override
+    def _main(self) -> None:
+        """Publishes the files, then records the update of the content (see MidiPlayerUpdateAgentModel)."""
+        folder = self.run_settings.midiplayer.folder
+        try:
+            if self.midi_filepath and os.path.exists(self.midi_filepath):
+                self.published_midi = publish_file(self.midi_filepath, folder)
+                self.loginfo("MIDI file published as %s", self.published_midi)
+                if self.helpinghand_filepath and os.path.exists(self.helpinghand_filepath):
+                    self.published_helpinghand = publish_file(self.helpinghand_filepath, folder)
+                    self.loginfo("Helping hand timeline published as %s", self.published_helpinghand)
+            if self.pdf_filepath and os.path.exists(self.pdf_filepath):
+                self.published_pdf = publish_file(self.pdf_filepath, folder)
+                self.loginfo("PDF file published as %s", self.published_pdf)
+        except OSError as e:
+            self.logerror(str(e))
+            return
+        super()._main()
+
+    @override
+    def _update_content(self, content: Content) -> None:
+        """Replaces the names of the MIDI and PDF files of the song with the published names."""
+        player_song: Song = next((song_ for song_ in content.songs if song_.title == self.song_title), None)
+        if not player_song:
+            self.logwarning("Song %s not found in the MIDI player content", self.song_title)
+            return
+        if self.published_pdf:
+            player_song.pdf = self.published_pdf
+        if self.published_midi:
+            # pylint: disable=not-an-iterable
+            part = next((part_ for part_ in player_song.parts if part_.part == self.part_name), None)
+            if part:
+                part.file = self.published_midi
+                part.helpinghand = self.published_helpinghand
+            else:
+                self.logwarning("Part %s not found in the MIDI player content", self.part_name)
+
+    @override
+    def _content_saved(self) -> None:
+        """Removes the previous versions of the published files, which are no longer referred to by the content."""
+        folder = self.run_settings.midiplayer.folder
+        for published in (self.published_midi, self.published_helpinghand, self.published_pdf):
+            if published:
+                try:
+                    remove_previous_versions(folder, published)
+                except OSError as e:
+                    self.logwarning(str(e))
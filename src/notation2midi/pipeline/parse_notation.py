@@ -233,7 +233,8 @@ class NotationParserAgent(Agent):
            If a parsing error is encountered, the error is logged and the parser skips
            to the next line.
         Args:
-            notation (str | None, optional): the notation read from file. Defaults to None.
+            notation (str | None, optional): the notation content. Defaults to None, in which case the notation is
+                taken from the run settings or read from the notation file.
         Returns:
             NotationDict: dict containing a structured representation of the notation.
             See the beginning of this module for a description.
@@ -242,6 +243,7 @@ class NotationParserAgent(Agent):
             self.logerror("Cannot parse font %s.", self.run_settings.fontversion)
             return None
 
+        notation = notation or self.run_settings.notation
         if notation:
             self.loginfo("Parsing notation from string")
         else:
@@ -444,4 +444,6 @@ class ScorePostprocessAgent(Agent):
         # Add kempli beats
         self._add_missing_measures(add_kempli=True)
         # self._add_pattern_to_rests()
+        # The score is complete: number the beats for fast lookup during the execution of the score.
+        self.score.index_beats()
         return self.score
@@ -3,21 +3,37 @@ Keeps track of the number of time each beat was passed and processes the flow (G
 Main method: create_midifile()
 """
 
+import json
+import multiprocessing
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from typing import override
 
 from mido import MidiFile
 
 from src.common.classes import Beat, Preset
 from src.common.constants import DEFAULT, Pitch, Position, Stroke
-from src.common.notes import Pattern
+from src.common.notes import Note, Pattern
+from src.common.output_sinks import OutputKind
 from src.notation2midi.classes import Agent
-from src.notation2midi.execution.execution import ExecutionManager
+from src.notation2midi.execution.execution import ExecutionManager, ExecutionPlan, ExecutionStep
 from src.notation2midi.metadata_classes import MetaType
-from src.notation2midi.midi.midi_track import BeatInfo, MidiTrackX, TimeUnit
-from src.settings.classes import PartForm, RunSettings
+from src.notation2midi.midi.midi_events import TempoMap, write_midifile
+from src.notation2midi.midi.midi_track import HELPINGHAND_TIMELINE_FIELDS, MidiTrackX, TimeUnit, TrackSegment
+from src.notation2midi.midi.segment_cache import SegmentCache, digest
+from src.settings.classes import HelpingHandOutput, MidiEncoder, PartForm, RunSettings, TempoCurve
 from src.settings.constants import MidiNotesFields
 
+# Agent and execution plan used by the worker processes that generate the MIDI tracks in parallel.
+# The worker processes are forked, so that they inherit these objects instead of receiving a pickled copy.
+_forked_agent: "MidiGeneratorAgent" = None
+_forked_plan: ExecutionPlan = None
+
+
+def _notation_to_track_in_worker(position: Position) -> tuple[MidiTrackX, dict[str, int], dict[bytes, TrackSegment]]:
+    """Generates a MIDI track in a worker process. See MidiGeneratorAgent._generate_tracks."""
+    return _forked_agent._notation_to_track(position, _forked_plan)  # pylint: disable=protected-access
+
 
 class MidiGeneratorAgent(Agent):
     """This Parser creates a MIDI file based on a Score objects."""
@@ -28,6 +44,7 @@ class MidiGeneratorAgent(Agent):
 
     part_info: PartForm = None
     exec_mgr: ExecutionManager = None
+    segment_cache: SegmentCache = None
 
     def __init__(self, run_settings: RunSettings, execution: ExecutionManager):
         super().__init__(run_settings)
@@ -38,13 +55,14 @@ class MidiGeneratorAgent(Agent):
             file=self.run_settings.midi_out_file,
             loop=self.run_settings.notationfile.part.loop,
         )
-        self.midi_dict: dict[tuple[Pitch, int, Stroke], set[int]] = {
+        # Midi notes of each (position, pitch, octave, stroke) combination, in ascending order.
+        self.midi_dict: dict[tuple[Position, Pitch, int, Stroke], tuple[int, ...]] = {
             (
                 pos,
                 record[MidiNotesFields.PITCH],
                 record[MidiNotesFields.OCTAVE],
                 record[MidiNotesFields.STROKE],
-            ): set(record[MidiNotesFields.MIDINOTE])
+            ): tuple(sorted(set(record[MidiNotesFields.MIDINOTE])))
             for record in run_settings.data.midinotes.filterOn(run_settings.instrumentgroup)
             for pos in record[MidiNotesFields.POSITIONS]
         }
@@ -66,32 +84,112 @@ class MidiGeneratorAgent(Agent):
             if track.total_tick_time() == max_ticks:
                 track.extend_last_notes(seconds, TimeUnit.SECOND)
 
-    def _notation_to_track(self, position: Position) -> MidiTrackX:
-        """Generates the MIDI content for a single instrument position.
+    def _pass_notes(self, position: Position, step: ExecutionStep) -> list[Note]:
+        """Returns the notes that the instrument position plays in the given step. Patterns are replaced by
+        their notes."""
+        beat = step.beat
+        try:
+            pass_ = beat.measures[position].passes.get(step.pass_nr, beat.measures[position].passes[DEFAULT])
+        except KeyError:
+            self.logerror(f"No measure found for {position} in beat {beat.full_id}. Program halted.")
+            sys.exit()
+        notes = []
+        for note in pass_.notes:
+            # Add the note, or the pattern in case of a pattern.
+            if isinstance(note, Pattern):
+                notes.extend(note.pattern)
+            else:
+                notes.append(note)
+        return notes
+
+    @staticmethod
+    def _segments(plan: ExecutionPlan) -> list[range]:
+        """Splits the execution plan into segments. A segment is a passage through a gongan: a series of
+        consecutive steps within the same gongan. A new segment starts if the flow returns to the first
+        beat of the segment or to a beat that precedes it.
+        Returns:
+            list[range]: the step sequence numbers of each segment.
+        """
+        starts = []
+        for step_seq, step in enumerate(plan.steps):
+            if (
+                not starts
+                or step.beat.gongan_id != plan.steps[starts[-1]].beat.gongan_id
+                or step.beat.id <= plan.steps[starts[-1]].beat.id
+            ):
+                starts.append(step_seq)
+        return [range(start, end) for start, end in zip(starts, starts[1:] + [len(plan.steps)])]
+
+    def _segment_content(self, position: Position, plan: ExecutionPlan, steps: range, notes: list[list[Note]]) -> tuple:
+        """Returns the notation content that determines the MIDI content of a segment, apart from
+        the state of the track. See the segment_cache module.
+        Args:
+            notes (list[list[Note]]): the notes of each step of the segment, see `_pass_notes`.
+        """
+        dynamics = plan.dynamics_for(position)
+        content = []
+        for step_seq, step_notes in zip(steps, notes):
+            step = plan.steps[step_seq]
+            beat = step.beat
+            partinfo = self.score.gongans[beat.gongan_seq].metadata[MetaType.PART]
+            content.append(
+                (
+                    beat.full_id,
+                    beat.duration,
+                    step.pass_nr,
+                    step.iteration,
+                    plan.tempo.values(step_seq),
+                    dynamics.values(step_seq),
+                    partinfo[0].name if partinfo else None,
+                    all(note.pitch == Pitch.NONE for note in beat.get_notes(position, DEFAULT)),
+                    tuple(
+                        (
+                            note.position,
+                            note.pitch,
+                            note.octave,
+                            note.effect,
+                            note.relative_velocity,
+                            note.note_value,
+                            note.sustaintype,
+                        )
+                        for note in step_notes
+                    ),
+                )
+            )
+        return tuple(content)
+
+    def _notation_to_track(
+        self, position: Position, plan: ExecutionPlan
+    ) -> tuple[MidiTrackX, dict[str, int], dict[bytes, TrackSegment]]:
+        """Generates the MIDI content for a single instrument position. If a segment cache is available,
+        segments that are found in the cache are not generated again.
 
         Args:
-            score (Score): The object model containing the notation.
             position (Position): the instrument position
+            plan (ExecutionPlan): the unrolled execution flow of the score.
 
         Returns:
-            MidiTrack: MIDI track for the instrument.
+            tuple[MidiTrackX, dict[str, int], dict[bytes, TrackSegment]]: MIDI track for the instrument,
+                    the start time in ticks of each part, as encountered in this track, and the
+                    segments of the track by cache key (empty if there is no segment cache).
         """
+        markers: dict[str, int] = {}
+        segments: dict[bytes, TrackSegment] = {}
 
-        def reset_pass_counters():
-            self.exec_mgr.reset_all(position)
-
-        def store_part_info(beat: Beat):
-            # current_time_in_millis might be incorrect if the beat consists of only silences.
+        def store_part_info(beat: Beat, part_markers: list[tuple[str, int]], segment_ticktime: int):
+            # The current time might be incorrect if the beat consists of only silences.
             if all(note.pitch == Pitch.NONE for note in beat.get_notes(position, DEFAULT)):
                 return
             gongan = self.score.gongans[beat.gongan_seq]
             if partinfo := gongan.metadata[MetaType.PART]:
-                if self.part_info.markers.get(partinfo[0].name, None):
-                    # Return if the part has already been registered
-                    return
-                # curr_time = track.current_time_in_millis()
-                curr_time = track.current_millitime
-                self.part_info.markers[partinfo[0].name] = int(curr_time)
+                # Time relative to the start of the segment.
+                part_markers.append((partinfo[0].name, track.current_ticktime - segment_ticktime))
+
+        def register_part_markers(part_markers: list[tuple[str, int]], segment_ticktime: int):
+            for part, time in part_markers:
+                # Skip the part if it has already been registered
+                if not markers.get(part, None):
+                    markers[part] = segment_ticktime + time
 
         track = MidiTrackX(
             position=position,
@@ -99,73 +197,103 @@ class MidiGeneratorAgent(Agent):
             midi_dict=self.midi_dict,
             run_settings=self.run_settings,
         )
+        track_key = (position, track.channel, track.port, track.bank, track.preset, track.animate_helpinghand)
         # Add silence before the start of the piece, except if the piece should be played in a loop.
         if not self.run_settings.notationfile.part.loop:
             track.increase_current_time(self.run_settings.midi.silence_seconds_before_start, TimeUnit.SECOND)
 
-        reset_pass_counters()
-
-        # Select the first beat.
-        beat = self.exec_mgr.next_beat_in_flow()
-        # beat = self.score.gongans[0].beats[0]
-        temp = []
+        track.set_expression_timelines(plan.tempo, plan.dynamics_for(position))
         flow = []
-        while beat:
-            if not temp or (beat.gongan_id != temp[-1].gongan_id) or (beat.id <= temp[-1].id):
-                temp.append(beat)
-                flow.append(beat.gongan_id)
-            # self.loginfo(f"beat={beat.full_id}")
-            # Add a marker with the beat full_id for easier debugging when running the integration test.
-            if self.run_settings.options.notation_to_midi.is_integration_test:
-                track.marker(f"b_{beat.full_id}")
-            # If a new part is encountered, store timestamp and name in the midiplayer_data section of the score
-            store_part_info(beat)
-            # beat.flow.incr_pass_counter(Flow.FlowType.GOTO)
-            if self.run_settings.options.debug_logging:
-                track.comment(
-                    f"beat {beat.full_id} pass{self.exec_mgr.goto(beat).counter} "
-                    f"loop{self.exec_mgr.loop(beat).counter if self.exec_mgr.loop(beat) else "-"}"
-                )
-            # Set new beat info.
-            start_bpm, end_bpm = self.exec_mgr.get_tempo_values()
-            start_velocity, end_velocity = self.exec_mgr.get_dynamics_values()
-            beat_info = BeatInfo(
-                fullid=beat.full_id,
-                start_bpm=start_bpm,
-                end_bpm=end_bpm,
-                start_velocity=start_velocity,
-                end_velocity=end_velocity,
-                duration=beat.duration,
-            )
-            track.set_beat_info(beat_info)
-
-            # Process individual notes.
-            try:
-                # TODO: create function Beat.next_beat_in_flow()
-                if self.exec_mgr.goto(beat):
-                    pass_ = beat.measures[position].passes.get(
-                        self.exec_mgr.goto(beat).counter, beat.measures[position].passes[DEFAULT]
+        for steps in self._segments(plan):
+            flow.append(plan.steps[steps.start].beat.gongan_id)
+            notes = [self._pass_notes(position, plan.steps[step_seq]) for step_seq in steps]
+            segment_ticktime = track.current_ticktime
+            if self.segment_cache:
+                key = digest(track_key, track.segment_state(), self._segment_content(position, plan, steps, notes))
+                if segment := segments.get(key, None) or self.segment_cache.get(key):
+                    track.splice_segment(segment)
+                    register_part_markers(segment.part_markers, segment_ticktime)
+                    segments[key] = segment
+                    continue
+                mark = track.mark_segment()
+
+            part_markers = []
+            for step_seq, step_notes in zip(steps, notes):
+                step = plan.steps[step_seq]
+                beat = step.beat
+                # self.loginfo(f"beat={beat.full_id}")
+                # Add a marker with the beat full_id for easier debugging when running the integration test.
+                if self.run_settings.options.notation_to_midi.is_integration_test:
+                    track.marker(f"b_{beat.full_id}")
+                # If a new part is encountered, store timestamp and name in the midiplayer_data section of the score
+                store_part_info(beat, part_markers, segment_ticktime)
+                if self.run_settings.options.debug_logging:
+                    track.comment(
+                        f"beat {beat.full_id} pass{step.pass_nr} "
+                        f"loop{step.iteration if step.iteration != DEFAULT else "-"}"
                     )
-                else:
-                    pass_ = beat.measures[position].passes[DEFAULT]
-            except KeyError:
-                self.logerror(f"No measure found for {position} in beat {beat.full_id}. Program halted.")
-                sys.exit()
-            for note in pass_.notes:
-                # Add the note, or the pattern in case of a pattern.
-                if isinstance(note, Pattern):
-                    for pattern_note in note.pattern:
-                        track.add_note(pattern_note)
-                else:
+                # Set new beat info.
+                track.set_beat(beat.full_id, beat.duration, step_seq)
+
+                # Process individual notes.
+                for note in step_notes:
                     track.add_note(note)
-            beat = self.exec_mgr.next_beat_in_flow()
-            # TODO GOTO modify, also for freq type
+            register_part_markers(part_markers, segment_ticktime)
+
+            if self.segment_cache:
+                segment = track.collect_segment(mark)
+                segment.part_markers = part_markers
+                segments[key] = segment
 
         track.finalize()
         if position == Position.PEMADE_POLOS:
             self.loginfo(f"{flow=}")
 
-        return track
+        return track, markers, segments
+
+    def _register_part_markers(self, markers: dict[str, int]) -> None:
+        """Adds the part markers of a track to the part info. A part that has already been registered
+        by a preceding track is not updated."""
+        for part, time in markers.items():
+            if not self.part_info.markers.get(part, None):
+                self.part_info.markers[part] = time
+
+    def _generate_tracks(
+        self, positions: list[Position], plan: ExecutionPlan
+    ) -> list[tuple[MidiTrackX, dict[str, int], dict[bytes, TrackSegment]]]:
+        """Generates the MIDI tracks for the given positions. The tracks are generated in parallel if the
+        run settings specify more than one worker. The worker processes are forked to share the score and the
+        execution plan with the main process.
+
+        Args:
+            positions (list[Position]): the instrument positions.
+            plan (ExecutionPlan): the unrolled execution flow of the score.
+
+        Returns:
+            list[tuple[MidiTrackX, dict[str, int], dict[bytes, TrackSegment]]]: track, part markers and
+                    segments of each position, in the given order. See `_notation_to_track`.
+        """
+        global _forked_agent, _forked_plan  # pylint: disable=global-statement
+
+        workers = min(self.run_settings.options.notation_to_midi.track_workers, len(positions))
+        if workers > 1 and "fork" not in multiprocessing.get_all_start_methods():
+            self.logwarning(
+                "Parallel track generation is not supported on this platform. Tracks are generated serially."
+            )
+            workers = 1
+        if workers <= 1:
+            return [self._notation_to_track(position, plan) for position in positions]
+
+        _forked_agent, _forked_plan = self, plan
+        try:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork")) as executor:
+                # map returns the results in the same order as the positions.
+                results = list(executor.map(_notation_to_track_in_worker, positions))
+        finally:
+            _forked_agent = _forked_plan = None
+        for track, _, _ in results:
+            track.restore_shared_attributes(self.run_settings, self.midi_dict)
+        return results
 
     def sorted_markers_millis_to_frac(self, markers: dict[str, int], total_duration: int) -> dict[str, float]:
         """Converts the markers that indicate the start of parts of the composition from milliseconds to
@@ -188,6 +316,58 @@ class MidiGeneratorAgent(Agent):
             markers=self.sorted_markers_millis_to_frac(self.part_info.markers, self.score.midifile_duration),
         )
 
+    def _report_tempo_messages(self, tracks: list[MidiTrackX]) -> None:
+        """Logs the number of tempo messages that were saved by the adaptive tempo curve."""
+        tempo_track = next((track for track in tracks if track.name == MidiTrackX.TEMPO_TRACK_NAME), None)
+        if not tempo_track:
+            return
+        saved = tempo_track.grid_tempo_change_count - tempo_track.tempo_message_count
+        self.loginfo(
+            f"Tempo curve {self.run_settings.midi.tempo_curve} (tolerance {self.run_settings.midi.tempo_tolerance}): "
+            f"{tempo_track.tempo_message_count} tempo messages instead of {tempo_track.grid_tempo_change_count}, "
+            f"{saved} saved."
+        )
+
+    def _save_helpinghand_timeline(self, tracks: list[MidiTrackX]) -> None:
+        """Saves the helping hand events of all animated tracks as a compact JSON timeline."""
+        timeline = {
+            "fields": HELPINGHAND_TIMELINE_FIELDS,
+            "tracks": {track.name: track.helpinghand_timeline() for track in tracks if track.animate_helpinghand},
+        }
+        self.run_settings.output_sink.write(
+            OutputKind.HELPINGHAND,
+            self.run_settings.helpinghand_out_filepath,
+            json.dumps(timeline, separators=(",", ":")).encode("utf-8"),
+        )
+        self.logger.info("Helping hand timeline saved as %s", self.run_settings.helpinghand_out_filepath)
+
+    def _set_times(self, tracks: list[MidiTrackX]) -> None:
+        """Sets the duration of the MIDI file and converts the part markers from ticks to milliseconds.
+        The times are derived from the tempo changes in the tempo track, which yields the same result as
+        the `length` attribute of a mido MidiFile without having to merge all tracks."""
+        tempo_track = next((track for track in tracks if track.name == MidiTrackX.TEMPO_TRACK_NAME), None)
+        tempo_map = TempoMap(tempo_track.events.tempo_changes() if tempo_track else [], self.run_settings.midi.PPQ)
+        self.score.midifile_duration = int(tempo_map.seconds(max(track.total_tick_time() for track in tracks)) * 1000)
+        self.part_info.markers = {
+            part: int(tempo_map.seconds(ticktime) * 1000) for part, ticktime in self.part_info.markers.items()
+        }
+
+    def _open_segment_cache(self) -> SegmentCache | None:
+        """Opens the MIDI segment cache of the notation part, if a cache folder has been set in the run settings.
+        The cache is only valid for the current MIDI settings and note definitions."""
+        filepath = self.run_settings.midi_segment_cache_filepath
+        if not filepath:
+            return None
+        return SegmentCache(
+            filepath,
+            self.run_settings.midi.model_dump(),
+            self.run_settings.midiplayer.model_dump(),
+            self.run_settings.options.debug_logging,
+            self.run_settings.options.notation_to_midi.is_integration_test,
+            self.run_settings.notationfile.part.loop,
+            sorted((repr(key), midinotes) for key, midinotes in self.midi_dict.items()),
+        )
+
     @override
     def _main(self) -> PartForm:
         """Generates the MIDI content and saves it to file.
@@ -197,17 +377,41 @@ class MidiGeneratorAgent(Agent):
 
         """
         # TODO Error handling and return False if error occurred
-        midifile = MidiFile(ticks_per_beat=self.run_settings.midi.PPQ, type=1)
+        # Unroll the execution flow once, unless this has already been done by the flow analysis.
+        # All tracks share the resulting plan.
+        plan = self.exec_mgr.plan or self.exec_mgr.create_execution_plan()
+        if not plan.complete:
+            self.logerror("The execution flow never ends. Run the flow analysis for more information.")
+            return None
 
-        for position in sorted(self.score.instrument_positions, key=lambda x: x.sequence):
-            track = self._notation_to_track(position)
-            midifile.tracks.append(track)
+        positions = sorted(self.score.instrument_positions, key=lambda x: x.sequence)
+        self.segment_cache = self._open_segment_cache()
+        tracks: list[MidiTrackX] = []
+        segments: dict[bytes, TrackSegment] = {}
+        for track, markers, track_segments in self._generate_tracks(positions, plan):
+            self._register_part_markers(markers)
+            tracks.append(track)
+            segments |= track_segments
+        if self.segment_cache:
+            reused = sum(1 for key in segments if key in self.segment_cache.segments)
+            self.loginfo(f"Reused {reused} of {len(segments)} MIDI segments from the segment cache.")
+            self.segment_cache.save(segments)
+        if self.run_settings.midi.tempo_curve is not TempoCurve.FIXED:
+            self._report_tempo_messages(tracks)
         if not self.run_settings.notationfile.part.loop:
-            self._add_attenuation_time(midifile.tracks, seconds=self.run_settings.midi.silence_seconds_after_end)
-        self.score.midifile_duration = int(midifile.length * 1000)
-
-        midifile.save(self.run_settings.midi_out_filepath)
+            self._add_attenuation_time(tracks, seconds=self.run_settings.midi.silence_seconds_after_end)
+        self._set_times(tracks)
+
+        with self.run_settings.output_sink.open(OutputKind.MIDI, self.run_settings.midi_out_filepath) as outfile:
+            if self.run_settings.options.notation_to_midi.midi_encoder is MidiEncoder.MIDO:
+                MidiFile(
+                    ticks_per_beat=self.run_settings.midi.PPQ, type=1, tracks=[track.to_mido() for track in tracks]
+                ).save(file=outfile)
+            else:
+                write_midifile(outfile, [track.events for track in tracks], self.run_settings.midi.PPQ)
         self.logger.info("File saved as %s", self.run_settings.midi_out_filepath)
+        if self.run_settings.midiplayer.helpinghand_output is HelpingHandOutput.SIDECAR:
+            self._save_helpinghand_timeline(tracks)
 
         if self.has_errors:
             return None
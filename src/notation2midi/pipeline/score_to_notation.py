@@ -1,18 +1,26 @@
 import csv
+import io
+import os
 from os import path
-from typing import override
-
-import pandas as pd
+from typing import Iterator, override
 
 from src.common.classes import Gongan
 from src.common.constants import ParserTag, Position
-from src.common.notes import Note
+from src.common.notes import Note, Pattern
+from src.common.output_sinks import OutputKind
 from src.notation2midi.classes import Agent
 from src.notation2midi.execution.execution import Score
+from src.notation2midi.score2notationutils.manifest import (
+    export_is_up_to_date,
+    record_export,
+    score_fingerprint,
+)
 from src.notation2midi.score2notationutils.utils import aggregate_positions, is_silent
 from src.settings.classes import RunSettings
 from src.settings.constants import InstrumentFields
 
+COMMENT_TAG = "comment"  # Tag of a comment line in the notation grammar
+
 
 class ScoreToNotationAgent(Agent):
     """Saves a corrected version of the notation input file"""
@@ -20,10 +28,12 @@ class ScoreToNotationAgent(Agent):
     LOGGING_MESSAGE = "EXPORTING CORRECTED NOTATION"
     EXPECTED_INPUT_TYPES = (Agent.InputOutputType.GENERICSCORE,)
     RETURN_TYPE = None
+    # Increase this value when a code change changes the content of the corrected notation.
+    FORMAT_VERSION = 1
 
-    def __init__(self, complete_score: Score):
-        super().__init__(complete_score.settings)
-        self.score = complete_score
+    def __init__(self, generic_score: Score):
+        super().__init__(generic_score.settings)
+        self.score = generic_score
 
     @override
     @classmethod
@@ -31,7 +41,7 @@ class ScoreToNotationAgent(Agent):
         return run_settings.options.notation_to_midi.save_corrected_to_file
 
     def _notelist_to_string(self, notelist: list[Note]) -> str:  # here: gongan_to_records, test_utils
-        return "".join((n.symbol for n in notelist if not n.autogenerated))
+        return "".join((n.symbol for n in notelist if isinstance(n, Pattern) or not n.autogenerated))
 
     def _gongan_to_records(self, gongan: Gongan) -> list[dict[Position | int, list[str]]]:
         """Converts a gongan to a dict containing the notation for the individual beats.
@@ -49,7 +59,8 @@ class ScoreToNotationAgent(Agent):
             [{InstrumentFields.POSITION: ParserTag.COMMENTS, 1: comment} for comment in gongan.comments]
             + [
                 {InstrumentFields.POSITION: ParserTag.METADATA, 1: metadata.model_dump_notation()}
-                for metadata in gongan.metadata.values()
+                for metalist in gongan.metadata.values()
+                for metadata in metalist
             ]
             + [
                 {
@@ -66,6 +77,32 @@ class ScoreToNotationAgent(Agent):
 
         return result
 
+    def _beat_columns(self) -> list[int]:
+        """Returns the beat columns of the notation file in order of first appearance. Comments and metadata
+        are written in the column of the first beat.
+        """
+        columns = {}
+        for gongan in self.score.gongans:
+            if gongan.comments or any(gongan.metadata.values()):
+                columns.setdefault(1)
+            for beat in gongan.beats:
+                columns.setdefault(beat.id)
+        return list(columns)
+
+    def _gongan_to_rows(self, gongan: Gongan, columns: list[int]) -> Iterator[list[str]]:
+        """Converts a gongan to rows of the notation file. Each row contains a value for each of the given columns.
+        Args:
+            gongan (Gongan): gongan to convert
+            columns (list[int]): the beat columns of the notation file, see _beat_columns.
+        """
+        for record in self._gongan_to_records(gongan):
+            if record[InstrumentFields.POSITION] == ParserTag.COMMENTS:
+                # A comment can contain tabs, which are written as cell separators to retain the original layout.
+                cells = record[1].rstrip("\t").split("\t")
+                yield [COMMENT_TAG] + cells + [""] * (len(columns) - len(cells))
+            else:
+                yield [record[InstrumentFields.POSITION]] + [record.get(column, "") for column in columns]
+
     @override
     def _main(self) -> None:  # score_validation
         """Converts a validated (and optionally corrected) score object back to the
@@ -73,8 +110,31 @@ class ScoreToNotationAgent(Agent):
         Args:
             score (Score): The score
         """
-        score_dict = sum((self._gongan_to_records(gongan) for gongan in self.score.gongans), [])
-        score_df = pd.DataFrame.from_records(score_dict)
         fpath, ext = path.splitext(self.score.settings.notation_filepath)
         filepath = fpath + "_CORRECTED" + ext
-        score_df.to_csv(filepath, sep="\t", index=False, header=False, quoting=csv.QUOTE_NONE)
+        fingerprint = None
+        if self.run_settings.options.notation_to_midi.skip_unchanged_exports:
+            fingerprint = score_fingerprint(self.score, self.FORMAT_VERSION)
+            if export_is_up_to_date(self.run_settings, filepath, fingerprint):
+                self.loginfo("Corrected notation %s is up to date, skipping the export.", filepath)
+                return
+            self.loginfo("Corrected notation %s is missing or out of date.", filepath)
+        # The notation is converted one gongan at a time. The column layout is determined beforehand so that
+        # each row can be written immediately. The output sink only replaces an existing file once the conversion
+        # has succeeded, so that a failed conversion does not truncate it.
+        columns = self._beat_columns()
+        try:
+            with self.score.settings.output_sink.open(OutputKind.NOTATION, filepath) as outfile:
+                textfile = io.TextIOWrapper(outfile, encoding="utf-8", newline="")
+                try:
+                    writer = csv.writer(textfile, delimiter="\t", lineterminator=os.linesep, quoting=csv.QUOTE_NONE)
+                    for gongan in self.score.gongans:
+                        writer.writerows(self._gongan_to_rows(gongan, columns))
+                finally:
+                    # Flushes the text and prevents the wrapper from closing the stream of the sink.
+                    textfile.detach()
+        except csv.Error as e:
+            self.logerror("Could not export the corrected notation to %s: %s", filepath, str(e))
+            return
+        if fingerprint:
+            record_export(self.run_settings, filepath, fingerprint)
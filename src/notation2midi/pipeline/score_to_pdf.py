@@ -5,14 +5,15 @@ from __future__ import annotations
 import html
 import itertools
 import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from typing import Callable, override
 
 from reportlab.lib.enums import TA_RIGHT
 from reportlab.lib.styles import ParagraphStyle
 from reportlab.lib.units import cm
-from reportlab.pdfbase.pdfmetrics import registerFont, stringWidth
-from reportlab.pdfbase.ttfonts import TTFont
-from reportlab.platypus import Paragraph, TableStyle
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from reportlab.platypus import Paragraph, Table, TableStyle
 
 from src.common.classes import Gongan
 from src.common.constants import Modifier, Position
@@ -37,6 +38,11 @@ from src.notation2midi.score2notationutils.formatting import (
     SpanType,
     TableContent,
 )
+from src.notation2midi.score2notationutils.manifest import (
+    export_is_up_to_date,
+    record_export,
+    score_fingerprint,
+)
 from src.notation2midi.score2notationutils.utils import (
     aggregate_positions,
     clean_staves,
@@ -46,6 +52,20 @@ from src.notation2midi.score2notationutils.utils import (
 from src.settings.classes import RunSettings
 from src.settings.constants import FontFields
 
+_forked_agent: "PDFGeneratorAgent" = None
+_forked_gongans: list[Gongan] = None
+
+
+def _gongan_tables_in_worker(chunk: tuple[int, int, int]) -> list[Table | None]:
+    """Creates the tables of a range of gongans in a worker process. See PDFGeneratorAgent._gongan_tables.
+    Args:
+        chunk (tuple[int, int, int]): start and stop index of the range and the tempo state at its start.
+    """
+    start, stop, tempo = chunk
+    _forked_agent.template.current_tempo = tempo
+    # pylint: disable-next=protected-access
+    return [_forked_agent._gongan_table(gongan) for gongan in _forked_gongans[start:stop]]
+
 
 class PDFGeneratorAgent(Agent):
     """PDF generator"""
@@ -66,7 +86,6 @@ class PDFGeneratorAgent(Agent):
         self.template = NotationTemplate(self.score.settings)
         self.current_tempo = -1
         self.current_dynamics = -1  # Not used currently
-        registerFont(TTFont("Bali Music 5", self.run_settings.configdata.font.ttf_filepath))
         self.story = []
         self.omit_octave_diacritics = self.run_settings.pdf_converter.omit_octave_diacritics
         self.octave_diacritics = [
@@ -280,6 +299,14 @@ class PDFGeneratorAgent(Agent):
                 content.data[-1][1] = Paragraph(text=html.escape(f"{comment}"), style=self.template.commentStyle)
         return content
 
+    @staticmethod
+    def _metadata_lists(gongan: Gongan) -> dict[type, list[MetaData]]:
+        """Groups the metadata of the gongan by class."""
+        metaclasses = {meta.__class__ for meta in gongan.metadata}
+        return {
+            metaclass: [meta for meta in gongan.metadata if meta.__class__ == metaclass] for metaclass in metaclasses
+        }
+
     def _append_metadata(self, content: TableContent, gongan: Gongan, above_notation: bool) -> TableContent:
         """Adds the gongan metadata and comments that should appear above or below the notation part.
         Only processes the metadata that is meaningful for the PDF notation. E.g. ValidationMeta,
@@ -289,10 +316,7 @@ class PDFGeneratorAgent(Agent):
             gongan (Gongan): the gongan to which the metadata belongs
             above_notation (bool): Selects which metadata to generate
         """
-        metaclasses = {meta.__class__ for meta in gongan.metadata}
-        metadict = {
-            metaclass: [meta for meta in gongan.metadata if meta.__class__ == metaclass] for metaclass in metaclasses
-        }
+        metadict = self._metadata_lists(gongan)
         if above_notation:
             # Content that should occur before the notation part of the gongan
             # still to add: SuppressMeta
@@ -421,57 +445,125 @@ class PDFGeneratorAgent(Agent):
             comment_table = self.template.create_table(content)
             self.story.append(comment_table)
 
-        for gongan in self.gongan_iterator(self.score):
-            if not gongan.beats:
-                continue
+        gongans = [gongan for gongan in self.score.gongans if gongan.beats]
+        self.story.extend(table for table in self._gongan_tables(gongans) if table)
+        self.template.build(self.story)
 
-            # Determine the column widths
-            staves_dict = clean_staves(gongan)
-            colwidths = self._gongan_colwidths(staves_dict, include_overflow_col=True)
-
-            # Create an empty content container and add the metadata that should appear above
-            # the gongan notation
-            content = TableContent(data=[], colwidths=colwidths, style=[], template=self.template)
-            content = self._append_metadata(content, gongan=gongan, above_notation=True)
-
-            # Add the gongan notation
-            pos_tags = aggregate_positions(gongan)
-            notation_data = self._staves_to_tabledata(staves_dict, pos_tags, gongan.id, add_overflow_col=True)
-            if notation_data:
-                row1, row2 = len(content.data), len(content.data) + len(notation_data) - 1
-                content.append(
-                    TableContent(
-                        data=notation_data,
-                        rowtypes=[RowType.NOTATION] * len(notation_data),
-                        colwidths=colwidths,
-                        rowheights=[self.template.notation_row_height + self.template.cell_padding_TB * 2]
-                        * len(notation_data),
-                        # If gongan has no kempli beat, the beats will be separated by dotted lines.
-                        style=(
-                            self.template.notationTableStyle(row1, row2)
-                            if has_kempli_beat(gongan)
-                            else self.template.notationNoKempliTableStyle(row1, row2)
-                        ),
-                        template=self.template,
-                    )
+    def _gongan_table(self, gongan: Gongan) -> Table | None:
+        """Creates the table containing the notation and the metadata of a gongan.
+        Returns:
+            Table | None: the table or None if there is nothing to display.
+        """
+        self.curr_gongan_id, self.curr_beat_id = gongan.id, None
+        # Determine the column widths
+        staves_dict = clean_staves(gongan)
+        colwidths = self._gongan_colwidths(staves_dict, include_overflow_col=True)
+
+        # Create an empty content container and add the metadata that should appear above
+        # the gongan notation
+        content = TableContent(data=[], colwidths=colwidths, style=[], template=self.template)
+        content = self._append_metadata(content, gongan=gongan, above_notation=True)
+
+        # Add the gongan notation
+        pos_tags = aggregate_positions(gongan)
+        notation_data = self._staves_to_tabledata(staves_dict, pos_tags, gongan.id, add_overflow_col=True)
+        if notation_data:
+            row1, row2 = len(content.data), len(content.data) + len(notation_data) - 1
+            content.append(
+                TableContent(
+                    data=notation_data,
+                    rowtypes=[RowType.NOTATION] * len(notation_data),
+                    colwidths=colwidths,
+                    rowheights=[self.template.notation_row_height + self.template.cell_padding_TB * 2]
+                    * len(notation_data),
+                    # If gongan has no kempli beat, the beats will be separated by dotted lines.
+                    style=(
+                        self.template.notationTableStyle(row1, row2)
+                        if has_kempli_beat(gongan)
+                        else self.template.notationNoKempliTableStyle(row1, row2)
+                    ),
+                    template=self.template,
                 )
+            )
 
-            # Add the metadata that should appear below gongan notation
-            content = self._append_metadata(content, gongan, above_notation=False)
+        # Add the metadata that should appear below gongan notation
+        content = self._append_metadata(content, gongan, above_notation=False)
 
-            # Create and append the gongan table
-            if content.data:
-                gongan_table = self.template.create_table(content)
-                self.story.append(gongan_table)
-        self.template.doc.build(self.story)
+        # Create the gongan table
+        if content.data:
+            return self.template.create_table(content)
+        return None
+
+    def _tempo_states(self, gongans: list[Gongan]) -> list[int]:
+        """Returns the value of the template's current_tempo attribute at the start of each gongan. This value
+        determines how the tempo metadata are displayed (see NotationTemplate._gradual_change_formatter_rml_safe)."""
+        tempo = self.template.current_tempo
+        states = []
+        for gongan in gongans:
+            states.append(tempo)
+            for meta in self._metadata_lists(gongan).get(MetaType.TEMPO, []):
+                tempo = getattr(meta, meta.DEFAULTPARAM)
+        return states
+
+    def _gongan_tables(self, gongans: list[Gongan]) -> list[Table | None]:
+        """Creates the tables of the given gongans. The tables are created in parallel if the run settings specify
+        more than one PDF worker. Each worker process handles a range of consecutive gongans. The worker processes
+        are forked to share the score with the main process. The tables are laid out on the pages afterwards, in a
+        single pass: the position of each table depends on the size of the preceding tables.
+        Returns:
+            list[Table | None]: the table of each gongan, in the given order. See `_gongan_table`.
+        """
+        global _forked_agent, _forked_gongans  # pylint: disable=global-statement
+
+        workers = min(self.run_settings.options.notation_to_midi.pdf_workers, len(gongans))
+        if workers > 1 and "fork" not in multiprocessing.get_all_start_methods():
+            self.logwarning(
+                "Parallel PDF generation is not supported on this platform. Gongans are processed serially."
+            )
+            workers = 1
+        if workers <= 1:
+            return [self._gongan_table(gongan) for gongan in gongans]
+
+        bounds = [len(gongans) * worker // workers for worker in range(workers + 1)]
+        tempo_states = self._tempo_states(gongans)
+        chunks = [(start, stop, tempo_states[start]) for start, stop in zip(bounds, bounds[1:])]
+        _forked_agent, _forked_gongans = self, gongans
+        try:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork")) as executor:
+                # map returns the results in the same order as the chunks.
+                results = list(executor.map(_gongan_tables_in_worker, chunks))
+        finally:
+            _forked_agent = _forked_gongans = None
+        return list(itertools.chain.from_iterable(results))
+
+    def _fingerprint(self) -> str:
+        """Fingerprint of the PDF content, see the manifest module."""
+        return score_fingerprint(
+            self.score,
+            NotationTemplate.TEMPLATE_VERSION,
+            self.template.title,
+            self.template.datestamp,
+            self.run_settings.pdf_converter.model_dump_json(),
+            self.run_settings.configdata.font.model_dump_json(),
+            self.octave_diacritics,
+        )
 
     @override
     def _main(self):
         """Main method, creates the PDF notation file"""
+        fingerprint = None
+        if self.run_settings.options.notation_to_midi.skip_unchanged_exports:
+            fingerprint = self._fingerprint()
+            if export_is_up_to_date(self.run_settings, self.template.filepath, fingerprint):
+                self.loginfo("Notation file %s is up to date, skipping the export.", self.template.filepath)
+                return self.score.settings.pdf_out_file
+            self.loginfo("Notation file %s is missing or out of date.", self.template.filepath)
         self._convert_to_pdf()
         self.logger.info("Notation file saved as %s", self.template.filepath)
         if self.has_errors:
             return None
+        if fingerprint:
+            record_export(self.run_settings, self.template.filepath, fingerprint)
         return self.score.settings.pdf_out_file
 
 
@@ -7,18 +7,20 @@ from __future__ import annotations
 
 import html
 from dataclasses import dataclass, field
+from datetime import datetime
 from enum import Enum
 
 from reportlab.lib import colors
 from reportlab.lib.colors import HexColor
 from reportlab.lib.enums import TA_CENTER, TA_LEFT, TA_RIGHT
 from reportlab.lib.pagesizes import A4
-from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
+from reportlab.lib.styles import ParagraphStyle
 from reportlab.lib.units import cm
 from reportlab.pdfbase.pdfmetrics import registerFont, stringWidth
 from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.pdfgen.canvas import Canvas
 from reportlab.platypus import (
+    Flowable,
     Frame,
     PageTemplate,
     Paragraph,
@@ -27,6 +29,7 @@ from reportlab.platypus import (
     TableStyle,
 )
 
+from src.common.output_sinks import OutputKind
 from src.notation2midi.metadata_classes import (
     DynamicsMeta,
     GoToMeta,
@@ -46,6 +49,18 @@ from src.settings.classes import RunSettings
 # pylint: disable=missing-function-docstring
 
 
+# Font name -> TrueType file of the fonts that have been registered with reportlab by this process.
+_registered_fonts: dict[str, str] = {}
+
+
+def register_font(fontname: str, ttf_filepath: str) -> None:
+    """Registers a TrueType font with reportlab. Parsing the font file is skipped if the font has already been
+    registered with the same file."""
+    if _registered_fonts.get(fontname, None) != ttf_filepath:
+        registerFont(TTFont(fontname, ttf_filepath))
+        _registered_fonts[fontname] = ttf_filepath
+
+
 class SpanType(Enum):  # pylint: disable=missing-class-docstring
     RANGE = 1
     LAST_CELL = 2
@@ -132,6 +147,9 @@ class NotationTemplate:
     All text is formatted using Table objects. This facilitates horizontal alignment
     and enables to keep lines together on the same page by disallowing tables to be split."""
 
+    # Increase this value when a change of the layout code changes the content of the PDF documents.
+    TEMPLATE_VERSION = 1
+
     pagesize = A4
     page_width = pagesize[0]
     page_height = pagesize[1]
@@ -143,16 +161,23 @@ class NotationTemplate:
     cell_padding_LR = 0.1 * cm  # Left and right padding
     cell_padding_TB = 0 * cm  # Top and bottom padding (not needed due to `leading` attribute of para styles.)
     table_space_after = 0.5 * cm
+    notation_fontname = "Bali Music 5"
+    # Cache of calculated cell dimensions (see cell_width_height). The oldest entry is removed if the cache is full.
+    cell_size_cache_size = 4096
+    _cell_size_cache: dict[tuple[str, str, float], tuple[float, float]] = {}
+    # Paragraph styles for each combination of font file and PDF converter settings (see _init_styles).
+    _paragraph_styles_registry: dict[tuple[str, str], dict[str, ParagraphStyle]] = {}
 
     def __init__(self, run_settings: RunSettings):
         self.run_settings = run_settings
         self.title = self.run_settings.notationfile.title
         self.filepath = self.run_settings.pdf_out_filepath
-        self.datestamp = self.run_settings.notation_datetime.strftime(run_settings.pdf_converter.version_fmt).lower()
+        # The notation datetime is not available if the notation is passed in memory.
+        notation_datetime = self.run_settings.notation_datetime or datetime.now()
+        self.datestamp = notation_datetime.strftime(run_settings.pdf_converter.version_fmt).lower()
         self.current_tempo = -1
         self.doc = self._doc_template()
-        self.styles = getSampleStyleSheet()
-        registerFont(TTFont("Bali Music 5", self.run_settings.configdata.font.ttf_filepath))
+        register_font(self.notation_fontname, self.run_settings.configdata.font.ttf_filepath)
         self._init_styles()
         self.notation_row_height = max(
             self.cell_width_height(html.escape("a,a<a="), self.notationStyle)[1],
@@ -187,122 +212,136 @@ class NotationTemplate:
     def _later_page_template(self):
         return PageTemplate(id="Later", frames=[self._body_frame], autoNextPageTemplate=1, onPage=self._page_header)
 
+    @classmethod
+    def _create_paragraph_styles(cls) -> dict[str, ParagraphStyle]:
+        """Creates the paragraph styles. Returns a dict attribute name -> style."""
+        return {
+            "basicparaStyle": ParagraphStyle(
+                name="basicparaStyle",
+                fontName="Helvetica",
+                fontSize=11,
+                leading=12,
+                textColor=HexColor(0x000000),
+                alignment=TA_LEFT,
+            ),
+            "headerStyleTitle": ParagraphStyle(
+                name="headerStyleTitle",
+                fontName="Helvetica",
+                fontSize=11,
+                leading=12,
+                textColor=HexColor(0x80340D),
+                alignment=TA_LEFT,
+            ),
+            "headerStylePageNr": ParagraphStyle(
+                name="headerStylePageNr",
+                fontName="Helvetica",
+                fontSize=11,
+                leading=12,
+                textColor=HexColor(0x000000),
+                alignment=TA_CENTER,
+            ),
+            "headerStyleDateStamp": ParagraphStyle(
+                name="headerStyleDateStamp",
+                fontName="Helvetica",
+                fontSize=9,
+                leading=12,
+                textColor=HexColor(0x000000),
+                alignment=TA_RIGHT,
+            ),
+            "headerStyleHyperlink": ParagraphStyle(
+                name="headerStyleHyperlink",
+                fontName="Helvetica",
+                fontSize=9,
+                leading=11,
+                textColor=HexColor(0x000000),
+                alignment=TA_RIGHT,
+            ),
+            "notationStyle": ParagraphStyle(
+                name="notationStyle",
+                fontName=cls.notation_fontname,
+                fontSize=9,
+                leading=11,
+                textColor=HexColor(0x000000),
+                alignment=TA_LEFT,
+                wordWrap=False,
+                splitLongWords=False,
+            ),
+            "tagStyle": ParagraphStyle(
+                name="GamelanTag",
+                fontName="Helvetica-Bold",
+                fontSize=8,
+                leading=10,
+                textColor=HexColor(0x000000),
+                alignment=TA_LEFT,
+            ),
+            "commentStyle": ParagraphStyle(
+                name="GamelanComment",
+                fontName="Helvetica",
+                fontSize=9,
+                leading=11,
+                textColor=HexColor(0x808040),
+                alignment=TA_LEFT,
+            ),
+            "metadataSequenceStyle": ParagraphStyle(
+                name="GamelanSequence",
+                fontName="Helvetica",
+                fontSize=9,
+                leading=11,
+                textColor=HexColor(0x80340D),
+                alignment=TA_LEFT,
+            ),
+            "metadataPartStyle": ParagraphStyle(
+                name="GamelanPart",
+                fontName="Helvetica-Bold",
+                fontSize=11,
+                leading=12,
+                textColor=HexColor(0x000000),
+                alignment=TA_LEFT,
+            ),
+            "metadataDefaultStyle": ParagraphStyle(
+                name="GamelanMetadata",
+                fontName="Helvetica-Oblique",
+                fontSize=8,
+                leading=10,
+                textColor=HexColor(0x000000),
+                alignment=TA_LEFT,
+            ),
+            "metadataRepeatStyle": ParagraphStyle(
+                name="GamelanMetadataHilite",
+                fontName="Helvetica",
+                fontSize=9,
+                leading=11,
+                textColor=colors.blue,
+                alignment=TA_RIGHT,
+            ),
+            "metadataGotoStyle": ParagraphStyle(
+                name="GamelanMetadataHilite",
+                fontName="Helvetica",
+                fontSize=9,
+                leading=11,
+                textColor=colors.blue,
+                alignment=TA_RIGHT,
+            ),
+            "metadataLabelStyle": ParagraphStyle(
+                name="GamelanLabel",
+                fontName="Courier-Bold",
+                fontSize=9,
+                leading=11,
+                textColor=colors.blue,
+                alignment=TA_LEFT,
+            ),
+        }
+
     def _init_styles(self):
-        """Creates the paragraph and table styles and formats."""
-        self.basicparaStyle = ParagraphStyle(
-            name="basicparaStyle",
-            fontName="Helvetica",
-            fontSize=11,
-            leading=12,
-            textColor=HexColor(0x000000),
-            alignment=TA_LEFT,
-        )
-        self.headerStyleTitle = ParagraphStyle(
-            name="headerStyleTitle",
-            fontName="Helvetica",
-            fontSize=11,
-            leading=12,
-            textColor=HexColor(0x80340D),
-            alignment=TA_LEFT,
-        )
-        self.headerStylePageNr = ParagraphStyle(
-            name="headerStylePageNr",
-            fontName="Helvetica",
-            fontSize=11,
-            leading=12,
-            textColor=HexColor(0x000000),
-            alignment=TA_CENTER,
-        )
-        self.headerStyleDateStamp = ParagraphStyle(
-            name="headerStyleDateStamp",
-            fontName="Helvetica",
-            fontSize=9,
-            leading=12,
-            textColor=HexColor(0x000000),
-            alignment=TA_RIGHT,
-        )
-        self.headerStyleHyperlink = ParagraphStyle(
-            name="headerStyleHyperlink",
-            fontName="Helvetica",
-            fontSize=9,
-            leading=11,
-            textColor=HexColor(0x000000),
-            alignment=TA_RIGHT,
-        )
-        self.notationStyle = ParagraphStyle(
-            name="notationStyle",
-            fontName="Bali Music 5",
-            fontSize=9,
-            leading=11,
-            textColor=HexColor(0x000000),
-            alignment=TA_LEFT,
-            wordWrap=False,
-            splitLongWords=False,
-        )
-        self.tagStyle = ParagraphStyle(
-            name="GamelanTag",
-            fontName="Helvetica-Bold",
-            fontSize=8,
-            leading=10,
-            textColor=HexColor(0x000000),
-            alignment=TA_LEFT,
-        )
-        self.commentStyle = ParagraphStyle(
-            name="GamelanComment",
-            fontName="Helvetica",
-            fontSize=9,
-            leading=11,
-            textColor=HexColor(0x808040),
-            alignment=TA_LEFT,
-        )
-        self.metadataSequenceStyle = ParagraphStyle(
-            name="GamelanSequence",
-            fontName="Helvetica",
-            fontSize=9,
-            leading=11,
-            textColor=HexColor(0x80340D),
-            alignment=TA_LEFT,
-        )
-        self.metadataPartStyle = ParagraphStyle(
-            name="GamelanPart",
-            fontName="Helvetica-Bold",
-            fontSize=11,
-            leading=12,
-            textColor=HexColor(0x000000),
-            alignment=TA_LEFT,
-        )
-        self.metadataDefaultStyle = ParagraphStyle(
-            name="GamelanMetadata",
-            fontName="Helvetica-Oblique",
-            fontSize=8,
-            leading=10,
-            textColor=HexColor(0x000000),
-            alignment=TA_LEFT,
-        )
-        self.metadataRepeatStyle = ParagraphStyle(
-            name="GamelanMetadataHilite",
-            fontName="Helvetica",
-            fontSize=9,
-            leading=11,
-            textColor=colors.blue,
-            alignment=TA_RIGHT,
-        )
-        self.metadataGotoStyle = ParagraphStyle(
-            name="GamelanMetadataHilite",
-            fontName="Helvetica",
-            fontSize=9,
-            leading=11,
-            textColor=colors.blue,
-            alignment=TA_RIGHT,
-        )
-        self.metadataLabelStyle = ParagraphStyle(
-            name="GamelanLabel",
-            fontName="Courier-Bold",
-            fontSize=9,
-            leading=11,
-            textColor=colors.blue,
-            alignment=TA_LEFT,
-        )
+        """Creates the paragraph and table styles and formats. The paragraph styles are created once per process
+        for each combination of font file and PDF converter settings and are shared by all templates."""
+        key = (self.run_settings.configdata.font.ttf_filepath, self.run_settings.pdf_converter.model_dump_json())
+        paragraph_styles = self._paragraph_styles_registry.get(key, None)
+        if paragraph_styles is None:
+            paragraph_styles = self._paragraph_styles_registry[key] = self._create_paragraph_styles()
+        for name, style in paragraph_styles.items():
+            setattr(self, name, style)
+
         self.metadataLabelCharStyle = '<font color="blue" size="9" face="Courier-Bold">'
         self.gonganIDFontName = "Courier"
         self.gonganIDFontSize = 7
@@ -439,6 +478,12 @@ class NotationTemplate:
             spaceAfter=self.table_space_after,
         )
 
+    def build(self, story: list[Flowable]) -> None:
+        """Renders the story and writes the document to the output sink of the run settings."""
+        with self.run_settings.output_sink.open(OutputKind.PDF, self.filepath) as outfile:
+            self.doc.filename = outfile
+            self.doc.build(story)
+
     def format_text_rml_safe(self, text: str, charstyle: str):
         """Applies a HTML character format to the text"""
         if charstyle:
@@ -599,17 +644,42 @@ class NotationTemplate:
         The function takes text wrapping and cell padding into account and returns the actual width and height
         of the text.
         The default value for `width` will return the actual text width + cell padding (10e6 pt > 138.000 inches).
+        Notation cells often contain the same text, so the results are cached. Paragraph styles are identified
+        by their name.
         Args:
             rml_safe_text (str): the text to evaluate. The text should be rml safe (formatted with html.escape).
             parastyle (ParagraphStyle): style to apply to the text.
             width (int, optional): available width. Defaults to 10e6.
         Returns:
-            tuple[int]: _description_
+            tuple[int]: width and height of the cell.
         """
         if rml_safe_text == "":
             return 0, 0
-        height = 10e6
+        key = (rml_safe_text, parastyle.name, width)
+        size = cls._cell_size_cache.get(key, None)
+        if size is None:
+            size = cls._calculate_cell_width_height(rml_safe_text, parastyle, width)
+            if len(cls._cell_size_cache) >= cls.cell_size_cache_size:
+                del cls._cell_size_cache[next(iter(cls._cell_size_cache))]
+            cls._cell_size_cache[key] = size
+        return size
+
+    @classmethod
+    def _calculate_cell_width_height(
+        cls, rml_safe_text: str, parastyle: ParagraphStyle, width: int
+    ) -> tuple[float, float]:
+        """Calculates the cell dimensions, see cell_width_height."""
         avail_width = width - 2 * cls.cell_padding_LR
+        if parastyle.fontName == cls.notation_fontname and not any(
+            char == "<" or char.isspace() for char in rml_safe_text
+        ):
+            # The text consists of a single word without markup, which results in a single line regardless of the
+            # available width. The width can be determined without wrapping the text in a Paragraph.
+            # Paragraph derives the line width from the remaining space: the same calculation yields the same value.
+            text_width = stringWidth(html.unescape(rml_safe_text), parastyle.fontName, parastyle.fontSize)
+            act_w = avail_width - (avail_width - text_width) + 2 * cls.cell_padding_LR
+            return (act_w, parastyle.leading + 2 * cls.cell_padding_TB)
+        height = 10e6
         para = Paragraph(rml_safe_text, parastyle)
         act_h = para.wrap(avail_width, height)[1] + 2 * cls.cell_padding_TB
         act_w = max(para.getActualLineWidths0()) + 2 * cls.cell_padding_LR
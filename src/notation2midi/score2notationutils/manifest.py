@@ -0,0 +1,117 @@
+"""Export manifest, which enables to skip the export of documents that would not change.
+The manifest is a JSON file in the output folder that contains a fingerprint of each exported document. The
+fingerprint combines the content of the score with the settings and the version of the exporting code.
+An export can be skipped if the document still exists and its fingerprint is equal to the one in the manifest.
+"""
+
+import json
+import os
+
+from src.common.classes import Score
+from src.common.notes import GenericNote
+from src.common.output_sinks import FileSink
+from src.notation2midi.metadata_classes import MetaData, MetaType
+from src.notation2midi.midi.segment_cache import digest
+from src.settings.classes import RunSettings
+
+MANIFEST_FILENAME = "export_manifest.json"
+
+
+def _note_content(note: GenericNote) -> tuple:
+    """Returns the attribute values of a note or a pattern, omitting its unique id."""
+    return tuple(
+        tuple(_note_content(patternnote) for patternnote in value) if name == "pattern" else value
+        for name, value in note
+        if name != "uuid"
+    )
+
+
+def _metadata_content(metadata: dict[MetaType, list[MetaData]]) -> list[tuple]:
+    """Returns the content of the metadata in a fixed order, omitting the input line numbers."""
+    # repr is used rather than JSON because some metadata fields can contain values that cannot be serialized.
+    # Empty lists are omitted: they are added to the metadata defaultdict by any agent that looks up a metadata type.
+    return sorted(
+        (metatype, [repr(meta.model_dump(exclude={"line"})) for meta in metalist])
+        for metatype, metalist in metadata.items()
+        if metalist
+    )
+
+
+def score_fingerprint(score: Score, *settings) -> str:
+    """Returns a fingerprint of the score content and the given settings. Input line numbers are ignored.
+    Args:
+        score (Score): the score to export.
+        settings: values, other than the score, that determine the content of the exported document.
+    Returns:
+        str: hexadecimal fingerprint.
+    """
+    content = [
+        score.title,
+        sorted(score.instrument_positions or []),
+        score.global_comments,
+        _metadata_content(score.global_metadata),
+    ]
+    for gongan in score.gongans:
+        content.append(
+            (
+                gongan.id,
+                gongan.gongantype,
+                gongan.comments,
+                _metadata_content(gongan.metadata),
+                [
+                    (
+                        beat.id,
+                        beat.has_kempli_beat,
+                        sorted(
+                            (
+                                position,
+                                sorted(
+                                    (passid, pass_.autogenerated, [_note_content(note) for note in pass_.notes or []])
+                                    for passid, pass_ in measure.passes.items()
+                                ),
+                            )
+                            for position, measure in beat.measures.items()
+                        ),
+                    )
+                    for beat in gongan.beats
+                ],
+            )
+        )
+    return digest(content, *settings).hex()
+
+
+def _manifest_filepath(filepath: str) -> str:
+    return os.path.join(os.path.dirname(filepath), MANIFEST_FILENAME)
+
+
+def _read_manifest(filepath: str) -> dict[str, str]:
+    try:
+        with open(_manifest_filepath(filepath), "r", encoding="utf-8") as manifestfile:
+            return json.load(manifestfile)
+    except (OSError, ValueError):
+        return {}
+
+
+def export_is_up_to_date(run_settings: RunSettings, filepath: str, fingerprint: str) -> bool:
+    """Determines whether the export of a document can be skipped.
+    Args:
+        run_settings (RunSettings): the run settings. Exports are only skipped if the output is written to the
+                                    file system.
+        filepath (str): location of the document.
+        fingerprint (str): fingerprint of the document content, see score_fingerprint.
+    Returns:
+        bool: True if the document exists and was exported with the same fingerprint.
+    """
+    if not isinstance(run_settings.output_sink, FileSink) or not os.path.exists(filepath):
+        return False
+    return _read_manifest(filepath).get(os.path.basename(filepath), None) == fingerprint
+
+
+def record_export(run_settings: RunSettings, filepath: str, fingerprint: str) -> None:
+    """Saves the fingerprint of an exported document in the manifest of its folder."""
+    if not isinstance(run_settings.output_sink, FileSink):
+        return
+    manifest = _read_manifest(filepath)
+    manifest[os.path.basename(filepath)] = fingerprint
+    with open(_manifest_filepath(filepath), "w", encoding="utf-8") as manifestfile:
+        json.dump(manifest, manifestfile, indent=4, sort_keys=True)
@@ -6,7 +6,7 @@ from functools import partial
 
 from src.common.classes import Gongan
 from src.common.constants import Pitch, Position, Stroke
-from src.common.notes import Note, NoteFactory, Pattern, Tone
+from src.common.notes import GenericNote, Note, NoteFactory, Pattern, Tone
 from src.notation2midi.metadata_classes import (
     GonganType,
     MetaData,
@@ -148,52 +148,37 @@ def is_silent(gongan: Gongan, position: Position, passid: PassID) -> bool:  # he
     return no_occurrence or all_rests
 
 
-def same(note1: Note, note2: Note) -> bool:
-    """Compares two notes.
-    Args:
-        notes1 (list[Note]): first note to compare.
-        notes2 (list[Note]): second note to compare.
-    Returns:
-        bool: True if both notes have the same pitch, octave, stroke, duration, rest after and velocity.
-    """
-    return (
-        note1.pitch == note2.pitch
-        and note1.octave == note2.octave
-        and note1.effect == note2.effect
-        and note1.note_value == note2.note_value
-    )
+def note_key(note: GenericNote) -> tuple:
+    """Returns the attributes that determine whether two notes are the same."""
+    return (note.pitch, note.octave, note.effect, note.note_value)
 
 
-def equivalent(note1: Note, note2: Note, positions: list[Position], metadata: MetaData) -> bool:
-    """Determines if two notes correspond with each other by applying instrument transformation rules
-       to cast the notes to each other's position.
-       Returns true if the notes are equivalent, e.g. if a sangsih note is the kempyung of a polos note.
+def cast_note_key(note: GenericNote, position: Position, positions: list[Position], metadata: MetaData) -> tuple | None:
+    """Applies the instrument transformation rules to cast a note to the given position.
     Args:
-        notes1 (list[Note]): first note to compare.
-        notes2 (list[Note]): second note to compare.
+        note (GenericNote): note to cast.
+        position (Position): position to which the note should be cast.
         positions (list[Position]): positions that should be involved in the instrument rules.
     Returns:
-        bool: True if the notes are equivalent
+        tuple | None: the note_key of the cast note, or None if the note has no equivalent for the position.
     """
-    if note2.is_melodic():
+    if note.is_melodic():
         transformation = RuleCastToPosition.cast_to_position(
-            note=note2, position=note1.position, all_positions=positions, metadata=metadata
+            note=note, position=position, all_positions=positions, metadata=metadata
         )
         if not transformation:
-            return False
-        tone2cast: Tone = transformation.tone
+            return None
+        tonecast: Tone = transformation.tone
         try:
-            note2cast = NoteFactory.clone_note(
-                note2, pitch=tone2cast.pitch, octave=tone2cast.octave, position=note1.position
-            )
+            notecast = NoteFactory.clone_note(note, pitch=tonecast.pitch, octave=tonecast.octave, position=position)
         except ValueError:
-            return False
+            return None
     else:
         try:
-            note2cast = NoteFactory.clone_note(note2, position=note1.position)
+            notecast = NoteFactory.clone_note(note, position=position)
         except ValueError:
-            return False
-    return same(note1, note2cast)
+            return None
+    return note_key(notecast)
 
 
 def compare(notes1: list[Note], notes2: list[Note], comparator: callable) -> bool:
@@ -210,9 +195,26 @@ def compare(notes1: list[Note], notes2: list[Note], comparator: callable) -> boo
     return all(comparator(note1, note2) for note1, note2 in zip(notes1, notes2))
 
 
+def stave_key(gongan: Gongan, position: Position, passid: PassID) -> tuple[tuple | None, ...]:
+    """Returns a hashable representation of the content of a stave, consisting of the note_key values of each beat.
+    Args:
+        gongan (Gongan): the gongan containing the stave.
+        position (Position): position of the stave.
+        passid (PassID): pass of the stave.
+    Returns:
+        tuple[tuple | None, ...]: tuple of note keys for each beat, None for beats without notes for the stave.
+    """
+    return tuple(
+        None if (notes := beat.get_notes(position, passid)) is None else tuple(note_key(note) for note in notes)
+        for beat in gongan.beats
+    )
+
+
 def aggregate_positions(gongan: Gongan) -> dict[tuple[Position, PassID], str]:
     """Returns a dict that maps positions to labels ('tags'). Groups certain positions with identical staves:
        GANGSA_P, GANGSA_S, GANGSA, REYONG_13, REYONG_24 and REYONG.
+       The result is cached on the gongan, so that the notation generators that call this function for the same
+       gongan share it. The cache is renewed when the content of the staves or the autokempyung metadata changes.
     Args:
         gongan (Gongan): gongan to convert
 
@@ -229,6 +231,17 @@ def aggregate_positions(gongan: Gongan) -> dict[tuple[Position, PassID], str]:
         for passid, pass_ in measure.passes.items()
         if not pass_.autogenerated
     ]
+    # Determine the content of each stave once. Each distinct content receives an id, which reduces the
+    # comparison of two staves to the comparison of two integers.
+    staves = {(position, passid): stave_key(gongan, position, passid) for position, passid in pos_pass_combis}
+    signature = (staves, gongan.metadata.get(MetaType.AUTOKEMPYUNG, []))
+    if gongan._position_tags_ is not None and gongan._position_tags_[0] == signature:
+        return dict(gongan._position_tags_[1])
+    stave_ids: dict[tuple, int] = {}
+    stave_id = {pos_pass: stave_ids.setdefault(stave, len(stave_ids)) for pos_pass, stave in staves.items()}
+    # Results of cast_note_key, by note, target position and position group.
+    cast_keys: dict[tuple, tuple | None] = {}
+
     pos_pass_tags = {
         (position, passid): position.shortcode + (f":{int(passid)}" if passid > 0 else "")
         for position, passid in sorted(
@@ -238,9 +251,16 @@ def aggregate_positions(gongan: Gongan) -> dict[tuple[Position, PassID], str]:
 
     # Remove empty staves
     for position, passid in list(pos_pass_tags.keys()):
-        if is_silent(gongan, position, passid):
+        if all(key[0] in [Pitch.EXTENSION, Pitch.SILENCE] for keys in staves[position, passid] if keys for key in keys):
             del pos_pass_tags[position, passid]
 
+    def is_equivalent(note: Note, refnote: Note, positions: tuple[Position]) -> bool:
+        """Memoized version of the `equivalent` function."""
+        castkey = (refnote.position, note_key(refnote), note.position, positions)
+        if castkey not in cast_keys:
+            cast_keys[castkey] = cast_note_key(refnote, note.position, list(positions), gongan.metadata)
+        return cast_keys[castkey] is not None and cast_keys[castkey] == note_key(note)
+
     def try_to_aggregate_pos(positions: list[Position], passid: PassID, aggregate_tag: str) -> bool:
         """Determines if the notation is identical for all of the given positions for the given pass.
         In that case, updates the pos_pass_tags dict.
@@ -255,7 +275,7 @@ def aggregate_positions(gongan: Gongan) -> dict[tuple[Position, PassID], str]:
         if not all((pos, passid) in pos_pass_tags.keys() for pos in positions):
             return False
         # Determine if all measures of the given positions are equivalent
-        comparator = partial(equivalent, positions=positions, metadata=gongan.metadata)
+        comparator = partial(is_equivalent, positions=tuple(positions))
         all_positions_have_same_notation = all(
             all(
                 compare(beat.get_notes(pos, passid), beat.get_notes(positions[0], passid), comparator)
@@ -289,10 +309,7 @@ def aggregate_positions(gongan: Gongan) -> dict[tuple[Position, PassID], str]:
             first = passes[0]
             nextpass = None
             for currpass, nextpass in zip(passes, passes[1:]):
-                if first != currpass and not all(
-                    compare(beat.get_notes(position, currpass), beat.get_notes(position, nextpass), same)
-                    for beat in gongan.beats
-                ):
+                if first != currpass and stave_id[position, currpass] != stave_id[position, nextpass]:
                     # Reached last pass of a group with size >1.
                     groups.append([first, currpass])
                     first = nextpass
@@ -328,4 +345,5 @@ def aggregate_positions(gongan: Gongan) -> dict[tuple[Position, PassID], str]:
 
     # Aggregate similar passes
     aggregate_passes()
+    gongan._position_tags_ = (signature, dict(pos_pass_tags))
     return pos_pass_tags
@@ -8,7 +8,7 @@ from typing import Any
 import numpy as np
 import pandas as pd
 import yaml
-from pydantic import BaseModel, ConfigDict, Field
+from pydantic import BaseModel, ConfigDict, Field, SerializerFunctionWrapHandler, model_serializer
 
 from src.common.constants import (
     AnimationProfiles,
@@ -31,6 +31,7 @@ from src.common.constants import (
     Stroke,
 )
 from src.common.logger import Logging
+from src.common.output_sinks import FileSink, OutputSink
 from src.settings.constants import (
     ENV_VAR_CONFIG_PATH,
     ENV_VAR_N2M_SETTINGS_PATH,
@@ -218,6 +219,15 @@ class Part(BaseModel):
     file: str
     loop: bool
     markers: dict[str, float] = Field(default_factory=dict)  # {partname: milliseconds}
+    # Published helping hand timeline (see HelpingHandOutput.SIDECAR). Omitted from the content if None.
+    helpinghand: str | None = None
+
+    @model_serializer(mode="wrap")
+    def _omit_helpinghand(self, handler: SerializerFunctionWrapHandler) -> dict[str, Any]:
+        data = handler(self)
+        if data.get("helpinghand") is None:
+            data.pop("helpinghand", None)
+        return data
 
 
 @dataclass
@@ -246,6 +256,22 @@ class Content(BaseModel):
     soundfont: str
 
 
+class SongIndexEntry(BaseModel):
+    # Entry of the index document of the SHARDED content layout.
+    title: str
+    instrumentgroup: InstrumentGroup
+    display: bool
+    file: str  # Location of the song document, relative to the midiplayer folder
+
+
+class ContentIndex(BaseModel):
+    # Index document of the SHARDED content layout: the Content without the details of the songs.
+    songs: list[SongIndexEntry]
+    instrumentgroups: dict[InstrumentGroup, list[InstrumentInfo]]
+    animation: AnimationInfo
+    soundfont: str
+
+
 # RUN SETTINGS
 
 
@@ -254,6 +280,27 @@ class RunType(StrEnum):
     RUN_ALL = "RUN_ALL"
 
 
+class MidiEncoder(StrEnum):
+    BINARY = "BINARY"  # Built-in encoder (see midi_events module)
+    MIDO = "MIDO"  # Encoding by the mido library
+
+
+class TempoCurve(StrEnum):
+    FIXED = "FIXED"  # A tempo message at each update moment of a gradual tempo change (every 24 ticks)
+    BPM = "BPM"  # Only the tempo messages needed to stay within `tempo_tolerance` BPM of the fixed curve
+    MILLISECONDS = "MILLISECONDS"  # Idem, with the accumulated timing error in milliseconds as tolerance
+
+
+class HelpingHandOutput(StrEnum):
+    MARKERS = "MARKERS"  # Marker messages in the MIDI file
+    SIDECAR = "SIDECAR"  # Separate JSON timeline file next to the MIDI file
+
+
+class ContentLayout(StrEnum):
+    MONOLITHIC = "MONOLITHIC"  # All the midiplayer content in a single document
+    SHARDED = "SHARDED"  # An index document and a separate document for each song
+
+
 class SettingsInstrumentInfo(BaseModel):
     folder: str
     instruments_file: str
@@ -285,6 +332,8 @@ class SettingsMidiInfo(BaseModel):
     default_dynamics: DynamicLevel
     silence_seconds_before_start: int  # silence before first note
     silence_seconds_after_end: int  # silence after last note
+    tempo_curve: TempoCurve = TempoCurve.FIXED  # resolution of gradual tempo changes
+    tempo_tolerance: float = 0  # maximum error in BPM or milliseconds, depending on tempo_curve
 
     @property
     def notes_filepath(self):
@@ -387,6 +436,10 @@ class SettingsMidiPlayerInfo(BaseModel):
     folder: str
     contentfile: str
     helpinghand: list[Position] = None
+    helpinghand_output: HelpingHandOutput = HelpingHandOutput.MARKERS
+    content_layout: ContentLayout = ContentLayout.MONOLITHIC
+    songs_folder: str = "songs"  # Subfolder of the song documents of the SHARDED layout
+    publish_bundle: bool = False  # Publish content-hashed, precompressed MIDI and PDF files in production runs
 
 
 class SettingsPdfConverterInfo(BaseModel):
@@ -434,6 +487,14 @@ class SettingsOptions(BaseModel):
         save_midifile: bool
         is_production_run: bool
         is_integration_test: bool = False
+        # The run is aborted before generating the MIDI file if the execution flow exceeds these limits.
+        max_executed_beats: int | None = None
+        max_duration_seconds: int | None = None
+        track_workers: int = 1  # Number of processes that generate the MIDI tracks. 1: serial generation.
+        pdf_workers: int = 1  # Number of processes that create the gongan tables of the PDF. 1: serial generation.
+        midi_encoder: MidiEncoder = MidiEncoder.BINARY  # Both encoders generate identical files.
+        segment_cache_folder: str | None = None  # Folder of the MIDI segment cache. None: no cache.
+        skip_unchanged_exports: bool = False  # Skip PDF and notation exports whose content would not change.
 
         @property
         def update_midiplayer_content(self) -> bool:
@@ -492,12 +553,17 @@ class RunSettings(BaseModel):
     Do not instantiate this class, but call src.settings.settings.Settings.get(...)
     to get a RunSettings instance."""
 
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
     midiversion: str | None = None
     notation_id: str | None = None
     part_id: str | None = None
     options: SettingsOptions
     configdata: ConfigData
     data: Data = None
+    # The following attributes enable to run the pipeline without file access (see notation2midi.main).
+    notation: str | None = Field(default=None, exclude=True)  # Notation content. None: read notation_filepath.
+    output_sink: OutputSink = Field(default_factory=FileSink, exclude=True)  # Destination of the generated files.
 
     def __init__(self):
         """Initializes an instance and populates it from the config/settings yaml files in the settings folder."""
@@ -565,6 +631,19 @@ class RunSettings(BaseModel):
     def midi_out_filepath(self) -> str:
         return os.path.join(self.folder_out, self.midi_out_file)
 
+    @property
+    def midi_segment_cache_filepath(self) -> str | None:
+        """Location of the MIDI segment cache of the notation part, None if no cache should be used."""
+        folder = self.options.notation_to_midi.segment_cache_folder
+        if not folder:
+            return None
+        return os.path.join(os.path.expanduser(folder), f"{self.notation_id}_{self.part_id}_midi_segments.pickle")
+
+    @property
+    def helpinghand_out_filepath(self) -> str:
+        """Location of the helping hand timeline if the midiplayer's helpinghand_output is SIDECAR."""
+        return os.path.splitext(self.midi_out_filepath)[0] + "_helpinghand.json"
+
     @property
     def pdf_out_filepath(self) -> str:
         return os.path.join(self.folder_out, self.pdf_out_file)
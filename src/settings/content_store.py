@@ -0,0 +1,153 @@
+"""Storage of the content of the JavaScript midiplayer app.
+The content can be saved in one of two layouts (see ContentLayout):
+- MONOLITHIC: a single content file that contains all the information.
+- SHARDED: the content file is an index that contains the general information and a list of the songs. Each entry
+  refers to a separate song document in the songs folder. Only the documents that changed are rewritten, which
+  keeps the write volume small when a single song is updated.
+The layout of an existing content file is detected when it is loaded, so that a store can be used to convert
+the content from one layout to the other (see convert_content).
+"""
+
+import argparse
+import json
+import os
+import re
+from contextlib import contextmanager
+from typing import Iterator, TextIO
+
+from src.settings.classes import (
+    Content,
+    ContentIndex,
+    ContentLayout,
+    SettingsMidiPlayerInfo,
+    Song,
+    SongIndexEntry,
+)
+from src.settings.utils import pretty_compact_json, write_pretty_compact_json
+
+
+class ContentStore:
+    """Loads and saves the midiplayer content in the given layout."""
+
+    def __init__(
+        self,
+        folder: str,
+        contentfile: str,
+        layout: ContentLayout = ContentLayout.MONOLITHIC,
+        songs_folder: str = "songs",
+    ):
+        self.folder = folder
+        self.contentfile = contentfile
+        self.layout = layout
+        self.songs_folder = songs_folder
+        # Text of the song documents as they were last loaded or saved, by file location.
+        self._song_documents: dict[str, str] = {}
+
+    @classmethod
+    def from_settings(cls, midiplayer: SettingsMidiPlayerInfo) -> "ContentStore":
+        """Creates a store for the midiplayer content that is defined in the settings."""
+        return cls(midiplayer.folder, midiplayer.contentfile, midiplayer.content_layout, midiplayer.songs_folder)
+
+    def song_file(self, title: str) -> str:
+        """Returns the location of the song document, relative to the midiplayer folder."""
+        return f"{self.songs_folder}/{re.sub(r'[^\w\-. ()]', '_', title)}.json"
+
+    def _path(self, file: str) -> str:
+        return os.path.join(self.folder, file)
+
+    def _read(self, file: str) -> str:
+        with open(self._path(file), "r", encoding="utf-8") as infile:
+            return infile.read()
+
+    @contextmanager
+    def _open_for_writing(self, file: str) -> Iterator[TextIO]:
+        """Writes to a temporary file which replaces the document when it has been written successfully.
+        This avoids leaving a corrupted document if the write fails."""
+        filepath = self._path(file)
+        os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+        tempfilepath = os.path.join(os.path.dirname(filepath), "_" + os.path.basename(filepath))
+        try:
+            with open(tempfilepath, "w", encoding="utf-8") as outfile:
+                yield outfile
+        except BaseException:
+            if os.path.exists(tempfilepath):
+                os.remove(tempfilepath)
+            raise
+        os.replace(tempfilepath, filepath)
+
+    def load(self) -> Content:
+        """Loads the content, regardless of the layout in which it was saved.
+        Returns:
+            Content: Structure for the midiplayer content.
+        """
+        document = json.loads(self._read(self.contentfile))
+        self._song_documents = {}
+        if not any("file" in song for song in document["songs"]):
+            return Content.model_validate(document)
+        index = ContentIndex.model_validate(document)
+        songs = []
+        for entry in index.songs:
+            self._song_documents[entry.file] = self._read(entry.file)
+            songs.append(Song.model_validate_json(self._song_documents[entry.file]))
+        return Content(
+            songs=songs, instrumentgroups=index.instrumentgroups, animation=index.animation, soundfont=index.soundfont
+        )
+
+    def save(self, content: Content) -> None:
+        """Saves the content in the layout of the store. The songs are sorted by title.
+        In the SHARDED layout, only the song documents that changed since they were loaded are written and the
+        documents of songs that are no longer part of the content are removed.
+        Args:
+            content (Content): content that should be saved.
+        Raises:
+            ValueError: two songs have titles that result in the same song document name.
+        """
+        content.songs = sorted(content.songs, key=lambda s: s.title)
+        song_documents = {}
+        if self.layout == ContentLayout.SHARDED:
+            entries = []
+            for song in content.songs:
+                file = self.song_file(song.title)
+                if file in song_documents:
+                    raise ValueError(f"Song '{song.title}' would overwrite the song document {file} of another song.")
+                song_documents[file] = pretty_compact_json(song.model_dump())
+                entries.append(
+                    SongIndexEntry(
+                        title=song.title, instrumentgroup=song.instrumentgroup, display=song.display, file=file
+                    )
+                )
+            root = ContentIndex(
+                songs=entries,
+                instrumentgroups=content.instrumentgroups,
+                animation=content.animation,
+                soundfont=content.soundfont,
+            )
+        else:
+            root = content
+        for file, text in song_documents.items():
+            if self._song_documents.get(file) != text:
+                with self._open_for_writing(file) as outfile:
+                    outfile.write(text)
+        with self._open_for_writing(self.contentfile) as outfile:
+            write_pretty_compact_json(root.model_dump(), outfile)
+        for file in self._song_documents.keys() - song_documents.keys():
+            if os.path.exists(self._path(file)):
+                os.remove(self._path(file))
+        self._song_documents = song_documents
+
+
+def convert_content(folder: str, contentfile: str, layout: ContentLayout, songs_folder: str = "songs") -> None:
+    """Converts the midiplayer content to the given layout. The song documents are removed when converting
+    to the MONOLITHIC layout."""
+    store = ContentStore(folder, contentfile, layout, songs_folder)
+    store.save(store.load())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Converts the midiplayer content to the given layout.")
+    parser.add_argument("layout", choices=list(ContentLayout))
+    parser.add_argument("--folder", default="./data/midiplayer")
+    parser.add_argument("--contentfile", default="content.json")
+    parser.add_argument("--songs_folder", default="songs")
+    args = parser.parse_args()
+    convert_content(args.folder, args.contentfile, ContentLayout(args.layout), args.songs_folder)
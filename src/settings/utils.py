@@ -1,64 +1,116 @@
+import io
 from itertools import product
+from typing import Any, Callable, TextIO
 
 from src.common.constants import InstrumentType, Position
 from src.settings.classes import RunSettings
 from src.settings.constants import InstrumentTagFields
 
 
-def pretty_compact_json(obj, _key: str = "root", _level: int = 0, _is_last: bool = False) -> list:
-    """Saves a json-like structure in a semi-compact form to keep it human-readable.
+def pretty_compact_json(obj) -> str:
+    """Returns a json-like structure in a semi-compact form to keep it human-readable.
+    See write_pretty_compact_json for a description of the format.
+    Args:
+        obj (Any): The root object of the structure.
+    Returns:
+        str: the formatted structure.
+    """
+    stream = io.StringIO()
+    write_pretty_compact_json(obj, stream)
+    return stream.getvalue()
+
+
+def write_pretty_compact_json(obj, stream: TextIO) -> None:
+    """Writes a json-like structure in a semi-compact form to keep it human-readable.
        The function keeps structures as much as possible on one line. Exceptions:
        - If the items of a structure contain only "complex" (dict or list) values, each item will be written on
           a separate line.
        - Both rules can be overruled with the lists `treat_as_complex` and `treat_as_simple` (see code).
+       The structure is written in a single pass, without building intermediate strings for its items.
 
     Args:
         obj (Any): The root object of the structure.
-        _key (str, optional): The key value of the item. Defaults "root". Only to be used in recursive call.
-        _level (int, optional): nesting level, used for indenting. Defaults to 0. Only to be used in  recursive call.
-        _is_last (bool, optional): last element of a list or dict. Defaults to False. Only to be used in  recursive
-        call.
+        stream (TextIO): The stream to which the structure should be written.
+    """
+    _write_pretty_compact_json(obj, stream.write, "root", 0, False)
 
-    Returns:
-        list: _description_
+
+def _write_pretty_compact_json(obj, write: Callable[[str], Any], key: str, level: int, is_last: bool) -> None:
+    """Writes an item of a json-like structure. See write_pretty_compact_json.
+    Args:
+        obj (Any): The item.
+        write (Callable[[str], Any]): The write method of the output stream.
+        key (str): The key value of the item.
+        level (int): nesting level, used for indenting.
+        is_last (bool): last element of a list or dict.
     """
     indent = " " * 8
-    treat_as_complex = _key in ["root", "markers", "highlight"]
-    treat_as_simple = _key in []
+    treat_as_complex = key in ["root", "markers", "highlight"]
+    treat_as_simple = key in []
+    if isinstance(obj, (dict, list)):
+        islist = isinstance(obj, list)
+        b_, _b = ("[", "]") if islist else ("{", "}")
+
+        if not obj:
+            write(b_ + _b)
+            return
+
+        values = obj if islist else obj.values()
+        is_complex = all(type(it) in (dict, list) for it in values)
+        is_complex = (is_complex or treat_as_complex) and not treat_as_simple
+        # JSON representation of the simple values, None for nested structures.
+        texts = [_simple_value_to_json(val) for val in values]
+        if not is_complex and None not in texts:
+            # A structure that contains only simple values is written at once.
+            items = texts if islist else (f'"{itemkey}": {text}' for itemkey, text in zip(obj, texts))
+            write(b_ + ", ".join(items) + _b)
+            return
+        # new line + level indent after last element
+        sep0 = "\n" + indent * (level) if is_complex and is_last else ""
+        # new line + level-1 indent after closing bracket following last element
+        sep_1 = "\n" + indent * max(level - 1, 0) if is_complex and is_last else ""
+        # new line + level indent after any other element
+        sep1 = "\n" + indent * (level + 1) if is_complex else ""
+
+        separator = ", " + sep1
+        lastindex = len(obj) - 1
+        for index, (itemkey, val, text) in enumerate(zip(obj if islist else obj.keys(), values, texts)):
+            head = (separator if index else b_ + sep1) + ("" if islist else f'"{itemkey}": ')
+            if text is None:
+                write(head)
+                _write_pretty_compact_json(val, write, key if islist else itemkey, level + 1, index == lastindex)
+            else:
+                write(head + text)
+        write(sep0 + _b + sep_1)
+    elif (text := _simple_value_to_json(obj)) is not None:
+        write(text)
+
+
+# JSON formatting functions for the built-in simple types.
+_SIMPLE_VALUE_FORMATS: dict[type, Callable[[Any], str]] = {
+    str: lambda obj: f'"{obj}"',
+    int: str,
+    float: str,
+    bool: lambda obj: "true" if obj else "false",
+    type(None): lambda obj: "null",
+}
+
+
+def _simple_value_to_json(obj) -> str | None:
+    """Returns the JSON representation of a simple value, or None if the value is a structure."""
+    if formatter := _SIMPLE_VALUE_FORMATS.get(type(obj)):
+        return formatter(obj)
+    # Subclasses of the simple types, e.g. enums.
     match obj:
         case None:
             return "null"
-        case dict() | list():
-            islist = isinstance(obj, list)
-            b_, _b = ("[", "]") if islist else ("{", "}")
-
-            if not obj:
-                return b_ + _b
-
-            if isinstance(obj, dict):
-                lastkey = list(obj.items())[-1][0]
-                items_to_str = [
-                    f'"{key}": {pretty_compact_json(val, key, _level+1, key==lastkey)}' for key, val in obj.items()
-                ]
-            else:
-                lastvalue = obj[-1]
-                items_to_str = [pretty_compact_json(val, _key, _level + 1, val == lastvalue) for val in obj]
-
-            is_complex = all(type(it) in [type(dict()), type(list())] for it in (obj if islist else obj.values()))
-            is_complex = (is_complex or treat_as_complex) and not treat_as_simple
-            # new line + level indent after last element
-            sep0 = "\n" + indent * (_level) if is_complex and _is_last else ""  # new
-            # new line + level-1 indent after closing bracket following last element
-            sep_1 = "\n" + indent * max(_level - 1, 0) if is_complex and _is_last else ""
-            # new line + level indent after any other element
-            sep1 = "\n" + indent * (_level + 1) if is_complex else ""
-            return f"{b_}{sep1}" + f", {sep1}".join(items_to_str) + f"{sep0}{_b}{sep_1}"
         case bool():
             return str(obj).lower()
         case int() | float():
             return f"{obj}"
         case str():
             return f'"{obj}"'
+    return None
 
 
 def tag_to_position_dict(run_settings: RunSettings) -> dict[str, list[Position]]:
@@ -0,0 +1,50 @@
+import os
+import tempfile
+import unittest
+
+from src.common.output_sinks import BytesIOSink, CallbackSink, FileSink, OutputKind, OutputSink
+
+
+class OutputSinkTester(unittest.TestCase):
+
+    DATA = b"MThd\x00\x00\x00\x06"
+
+    def test_output_sink_is_abstract(self):
+        with self.assertRaises(TypeError):
+            OutputSink()  # pylint: disable=abstract-class-instantiated
+
+    def test_file_sink(self):
+        with tempfile.TemporaryDirectory() as folder:
+            filepath = os.path.join(folder, "out.mid")
+            FileSink().write(OutputKind.MIDI, filepath, self.DATA)
+            with open(filepath, "rb") as infile:
+                self.assertEqual(infile.read(), self.DATA)
+
+    def test_file_sink_failure(self):
+        with tempfile.TemporaryDirectory() as folder:
+            filepath = os.path.join(folder, "out.mid")
+            FileSink().write(OutputKind.MIDI, filepath, self.DATA)
+            with self.assertRaises(ValueError):
+                with FileSink().open(OutputKind.MIDI, filepath) as outfile:
+                    outfile.write(b"MThd")
+                    raise ValueError("failure")
+            # The existing file is left untouched and the temporary file is removed.
+            with open(filepath, "rb") as infile:
+                self.assertEqual(infile.read(), self.DATA)
+            self.assertEqual(os.listdir(folder), ["out.mid"])
+
+    def test_bytesio_sink(self):
+        sink = BytesIOSink()
+        with sink.open(OutputKind.PDF, "out.pdf") as outfile:
+            outfile.write(self.DATA[:4])
+            # The content only becomes available when the output is complete.
+            self.assertNotIn(OutputKind.PDF, sink.outputs)
+            outfile.write(self.DATA[4:])
+        self.assertEqual(sink.outputs, {OutputKind.PDF: self.DATA})
+        self.assertEqual(sink.filepaths, {OutputKind.PDF: "out.pdf"})
+
+    def test_callback_sink(self):
+        received = []
+        sink = CallbackSink(lambda kind, filepath, data: received.append((kind, filepath, data)))
+        sink.write(OutputKind.MIDI, "out.mid", self.DATA)
+        self.assertEqual(received, [(OutputKind.MIDI, "out.mid", self.DATA)])
@@ -0,0 +1,94 @@
+import unittest
+
+from src.common.classes import Beat, Gongan, Score
+from src.common.constants import DEFAULT, DynamicLevel, Position
+from src.notation2midi.execution.execution import ExecutionManager, Loop
+from src.notation2midi.metadata_classes import DynamicsMeta, TempoMeta
+from src.settings.settings import Settings
+from tests.conftest import BaseUnitTestCase
+
+# pylint: disable=missing-module-docstring
+# pylint: disable=missing-function-docstring
+# pylint: disable=protected-access
+
+
+class ExecutionPlanTester(BaseUnitTestCase):
+
+    def setUp(self):
+        self.settings = Settings.get(notation_id="test-gongkebyar", part_id="full")
+        # Three gongans of two beats each. Gongan 2 is looped, gongan 3 jumps back to gongan 1 on the first pass.
+        gongans = [Gongan(id=g_id, beats=[Beat(id=b_id, gongan_id=g_id) for b_id in (1, 2)]) for g_id in (1, 2, 3)]
+        beats = [beat for gongan in gongans for beat in gongan.beats]
+        for prev_beat, next_beat in zip(beats, beats[1:]):
+            prev_beat.next = next_beat
+            next_beat.prev = prev_beat
+        self.score = Score(title="Test", settings=self.settings, gongans=gongans)
+        self.score.index_beats()
+        self.exec_mgr = ExecutionManager(score=self.score)
+        for beat in beats:
+            self.exec_mgr.create_default_goto(beat)
+        self.exec_mgr.goto(gongans[2].beats[-1]).to_beat_dict |= {1: gongans[0].beats[0]}
+        self.exec_mgr.set_loop(
+            2, Loop(from_beat=gongans[1].beats[-1], to_beat_dict={DEFAULT: gongans[1].beats[0]}, cycle=2)
+        )
+        self.exec_mgr.assign_tempo(gongans[0].beats[0], TempoMeta(to_value=80, first_beat=1, beat_count=2, passes=[2]))
+        self.exec_mgr.assign_dynamics(
+            gongans[2].beats[0],
+            DynamicsMeta(to_abbr=DynamicLevel.PIANO, first_beat=1, positions=[Position.PEMADE_POLOS], passes=[1]),
+        )
+
+    def test_create_execution_plan(self):
+        plan = self.exec_mgr.create_execution_plan()
+        self.assertEqual(
+            [step.beat.full_id for step in plan.steps],
+            ["1-1", "1-2", "2-1", "2-2", "2-1", "2-2", "3-1", "3-2"] * 2,
+        )
+        self.assertEqual([step.pass_nr for step in plan.steps[:8]], [1] * 8)
+        self.assertEqual([step.pass_nr for step in plan.steps[8:]], [2] * 8)
+        self.assertEqual([step.iteration for step in plan.steps[:8]], [DEFAULT, DEFAULT, 1, 1, 2, 2, DEFAULT, DEFAULT])
+        self.assertEqual(list(plan.dynamics_overrides.keys()), [Position.PEMADE_POLOS])
+
+    def test_expression_timelines(self):
+        plan = self.exec_mgr.create_execution_plan()
+        tempo = [plan.tempo.values(step_seq) for step_seq in range(len(plan.steps))]
+        self.assertEqual(tempo, [(60, 60)] * 8 + [(60, 70), (70, 80)] + [(80, 80)] * 6)
+        for position, expected in (
+            (Position.JEGOGAN, [(85, 85)] * 16),
+            (Position.PEMADE_POLOS, [(85, 85)] * 6 + [(45, 45)] * 10),
+        ):
+            with self.subTest(position=position):
+                dynamics = plan.dynamics_for(position)
+                self.assertEqual([dynamics.values(step_seq) for step_seq in range(len(plan.steps))], expected)
+        self.assertIs(plan.dynamics_for(Position.JEGOGAN), plan.dynamics)
+
+    def test_execution_plan_is_reproducible(self):
+        # The progress of gradual changes is not stored in the (shared) GradualChange objects.
+        plan1 = self.exec_mgr.create_execution_plan()
+        plan2 = self.exec_mgr.create_execution_plan()
+        self.assertEqual(plan1, plan2)
+
+    def test_execution_plan_detects_endless_flow(self):
+        # Jump back from the last beat to the first beat on every pass.
+        gongans = self.score.gongans
+        self.exec_mgr.goto(gongans[2].beats[-1]).to_beat_dict[DEFAULT] = gongans[0].beats[0]
+        plan = self.exec_mgr.create_execution_plan()
+        self.assertFalse(plan.complete)
+        self.assertIs(plan.cycle_beat, gongans[0].beats[0])
+
+    def test_score_not_indexed(self):
+        # Beats that are added after Score.index_beats have no valid sequence number.
+        self.score.gongans[2].beats.append(Beat(id=3, gongan_id=3, prev=self.score.gongans[2].beats[-1]))
+        with self.assertRaises(ValueError):
+            ExecutionManager(score=self.score)
+        self.score.index_beats()
+        ExecutionManager(score=self.score)
+
+    def test_execution_plan_max_steps(self):
+        plan = self.exec_mgr.create_execution_plan(max_steps=5)
+        self.assertFalse(plan.complete)
+        self.assertIsNone(plan.cycle_beat)
+        self.assertEqual(len(plan.steps), 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+import unittest
+from unittest.mock import patch
+
+from src.common.classes import Beat, Gongan, Measure, Score
+from src.common.constants import DEFAULT, Position
+from src.notation2midi.execution.execution import ExecutionManager
+from src.notation2midi.pipeline.analyze_flow import FlowAnalysisAgent
+from src.settings.settings import Settings
+from tests.conftest import BaseUnitTestCase
+from tests.src.utils_for_tests import PositionNote
+
+# pylint: disable=missing-module-docstring
+# pylint: disable=missing-function-docstring
+# pylint: disable=protected-access
+
+P = PositionNote(Position.PEMADE_POLOS)
+
+
+class FlowAnalysisTester(BaseUnitTestCase):
+
+    def setUp(self):
+        self.settings = Settings.get(notation_id="test-gongkebyar", part_id="full")
+        # Two gongans of two beats. Each beat lasts one second at the default tempo of 60 BPM.
+        gongans = [
+            Gongan(
+                id=g_id,
+                beats=[
+                    Beat(
+                        id=b_id,
+                        gongan_id=g_id,
+                        measures={
+                            P.position: Measure(
+                                position=P.position,
+                                all_positions=P.position,
+                                passes={DEFAULT: Measure.Pass(seq=-1, notes=[P.DING1, P.DONG1, P.DENG1, P.DUNG1])},
+                            )
+                        },
+                    )
+                    for b_id in (1, 2)
+                ],
+            )
+            for g_id in (1, 2)
+        ]
+        beats = [beat for gongan in gongans for beat in gongan.beats]
+        for prev_beat, next_beat in zip(beats, beats[1:]):
+            prev_beat.next = next_beat
+            next_beat.prev = prev_beat
+        self.score = Score(title="Test", settings=self.settings, gongans=gongans)
+        self.score.index_beats()
+        self.exec_mgr = ExecutionManager(score=self.score)
+        for beat in beats:
+            self.exec_mgr.create_default_goto(beat)
+        self.silence = self.settings.midi.silence_seconds_before_start + self.settings.midi.silence_seconds_after_end
+
+    def test_run_condition(self):
+        options = self.settings.options.notation_to_midi
+        self.addCleanup(setattr, options, "save_midifile", options.save_midifile)
+        options.save_midifile = True
+        self.assertTrue(FlowAnalysisAgent.run_condition_satisfied(self.settings))
+        # PDF and notation exports do not perform the flow.
+        options.save_midifile = False
+        self.assertFalse(FlowAnalysisAgent.run_condition_satisfied(self.settings))
+
+    def test_flow_analysis(self):
+        analysis = FlowAnalysisAgent(self.exec_mgr)._main()
+        self.assertEqual(analysis.executed_beat_count, 4)
+        self.assertAlmostEqual(analysis.duration_seconds, 4 + self.silence)
+        self.assertTrue(analysis.terminates)
+        self.assertIsNotNone(self.exec_mgr.plan)
+
+    def test_endless_flow(self):
+        gongans = self.score.gongans
+        self.exec_mgr.goto(gongans[1].beats[-1]).to_beat_dict[DEFAULT] = gongans[1].beats[0]
+        agent = FlowAnalysisAgent(self.exec_mgr)
+        with patch.object(agent, "logerror") as logerror:
+            analysis = agent._main()
+        logerror.assert_called_once()
+        self.assertFalse(analysis.terminates)
+        self.assertEqual(analysis.cycle_beat_id, "2-1")
+
+    def test_limits_exceeded(self):
+        for option, value in (("max_executed_beats", 3), ("max_duration_seconds", 3 + self.silence)):
+            with self.subTest(option=option):
+                options = self.settings.options.notation_to_midi.model_copy(update={option: value})
+                agent = FlowAnalysisAgent(self.exec_mgr)
+                with (
+                    patch.object(agent.run_settings.options, "notation_to_midi", options),
+                    patch.object(agent, "logerror") as logerror,
+                ):
+                    agent._main()
+                logerror.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -54,6 +54,7 @@ class TestDictToScoreConverter(BaseUnitTestCase):
         mock_score.settings = self.settings
         mock_score.gongans = {}
         mock_score.global_metadata = []
+        mock_score.beat_count = 2
         return ExecutionCreatorAgent(mock_score)
 
     def create_gongan_with_metadata(self, gongan_id: int, meta_dict: dict[MetaType, MetaDataBaseModel]):
@@ -77,6 +78,8 @@ class TestDictToScoreConverter(BaseUnitTestCase):
                 },
             ),
         ]
+        for seq, beat in enumerate(beats):
+            beat.seq = seq
         return Gongan(id=gongan_id, beats=beats, metadata=meta_dict)
 
     def test_apply_meta(self):
@@ -100,7 +103,7 @@ class TestDictToScoreConverter(BaseUnitTestCase):
                         ]
                     },
                 ),
-                value := lambda: converter.execution_mgr.dynamics_dict[gongan.beats[0].full_id],
+                value := lambda: converter.execution_mgr.dynamics_list[gongan.beats[0].seq],
                 expected := [
                     GradualChange(
                         positions=[Position.PEMADE_POLOS, Position.PEMADE_SANGSIH],
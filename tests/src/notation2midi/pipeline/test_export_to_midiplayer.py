@@ -0,0 +1,187 @@
+# pylint: disable=missing-module-docstring, missing-class-docstring, missing-function-docstring
+
+import gzip
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+import brotli
+
+from src.common.output_sinks import BytesIOSink
+from src.notation2midi.pipeline.export_to_midiplayer import (
+    MidiPlayerPublishAgent,
+    MidiPlayerUpdateAgentModel,
+    MidiPlayerUpdatePartAgent,
+    MidiPlayerUpdatePdfAgent,
+    content_hashed_name,
+    locked_file,
+    publish_file,
+    remove_previous_versions,
+)
+from src.settings.classes import PartForm
+from src.settings.content_store import ContentStore
+from src.settings.settings import Settings
+from tests.conftest import BaseUnitTestCase
+
+# pylint: disable=protected-access
+
+
+class MidiPlayerUpdateTester(BaseUnitTestCase):
+
+    def setUp(self):
+        self.settings = Settings.get(notation_id="test-gongkebyar", part_id="full")
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        shutil.copy(os.path.join(self.settings.midiplayer.folder, self.settings.midiplayer.contentfile), folder)
+        self.addCleanup(setattr, self.settings.midiplayer, "folder", self.settings.midiplayer.folder)
+        self.settings.midiplayer.folder = folder
+        self.contentfilepath = os.path.join(folder, self.settings.midiplayer.contentfile)
+
+    def content(self):
+        return ContentStore.from_settings(self.settings.midiplayer).load()
+
+    def test_batch(self):
+        with open(self.contentfilepath, "r", encoding="utf-8") as contentfile:
+            original = contentfile.read()
+        get_midiplayer_content = MidiPlayerUpdateAgentModel._get_midiplayer_content
+        with patch.object(
+            MidiPlayerUpdateAgentModel, "_get_midiplayer_content", autospec=True, side_effect=get_midiplayer_content
+        ) as get_content:
+            with MidiPlayerUpdateAgentModel.batch():
+                MidiPlayerUpdatePartAgent(self.settings, PartForm(part="test", file="test.mid", loop=True))._main()
+                MidiPlayerUpdatePdfAgent(self.settings, "test.pdf")._main()
+                # The updates are saved at the end of the batch.
+                with open(self.contentfilepath, "r", encoding="utf-8") as contentfile:
+                    self.assertEqual(contentfile.read(), original)
+        # The content is read and saved once for all the updates.
+        get_content.assert_called_once()
+        song = next(song for song in self.content().songs if song.title == self.settings.notationfile.title)
+        self.assertEqual(song.pdf, "test.pdf")
+        self.assertIn("test.mid", [part.file for part in song.parts])
+        self.assertFalse(os.path.exists(self.contentfilepath + ".lock"))
+
+    def test_run_condition(self):
+        options = self.settings.options.notation_to_midi
+        for attribute in ("is_production_run", "save_midifile", "save_pdf_notation"):
+            self.addCleanup(setattr, options, attribute, getattr(options, attribute))
+        self.addCleanup(setattr, self.settings, "output_sink", self.settings.output_sink)
+        options.is_production_run = options.save_midifile = options.save_pdf_notation = True
+        self.assertTrue(MidiPlayerUpdatePartAgent.run_condition_satisfied(self.settings))
+        self.assertTrue(MidiPlayerUpdatePdfAgent.run_condition_satisfied(self.settings))
+        # Files that are not written to the file system should not be referred to by the midiplayer content.
+        self.settings.output_sink = BytesIOSink()
+        self.assertFalse(MidiPlayerUpdatePartAgent.run_condition_satisfied(self.settings))
+        self.assertFalse(MidiPlayerUpdatePdfAgent.run_condition_satisfied(self.settings))
+
+    def test_locked_file(self):
+        with locked_file(self.contentfilepath):
+            with self.assertRaises(TimeoutError):
+                with locked_file(self.contentfilepath, timeout=0.2):
+                    pass
+        self.assertFalse(os.path.exists(self.contentfilepath + ".lock"))
+
+    @unittest.skipIf(os.name != "posix", "The owner of a lock file can only be checked on POSIX platforms")
+    def test_locked_file_owner_ended(self):
+        lockfilepath = self.contentfilepath + ".lock"
+        process = subprocess.run(
+            [sys.executable, "-c", "import os; print(os.getpid())"], capture_output=True, check=True
+        )
+        with open(lockfilepath, "w", encoding="utf-8") as lockfile:
+            lockfile.write(f"{socket.gethostname()} {int(process.stdout)}")
+        with locked_file(self.contentfilepath, timeout=0.2):
+            with open(lockfilepath, "r", encoding="utf-8") as lockfile:
+                self.assertEqual(lockfile.read(), f"{socket.gethostname()} {os.getpid()}")
+        self.assertFalse(os.path.exists(lockfilepath))
+
+    def test_locked_file_stale(self):
+        lockfilepath = self.contentfilepath + ".lock"
+        # Lock file of a process on another host, which is older than `stale_after`.
+        with open(lockfilepath, "w", encoding="utf-8") as lockfile:
+            lockfile.write("otherhost 1")
+        with self.assertRaises(TimeoutError):
+            with locked_file(self.contentfilepath, timeout=0.2):
+                pass
+        os.utime(lockfilepath, (time.time() - 120, time.time() - 120))
+        with locked_file(self.contentfilepath, timeout=0.2, stale_after=60):
+            pass
+        self.assertFalse(os.path.exists(lockfilepath))
+
+    def test_publish_file(self):
+        folder = self.settings.midiplayer.folder
+        sourcepath = os.path.join(folder, "song.mid")
+        with open(sourcepath, "wb") as outfile:
+            outfile.write(b"version 1")
+        published = publish_file(sourcepath, folder)
+        self.assertEqual(published, content_hashed_name("song.mid", b"version 1"))
+        self.assertRegex(published, r"^song\.[0-9a-f]{10}\.mid$")
+        with gzip.open(os.path.join(folder, published + ".gz")) as infile:
+            self.assertEqual(infile.read(), b"version 1")
+        with open(os.path.join(folder, published + ".br"), "rb") as infile:
+            self.assertEqual(brotli.decompress(infile.read()), b"version 1")
+        # Unchanged files are not rewritten.
+        os.utime(os.path.join(folder, published), (0, 0))
+        self.assertEqual(publish_file(sourcepath, folder), published)
+        self.assertEqual(os.path.getmtime(os.path.join(folder, published)), 0)
+        # A new version is published next to the previous one, which is removed separately.
+        with open(sourcepath, "wb") as outfile:
+            outfile.write(b"version 2")
+        republished = publish_file(sourcepath, folder)
+        self.assertNotEqual(republished, published)
+        self.assertTrue(os.path.exists(os.path.join(folder, republished + ".br")))
+        self.assertTrue(os.path.exists(os.path.join(folder, published)))
+        remove_previous_versions(folder, republished)
+        self.assertFalse([name for name in os.listdir(folder) if name.startswith(published)])
+        self.assertEqual(len([name for name in os.listdir(folder) if name.startswith(republished)]), 3)
+        self.assertTrue(os.path.exists(sourcepath))
+
+    def _publish_agent(self, version: bytes) -> MidiPlayerPublishAgent:
+        """Returns a publish agent for a MIDI file and a helping hand timeline with the given content."""
+        folder = self.settings.midiplayer.folder
+        agent = MidiPlayerPublishAgent(self.settings)
+        agent.part_name = "test"
+        agent.midi_filepath = os.path.join(folder, "test.mid")
+        agent.helpinghand_filepath = os.path.join(folder, "test_helpinghand.json")
+        for filepath in (agent.midi_filepath, agent.helpinghand_filepath):
+            with open(filepath, "wb") as outfile:
+                outfile.write(version + filepath.encode())
+        return agent
+
+    def test_publish_update_content(self):
+        MidiPlayerUpdatePartAgent(self.settings, PartForm(part="test", file="test.mid", loop=True))._main()
+        agent = self._publish_agent(b"version 1")
+        agent._main()
+        song = next(song for song in self.content().songs if song.title == self.settings.notationfile.title)
+        part = next(part for part in song.parts if part.part == "test")
+        self.assertEqual(part.file, agent.published_midi)
+        self.assertEqual(part.helpinghand, agent.published_helpinghand)
+        self.assertRegex(part.helpinghand, r"^test_helpinghand\.[0-9a-f]{10}\.json$")
+        # Parts without a helping hand timeline are saved without the helpinghand field.
+        with open(self.contentfilepath, "r", encoding="utf-8") as contentfile:
+            self.assertEqual(contentfile.read().count('"helpinghand"'), 1)
+
+    def test_publish_remove_previous_versions(self):
+        MidiPlayerUpdatePartAgent(self.settings, PartForm(part="test", file="test.mid", loop=True))._main()
+        folder = self.settings.midiplayer.folder
+        previous = self._publish_agent(b"version 1")
+        previous._main()
+        # A changed helping hand timeline is published under a new name, even if the MIDI file is unchanged.
+        agent = self._publish_agent(b"version 1")
+        with open(agent.helpinghand_filepath, "wb") as outfile:
+            outfile.write(b"version 2")
+        # The previous versions are kept if the content can't be saved, because the content still refers to them.
+        with patch.object(ContentStore, "save", side_effect=OSError("disk full")), patch.object(agent, "logerror"):
+            agent._main()
+        self.assertEqual(agent.published_midi, previous.published_midi)
+        self.assertNotEqual(agent.published_helpinghand, previous.published_helpinghand)
+        self.assertTrue(os.path.exists(os.path.join(folder, previous.published_helpinghand)))
+        # They are removed once the content refers to the new versions.
+        agent._main()
+        self.assertFalse(os.path.exists(os.path.join(folder, previous.published_helpinghand)))
+        self.assertTrue(os.path.exists(os.path.join(folder, agent.published_helpinghand)))
+        self.assertTrue(os.path.exists(os.path.join(folder, agent.published_midi)))
@@ -1,10 +1,12 @@
 # pylint: disable=missing-module-docstring, missing-class-docstring, missing-function-docstring, line-too-long, invalid-name
 
-from unittest.mock import MagicMock
+import os
+from unittest.mock import MagicMock, patch
 
 from src.common.classes import Score
 from src.common.constants import DEFAULT, Position
 from src.common.notes import NoteFactory
+from src.common.output_sinks import BytesIOSink, OutputKind
 from src.notation2midi.pipeline.score_to_notation import ScoreToNotationAgent
 from src.settings.constants import InstrumentFields
 from src.settings.settings import Settings
@@ -64,3 +66,38 @@ class ScoreToNotationTester(BaseUnitTestCase):
         for gongan, expected in self.gongan_data:
             with self.subTest(gongan=gongan.id):
                 self.assertEqual(agent._gongan_to_records(gongan), expected, "Failed for gongan %s" % gongan.id)
+
+    def test_main(self):
+        # The file contains one tab-separated line per record.
+        self.addCleanup(setattr, self.score.settings, "output_sink", self.score.settings.output_sink)
+        self.score.settings.output_sink = BytesIOSink()
+        self.score.gongans = [gongan for gongan, _ in self.gongan_data]
+        ScoreToNotationAgent(self.score)._main()
+        expected = "".join(
+            "\t".join(record.values()) + os.linesep for _, records in self.gongan_data for record in records
+        )
+        self.assertEqual(self.score.settings.output_sink.outputs[OutputKind.NOTATION].decode("utf-8"), expected)
+
+    def test_main_comment_with_tabs(self):
+        # Tabs in a comment are written as cell separators.
+        self.addCleanup(setattr, self.score.settings, "output_sink", self.score.settings.output_sink)
+        self.score.settings.output_sink = BytesIOSink()
+        gongan = self.gongan_data[0][0].model_copy(update={"comments": ["angsel\t\t\trall---\t\t"]})
+        self.score.gongans = [gongan]
+        ScoreToNotationAgent(self.score)._main()
+        notation = self.score.settings.output_sink.outputs[OutputKind.NOTATION].decode("utf-8")
+        self.assertEqual(notation.split(os.linesep)[0], "comment\tangsel\t\t\trall---\t\t\t\t")
+
+    def test_main_csv_error(self):
+        # The notation is not saved if it cannot be written as tab-separated values.
+        self.addCleanup(setattr, self.score.settings, "output_sink", self.score.settings.output_sink)
+        self.score.settings.output_sink = BytesIOSink()
+        self.score.gongans = [gongan for gongan, _ in self.gongan_data]
+        agent = ScoreToNotationAgent(self.score)
+        with (
+            patch.object(agent, "_gongan_to_rows", return_value=[["UGAL", "a\ta"]]),
+            patch.object(agent, "logerror") as logerror,
+        ):
+            agent._main()
+        logerror.assert_called_once()
+        self.assertNotIn(OutputKind.NOTATION, self.score.settings.output_sink.outputs)
@@ -0,0 +1,62 @@
+import html
+from unittest.mock import patch
+
+from reportlab.platypus import Paragraph
+
+from src.notation2midi.metadata_classes import MetaType
+from src.notation2midi.score2notationutils import formatting
+from src.notation2midi.score2notationutils.formatting import NotationTemplate
+from src.settings.settings import Settings
+from tests.conftest import BaseUnitTestCase
+
+# pylint: disable=missing-function-docstring
+# pylint: disable=protected-access
+
+
+class TestNotationTemplate(BaseUnitTestCase):
+    """Test case for the NotationTemplate class of the src.notation2midi.score2notation.formatting module"""
+
+    def setUp(self):
+        self.template = NotationTemplate(Settings.get(notation_id="test-gongkebyar", part_id="full"))
+        NotationTemplate._cell_size_cache.clear()
+        self.addCleanup(NotationTemplate._cell_size_cache.clear)
+
+    def paragraph_width_height(self, text: str, parastyle, width: float = 10e6) -> tuple[float, float]:
+        avail_width = width - 2 * self.template.cell_padding_LR
+        para = Paragraph(text, parastyle)
+        height = para.wrap(avail_width, 10e6)[1] + 2 * self.template.cell_padding_TB
+        return max(para.getActualLineWidths0()) + 2 * self.template.cell_padding_LR, height
+
+    def test_cell_width_height_notation_font(self):
+        # The notation cells are measured without Paragraph: the result should be identical.
+        for text in ("i", "-.ai", "i<-i<-", "a,a<a=", "----", "o o", "<b>i</b>"):
+            for width in (10e6, 20):
+                with self.subTest(text=text, width=width):
+                    rml_safe_text = html.escape(text) if "<b>" not in text else text
+                    self.assertEqual(
+                        self.template.cell_width_height(rml_safe_text, self.template.notationStyle, width),
+                        self.paragraph_width_height(rml_safe_text, self.template.notationStyle, width),
+                    )
+
+    def test_cell_width_height_cache(self):
+        self.addCleanup(setattr, NotationTemplate, "cell_size_cache_size", NotationTemplate.cell_size_cache_size)
+        NotationTemplate.cell_size_cache_size = 2
+        size = self.template.cell_width_height("quick fox", self.template.tagStyle)
+        self.assertEqual(size, self.paragraph_width_height("quick fox", self.template.tagStyle))
+        self.assertEqual(self.template.cell_width_height("quick fox", self.template.tagStyle), size)
+        self.template.cell_width_height("quick fox", self.template.commentStyle)
+        self.template.cell_width_height("quick", self.template.tagStyle)
+        # The cache is bounded: the oldest entry has been removed.
+        self.assertEqual(
+            list(NotationTemplate._cell_size_cache),
+            [("quick fox", "GamelanComment", 10e6), ("quick", "GamelanTag", 10e6)],
+        )
+
+    def test_shared_fonts_and_styles(self):
+        # A second template neither parses the font file again nor creates new paragraph styles.
+        with patch.object(formatting, "TTFont") as ttfont:
+            template = NotationTemplate(self.template.run_settings)
+        ttfont.assert_not_called()
+        self.assertIs(template.notationStyle, self.template.notationStyle)
+        # The formatters are bound to their own template, which keeps track of the current tempo.
+        self.assertIs(template.metaFormatParameters[MetaType.TEMPO]["formatter"].__self__, template)
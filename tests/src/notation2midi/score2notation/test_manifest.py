@@ -0,0 +1,76 @@
+import os
+import tempfile
+
+from src.common.classes import Beat, Gongan, Measure, Score
+from src.common.constants import DEFAULT, Position
+from src.common.output_sinks import BytesIOSink
+from src.notation2midi.metadata_classes import MetaType
+from src.notation2midi.score2notationutils.manifest import (
+    MANIFEST_FILENAME,
+    export_is_up_to_date,
+    record_export,
+    score_fingerprint,
+)
+from src.settings.settings import Settings
+from tests.conftest import BaseUnitTestCase
+from tests.src.utils_for_tests import PositionNote
+
+# pylint: disable=missing-module-docstring
+# pylint: disable=missing-function-docstring
+
+P = PositionNote(Position.PEMADE_POLOS)
+
+
+class ExportManifestTester(BaseUnitTestCase):
+
+    def setUp(self):
+        self.settings = Settings.get(notation_id="test-gongkebyar", part_id="full")
+        self.addCleanup(setattr, self.settings, "output_sink", self.settings.output_sink)
+
+    def score(self, notes: list) -> Score:
+        gongan = Gongan(
+            id=1,
+            beats=[
+                Beat(
+                    id=1,
+                    gongan_id=1,
+                    measures={
+                        P.position: Measure(
+                            position=P.position,
+                            all_positions=P.position,
+                            passes={DEFAULT: Measure.Pass(seq=-1, notes=notes)},
+                        )
+                    },
+                )
+            ],
+        )
+        return Score(title="Test", settings=self.settings, gongans=[gongan])
+
+    def test_score_fingerprint(self):
+        fingerprint = score_fingerprint(self.score([P.DING1, P.DONG1]), 1)
+        # Notes are new objects with a different unique id.
+        self.assertEqual(score_fingerprint(self.score([P.DING1, P.DONG1]), 1), fingerprint)
+        self.assertNotEqual(score_fingerprint(self.score([P.DING1, P.DENG1]), 1), fingerprint)
+        self.assertNotEqual(score_fingerprint(self.score([P.DING1, P.DONG1]), 2), fingerprint)
+
+    def test_score_fingerprint_metadata_lookup(self):
+        score = self.score([P.DING1, P.DONG1])
+        fingerprint = score_fingerprint(score, 1)
+        # Looking up a metadata type adds an empty list to the metadata defaultdict.
+        _ = score.gongans[0].metadata[MetaType.KEMPLI]
+        _ = score.global_metadata[MetaType.GONGAN]
+        self.assertEqual(score_fingerprint(score, 1), fingerprint)
+
+    def test_export_is_up_to_date(self):
+        with tempfile.TemporaryDirectory() as folder:
+            filepath = os.path.join(folder, "score.pdf")
+            with open(filepath, "wb") as outfile:
+                outfile.write(b"%PDF")
+            self.assertFalse(export_is_up_to_date(self.settings, filepath, "abc"))
+            record_export(self.settings, filepath, "abc")
+            self.assertTrue(os.path.exists(os.path.join(folder, MANIFEST_FILENAME)))
+            self.assertTrue(export_is_up_to_date(self.settings, filepath, "abc"))
+            self.assertFalse(export_is_up_to_date(self.settings, filepath, "abd"))
+            # Output that is not written to the file system is always exported.
+            self.settings.output_sink = BytesIOSink()
+            self.assertFalse(export_is_up_to_date(self.settings, filepath, "abc"))
@@ -1,5 +1,5 @@
 import unittest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
 from src.common.classes import Gongan
 from src.common.constants import Position, Stroke
@@ -10,6 +10,7 @@ from src.notation2midi.metadata_classes import (
     MetaDataSwitch,
     MetaType,
 )
+from src.notation2midi.score2notationutils import utils
 from src.notation2midi.score2notationutils.utils import (
     aggregate_positions,
     clean_staves,
@@ -302,6 +303,32 @@ class TestUtils(BaseUnitTestCase):
             with self.subTest(gongan_id=gongan.id):
                 self.assertEqual(aggregate_positions(gongan), expected)
 
+    def test_aggregate_positions_cache(self):
+        PP = PositionNote(position=Position.PEMADE_POLOS)
+        PS = PositionNote(position=Position.PEMADE_SANGSIH)
+        KP = PositionNote(position=Position.KANTILAN_POLOS)
+        KS = PositionNote(position=Position.KANTILAN_SANGSIH)
+        gongan = create_gongan(
+            1,
+            {
+                PP.position: {-1: [[PP.DANG0, PP.DING2]]},
+                PS.position: {-1: [[PS.DENG1, PS.DING2]]},
+                KP.position: {-1: [[KP.DANG0, KP.DING2]]},
+                KS.position: {-1: [[KS.DENG1, KS.DING2]]},
+            },
+        )
+        self.assertEqual(aggregate_positions(gongan), {(Position.PEMADE_POLOS, -1): "GANGSA"})
+        # The second call retrieves the result from the gongan without casting any notes.
+        with patch.object(utils, "cast_note_key") as cast_note_key:
+            self.assertEqual(aggregate_positions(gongan), {(Position.PEMADE_POLOS, -1): "GANGSA"})
+        cast_note_key.assert_not_called()
+        # Metadata that affects the casting of notes causes the aggregation to be re-evaluated.
+        gongan.metadata[MetaType.AUTOKEMPYUNG] = [AutoKempyungMeta(metatype="AUTOKEMPYUNG", status=MetaDataSwitch.OFF)]
+        self.assertEqual(
+            aggregate_positions(gongan),
+            {(Position.PEMADE_POLOS, -1): "GANGSA_P", (Position.PEMADE_SANGSIH, -1): "GANGSA_S"},
+        )
+
 
 if __name__ == "__main__":
     unittest.main()
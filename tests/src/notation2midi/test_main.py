@@ -0,0 +1,35 @@
+import os
+import tempfile
+
+from src.common.output_sinks import FileSink, OutputKind
+from src.notation2midi.main import run_pipeline_in_memory
+from src.settings.settings import Settings
+from tests.conftest import BaseUnitTestCase
+
+
+class MainTester(BaseUnitTestCase):
+
+    def test_run_pipeline_in_memory(self):
+        run_settings = Settings.get(notation_id="test_beat_at_end", part_id="full")
+        with open(run_settings.notation_filepath, "r", encoding="utf-8") as infile:
+            notation = infile.read()
+        # The settings object is shared by all tests.
+        options = run_settings.options.notation_to_midi
+        notationfile = run_settings.configdata.notationfiles[run_settings.notation_id]
+        for obj, attributes in (
+            (options, ("save_midifile", "save_pdf_notation")),
+            (notationfile, ("folder_in", "folder_out_nonprod")),
+        ):
+            for attribute in attributes:
+                self.addCleanup(setattr, obj, attribute, getattr(obj, attribute))
+        options.save_midifile = options.save_pdf_notation = True
+        with tempfile.TemporaryDirectory() as folder:
+            # Any file that is read from or written to the notation folders would end up in the empty folder.
+            notationfile.folder_in = notationfile.folder_out_nonprod = folder
+            outputs = run_pipeline_in_memory(run_settings, notation)
+            self.assertEqual(os.listdir(folder), [])
+        self.assertTrue(outputs[OutputKind.MIDI].startswith(b"MThd"))
+        self.assertTrue(outputs[OutputKind.PDF].startswith(b"%PDF"))
+        # The settings are restored.
+        self.assertIsNone(run_settings.notation)
+        self.assertIsInstance(run_settings.output_sink, FileSink)
@@ -1,16 +1,26 @@
 """Tests that grace notes are processed correctly by the MidiTrackX class"""
 
+import json
 import os
+import pickle
+import tempfile
+from io import BytesIO
+from unittest.mock import patch
 
-from mido import Message
+from mido import Message, MidiFile, tempo2bpm
 
 from src.common.classes import Preset
 from src.common.constants import Position
 from src.notation2midi.execution.execution import ExecutionManager
-from src.notation2midi.midi.midi_track import MidiTrackX
+from src.notation2midi.midi.midi_events import SET_TEMPO, TempoMap, write_midifile
+from src.notation2midi.midi.midi_track import BeatInfo, MidiTrackX, TimeUnit
+from src.notation2midi.midi import segment_cache
+from src.notation2midi.midi.segment_cache import SegmentCache, digest
 from src.notation2midi.pipeline.score_to_midi import MidiGeneratorAgent
+from src.settings.classes import HelpingHandOutput, TempoCurve
 from src.settings.settings import Settings
 from tests.conftest import BaseUnitTestCase
+from tests.src.utils_for_tests import PositionNote
 
 # pylint: disable=protected-access
 # pylint: disable=missing-class-docstring
@@ -49,3 +59,291 @@ class TestSpecialNotes(BaseUnitTestCase):
         self.midi_track.open_noteoff_msgs = [Message("note_off", note=60, time=100)]
         midi_duration = self.midi_track._grace_note_duration()
         assert midi_duration == 0
+
+    def test_pickle_omits_shared_attributes(self):
+        """Tracks that are generated by a worker process are returned without the shared objects."""
+        P = PositionNote(Position.PEMADE_POLOS)
+        for note in (P.DING1, P.DONG1, P.SILENCE, P.DENG1):
+            self.midi_track.add_note(note)
+        self.midi_track.finalize()
+        state = self.midi_track.__getstate__()
+        self.assertFalse(set(MidiTrackX.SHARED_ATTRIBUTES) & set(state.keys()))
+
+        track: MidiTrackX = pickle.loads(pickle.dumps(self.midi_track))
+        track.restore_shared_attributes(self.run_settings, self.midi_track.midi_dict)
+        self.assertEqual(list(track.to_mido()), list(self.midi_track.to_mido()))
+        self.assertEqual(track.total_tick_time(), self.midi_track.total_tick_time())
+        self.assertIs(track.run_settings, self.run_settings)
+
+    def test_tick_clock(self):
+        P = PositionNote(Position.PEMADE_POLOS)
+        for note in (P.DING1, P.DONG1, P.SILENCE, P.DENG1):
+            self.midi_track.add_note(note)
+        self.midi_track.finalize()
+        self.midi_track.extend_last_notes(24, TimeUnit.TICK)
+        messages = self.midi_track.to_mido()
+        self.assertEqual(self.midi_track.total_tick_time(), sum(msg.time for msg in messages))
+        self.assertEqual(self.midi_track.message_count, len(messages))
+        self.midi_track.check_tick_clock()
+        # Modifying a message without updating the tick clock should be detected.
+        self.midi_track.events.deltas[-1] += 1
+        with self.assertRaises(ValueError):
+            self.midi_track.check_tick_clock()
+
+    def test_binary_encoder_equals_mido(self):
+        P = PositionNote(Position.PEMADE_POLOS)
+        self.midi_track.name = MidiTrackX.TEMPO_TRACK_NAME  # Enables tempo messages
+        self.midi_track.comment("comment")
+        self.midi_track.set_beat_info(
+            BeatInfo(fullid="1-1", start_bpm=60, end_bpm=90, start_velocity=40, end_velocity=100, duration=4)
+        )
+        for note in (P.DING1, P.DONG1, P.SILENCE, P.DENG1, P.DENG1, P.EXTENSION):
+            self.midi_track.add_note(note)
+        self.midi_track.marker("marker")
+        self.midi_track.finalize()
+        self.midi_track.extend_last_notes(1, TimeUnit.SECOND)
+
+        binary_file = BytesIO()
+        write_midifile(binary_file, [self.midi_track.events] * 2, self.run_settings.midi.PPQ)
+        mido_file = BytesIO()
+        MidiFile(ticks_per_beat=self.run_settings.midi.PPQ, type=1, tracks=[self.midi_track.to_mido()] * 2).save(
+            file=mido_file
+        )
+        self.assertEqual(binary_file.getvalue(), mido_file.getvalue())
+
+    def _tempo_curve(self, tempo_curve: TempoCurve, tolerance: float) -> tuple[list[tuple[int, int]], int]:
+        """Generates a gradual tempo change followed by a beat with constant tempo.
+        Returns the tick time and tempo of the tempo messages and the number of tempo changes of the fixed curve."""
+        midi = self.run_settings.midi
+        self.addCleanup(setattr, midi, "tempo_curve", midi.tempo_curve)
+        self.addCleanup(setattr, midi, "tempo_tolerance", midi.tempo_tolerance)
+        midi.tempo_curve, midi.tempo_tolerance = tempo_curve, tolerance
+        P = PositionNote(Position.PEMADE_POLOS)
+        track = MidiTrackX(
+            Position.KEMPLI, Preset.get_preset(Position.KEMPLI), self.midi_track.midi_dict, self.run_settings
+        )
+        for start_bpm, end_bpm in ((60, 120), (120, 120)):
+            track.set_beat_info(
+                BeatInfo(
+                    fullid="1-1", start_bpm=start_bpm, end_bpm=end_bpm, start_velocity=60, end_velocity=60, duration=16
+                )
+            )
+            for _ in range(16):
+                track.add_note(P.DING1)
+        tempo_changes = track.events.tempo_changes()
+        self.assertEqual(len(tempo_changes), track.tempo_message_count)
+        return tempo_changes, track.grid_tempo_change_count
+
+    @staticmethod
+    def _tempo_at(tempo_changes: list[tuple[int, int]], ticktime: int) -> int:
+        return [tempo for time, tempo in tempo_changes if time <= ticktime][-1]
+
+    def test_adaptive_tempo_curve(self):
+        fixed_changes, grid_count = self._tempo_curve(TempoCurve.FIXED, 0)
+        self.assertEqual(len(fixed_changes), grid_count)
+        fixed_map = TempoMap(fixed_changes, self.run_settings.midi.PPQ)
+        fixed_tempi = [round(tempo2bpm(tempo)) for _, tempo in fixed_changes]
+        for tempo_curve, tolerance in ((TempoCurve.BPM, 0), (TempoCurve.BPM, 5), (TempoCurve.MILLISECONDS, 10)):
+            with self.subTest(tempo_curve=tempo_curve, tolerance=tolerance):
+                changes, count = self._tempo_curve(tempo_curve, tolerance)
+                tempi = [round(tempo2bpm(tempo)) for _, tempo in changes]
+                self.assertEqual(count, grid_count)
+                self.assertEqual(tempi[-1], fixed_tempi[-1])  # The curve ends on the exact tempo.
+                if tolerance == 0:
+                    self.assertEqual(tempi, fixed_tempi)
+                else:
+                    self.assertLess(len(tempi), len(fixed_tempi))
+                # Both curves are step functions, so the largest errors occur at their tempo changes.
+                ticktimes = sorted({time for time, _ in changes + fixed_changes})
+                if tempo_curve is TempoCurve.BPM:
+                    errors = [
+                        tempo2bpm(self._tempo_at(changes, time)) - tempo2bpm(self._tempo_at(fixed_changes, time))
+                        for time in ticktimes
+                    ]
+                else:
+                    tempo_map = TempoMap(changes, self.run_settings.midi.PPQ)
+                    errors = [1000 * (tempo_map.seconds(time) - fixed_map.seconds(time)) for time in ticktimes]
+                # The tempo messages are rounded to whole BPM values.
+                self.assertLessEqual(max(abs(error) for error in errors), tolerance + 0.5)
+
+    def _helpinghand_track(self, output: HelpingHandOutput) -> MidiTrackX:
+        midiplayer = self.run_settings.midiplayer
+        self.addCleanup(setattr, midiplayer, "helpinghand_output", midiplayer.helpinghand_output)
+        midiplayer.helpinghand_output = output
+        P = PositionNote(Position.PEMADE_POLOS)
+        track = MidiTrackX(
+            Position.PEMADE_POLOS,
+            Preset.get_preset(Position.PEMADE_POLOS),
+            self.midi_track.midi_dict,
+            self.run_settings,
+        )
+        for note in (P.DING1, P.DONG1, P.SILENCE, P.DENG1):
+            track.add_note(note)
+        track.finalize()
+        return track
+
+    def test_helpinghand_markers(self):
+        track = self._helpinghand_track(HelpingHandOutput.MARKERS)
+        markers = [json.loads(msg.text) for msg in track.to_mido() if msg.type == "marker"]
+        self.assertEqual([marker["pitch"] for marker in markers], ["DING", "DONG", "DENG", "DING"])
+        self.assertEqual([marker["islast"] for marker in markers], [False, False, False, True])
+        # At 60 BPM (initial tempo), a note lasts 250 ms.
+        self.assertEqual([marker["timeuntil"] for marker in markers], [0, 250, 500, 250])
+        self.assertTrue(all(marker["position"] == "PEMADE_POLOS" for marker in markers))
+
+    def test_helpinghand_sidecar(self):
+        markers = self._helpinghand_track(HelpingHandOutput.MARKERS)
+        track = self._helpinghand_track(HelpingHandOutput.SIDECAR)
+        self.assertFalse(any(msg.type == "marker" for msg in track.to_mido()))
+        self.assertEqual(track.message_count, markers.message_count - 4)
+        timeline = track.helpinghand_timeline()
+        self.assertEqual(timeline["channel"], track.channel)
+        self.assertEqual(timeline["events"], markers.helpinghand_timeline()["events"])
+        self.assertEqual([entry[2] for entry in timeline["events"]], ["DING", "DONG", "DENG", "DING"])
+
+    def _add_segment(self, track: MidiTrackX, segment_nr: int):
+        P = PositionNote(Position.PEMADE_POLOS)
+        track.set_beat_info(
+            BeatInfo(fullid=f"{segment_nr}-1", start_bpm=60, end_bpm=80, start_velocity=60, end_velocity=90, duration=4)
+        )
+        for note in (P.DING1, P.DONG1, P.SILENCE, P.DENG1):
+            track.add_note(note)
+
+    def test_splice_segment(self):
+        position = Position.PEMADE_POLOS
+        # Generate three segments and collect the second one.
+        generated = MidiTrackX(position, Preset.get_preset(position), self.midi_track.midi_dict, self.run_settings)
+        self._add_segment(generated, 1)
+        state = generated.segment_state()
+        mark = generated.mark_segment()
+        self._add_segment(generated, 2)
+        segment = generated.collect_segment(mark)
+        self._add_segment(generated, 3)
+        generated.finalize()
+        # Splice the second segment into a track with the same state.
+        spliced = MidiTrackX(position, Preset.get_preset(position), self.midi_track.midi_dict, self.run_settings)
+        self._add_segment(spliced, 1)
+        self.assertEqual(spliced.segment_state(), state)
+        spliced.splice_segment(pickle.loads(pickle.dumps(segment)))
+        self._add_segment(spliced, 3)
+        spliced.finalize()
+
+        self.assertEqual(spliced.events.deltas, generated.events.deltas)
+        self.assertEqual(spliced.events.events, generated.events.events)
+        self.assertEqual(spliced.helpinghand_events, generated.helpinghand_events)
+        self.assertEqual(spliced.segment_state(), generated.segment_state())
+        spliced.check_tick_clock()
+
+    def test_splice_segment_at_other_position(self):
+        position = Position.PEMADE_POLOS
+        generated = MidiTrackX(position, Preset.get_preset(position), self.midi_track.midi_dict, self.run_settings)
+        self._add_segment(generated, 1)
+        state = generated.segment_state()
+        mark = generated.mark_segment()
+        self._add_segment(generated, 2)
+        segment = generated.collect_segment(mark)
+        # The state only contains relative times, so the segment can be reused later in the track.
+        expected = MidiTrackX(position, Preset.get_preset(position), self.midi_track.midi_dict, self.run_settings)
+        spliced = MidiTrackX(position, Preset.get_preset(position), self.midi_track.midi_dict, self.run_settings)
+        for track in (expected, spliced):
+            self._add_segment(track, 1)
+            self._add_segment(track, 1)
+        self.assertGreater(spliced.current_ticktime, mark.ticktime)
+        self.assertEqual(spliced.segment_state(), state)
+        self._add_segment(expected, 2)
+        spliced.splice_segment(segment)
+        for track in (expected, spliced):
+            track.finalize()
+
+        self.assertEqual(spliced.events.events, expected.events.events)
+        self.assertEqual(spliced.helpinghand_events, expected.helpinghand_events)
+        self.assertEqual(spliced.current_millitime, expected.current_millitime)
+        self.assertEqual(spliced.segment_state(), expected.segment_state())
+
+    def test_segment_cache(self):
+        with tempfile.TemporaryDirectory() as folder:
+            filepath = os.path.join(folder, "cache", "segments.pickle")
+            cache = SegmentCache(filepath, "settings")
+            self.assertEqual(cache.segments, {})
+            mark = self.midi_track.mark_segment()
+            self._add_segment(self.midi_track, 1)
+            key = digest("key")
+            cache.save({key: self.midi_track.collect_segment(mark)})
+            self.assertEqual(SegmentCache(filepath, "settings").get(key), cache.get(key))
+            # The content is discarded if the settings differ.
+            self.assertIsNone(SegmentCache(filepath, "other settings").get(key))
+
+    def test_segment_cache_unreadable(self):
+        with tempfile.TemporaryDirectory() as folder:
+            filepath = os.path.join(folder, "segments.pickle")
+            cache = SegmentCache(filepath, "settings")
+            # Segments that can't be unpickled, e.g. because a class no longer exists, are discarded.
+            with open(filepath, "wb") as cachefile:
+                pickle.dump(cache.fingerprint, cachefile)
+                cachefile.write(b"cnonexistent_module\nTrackSegment\n.")
+            with patch.object(segment_cache.logger, "warning") as warning:
+                self.assertEqual(SegmentCache(filepath, "settings").segments, {})
+                warning.assert_called_once()
+                # The segments of a cache with other settings are not read.
+                warning.reset_mock()
+                self.assertEqual(SegmentCache(filepath, "other settings").segments, {})
+                warning.assert_not_called()
+
+    def test_tempo_map_duration_equals_mido_length(self):
+        P = PositionNote(Position.PEMADE_POLOS)
+        tracks = [
+            MidiTrackX(position, Preset.get_preset(position), self.midi_track.midi_dict, self.run_settings)
+            for position in (Position.KEMPLI, Position.PEMADE_POLOS)
+        ]
+        for track, notes in zip(tracks, ((P.DING1, P.SILENCE), (P.DONG1, P.DENG1, P.DENG1))):
+            for start_bpm, end_bpm in ((60, 120), (120, 120), (120, 45)):
+                track.set_beat_info(
+                    BeatInfo(
+                        fullid="1-1",
+                        start_bpm=start_bpm,
+                        end_bpm=end_bpm,
+                        start_velocity=60,
+                        end_velocity=60,
+                        duration=6,
+                    )
+                )
+                for _ in range(2):
+                    for note in notes:
+                        track.add_note(note)
+            track.finalize()
+        tracks[1].extend_last_notes(2, TimeUnit.SECOND)
+        tempo_map = TempoMap(tracks[0].events.tempo_changes(), self.run_settings.midi.PPQ)
+        duration = tempo_map.seconds(max(track.total_tick_time() for track in tracks))
+        midifile = MidiFile(
+            ticks_per_beat=self.run_settings.midi.PPQ, type=1, tracks=[track.to_mido() for track in tracks]
+        )
+        self.assertAlmostEqual(duration, midifile.length, delta=0.001)
+
+
+class TestBeatInfo(BaseUnitTestCase):
+    def test_update_times_and_change_fraction(self):
+        freq = BeatInfo.UPDATEFREQ
+        for tick_duration in (0, freq - 1, freq, 5 * freq + 7):
+            beat_info = BeatInfo(
+                fullid="1-1",
+                start_bpm=60,
+                end_bpm=90,
+                start_velocity=40,
+                end_velocity=80,
+                duration=1,
+                start_ticktime=100,
+                end_ticktime=100 + tick_duration,
+                update_count=int(tick_duration / freq) + 1,
+            )
+            # Reference values: explicit list of update times.
+            update_times = [100 + t * freq for t in range(int(tick_duration / freq) + 1)]
+            for from_time, to_time in ((0, 1000), (100, 100), (101, 100 + freq), (90, 99), (130, 300), (200, 150)):
+                with self.subTest(tick_duration=tick_duration, interval=(from_time, to_time)):
+                    self.assertEqual(
+                        list(beat_info.update_times(from_time, to_time)),
+                        [t for t in update_times if from_time <= t <= to_time],
+                    )
+            for ticktime in range(80, 100 + tick_duration + 2 * freq):
+                past = [t for t in update_times if t <= ticktime]
+                expected = update_times.index(past[-1]) / len(update_times) if past else 0
+                self.assertEqual(beat_info.get_change_fraction(ticktime), expected)
@@ -0,0 +1,65 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from src.settings.classes import ContentLayout, Song
+from src.settings.content_store import ContentStore, convert_content
+
+# pylint: disable=missing-module-docstring
+# pylint: disable=missing-function-docstring
+
+CONTENTFOLDER = "./data/midiplayer"
+CONTENTFILE = "content.json"
+
+
+class ContentStoreTester(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        shutil.copy(os.path.join(CONTENTFOLDER, CONTENTFILE), self.folder)
+
+    def read(self, file: str) -> str:
+        with open(os.path.join(self.folder, file), "r", encoding="utf-8") as infile:
+            return infile.read()
+
+    def test_convert_round_trip(self):
+        original = self.read(CONTENTFILE)
+        content = ContentStore(self.folder, CONTENTFILE).load()
+        convert_content(self.folder, CONTENTFILE, ContentLayout.SHARDED)
+        self.assertEqual(len(os.listdir(os.path.join(self.folder, "songs"))), len(content.songs))
+        self.assertEqual(ContentStore(self.folder, CONTENTFILE).load(), content)
+        convert_content(self.folder, CONTENTFILE, ContentLayout.MONOLITHIC)
+        self.assertEqual(self.read(CONTENTFILE), original)
+        self.assertEqual(os.listdir(os.path.join(self.folder, "songs")), [])
+
+    def test_save_changed_songs_only(self):
+        convert_content(self.folder, CONTENTFILE, ContentLayout.SHARDED)
+        store = ContentStore(self.folder, CONTENTFILE, ContentLayout.SHARDED)
+        content = store.load()
+        changed, unchanged, removed = content.songs[0], content.songs[1], content.songs[2]
+        for song in content.songs:
+            os.utime(os.path.join(self.folder, store.song_file(song.title)), (0, 0))
+        changed.pdf = "changed.pdf"
+        content.songs.remove(removed)
+        content.songs.append(new := Song(title="New Song", instrumentgroup=changed.instrumentgroup, display=True))
+        store.save(content)
+
+        def is_written(song: Song) -> bool:
+            return os.path.getmtime(os.path.join(self.folder, store.song_file(song.title))) > 0
+
+        self.assertTrue(is_written(changed))
+        self.assertFalse(is_written(unchanged))
+        self.assertTrue(is_written(new))
+        self.assertFalse(os.path.exists(os.path.join(self.folder, store.song_file(removed.title))))
+        self.assertEqual(ContentStore(self.folder, CONTENTFILE).load(), content)
+
+    def test_song_file_collision(self):
+        store = ContentStore(self.folder, CONTENTFILE, ContentLayout.SHARDED)
+        content = store.load()
+        song = content.songs[0]
+        content.songs.append(song.model_copy(update={"title": song.title + "?"}))
+        content.songs.append(song.model_copy(update={"title": song.title + "*"}))
+        with self.assertRaises(ValueError):
+            store.save(content)
@@ -0,0 +1,32 @@
+import io
+import unittest
+
+from src.common.constants import InstrumentGroup
+from src.settings.utils import pretty_compact_json, write_pretty_compact_json
+
+# pylint: disable=missing-function-docstring
+
+
+class PrettyCompactJsonTester(unittest.TestCase):
+
+    def test_simple_structures_on_one_line(self):
+        obj = {"title": "Sinom", "group": InstrumentGroup.GONG_KEBYAR, "display": True, "pdf": None, "loop": [1, 2.5]}
+        self.assertEqual(
+            pretty_compact_json(obj),
+            '{\n        "title": "Sinom", \n        "group": "GONG_KEBYAR", \n        "display": true, \n'
+            '        "pdf": null, \n        "loop": [1, 2.5]}',
+        )
+
+    def test_equal_items(self):
+        # Items that are equal to the last item of a list are formatted like any other item.
+        distinct = pretty_compact_json({"songs": [{"parts": [1]}, {"parts": [2]}]})
+        self.assertEqual(pretty_compact_json({"songs": [{"parts": [1]}, {"parts": [1]}]}), distinct.replace("2", "1"))
+
+    def test_write_to_stream(self):
+        # The items of `markers` are always written on separate lines.
+        stream = io.StringIO()
+        write_pretty_compact_json({"songs": [], "markers": {"a": 1.0, "b": 2.0}}, stream)
+        self.assertEqual(
+            stream.getvalue(),
+            '{\n        "songs": [], \n        "markers": {\n                "a": 1.0, \n                "b": 2.0\n        }\n}',
+        )